@@ -23,7 +23,18 @@ def flush_print(*args, **kwargs):
 def create_app():
     # import all routers
     from src.apis import apis
-
+    from src.config.database import EnsureIndexes
+    from src.config.settings import QUERY_TRACE_LOG
+    from src.utils.batching import add_trace_hook, print_trace, trace_queries
+    from src.utils.mailer import start_outbox_worker, stop_outbox_worker
+
+    app.add_event_handler("startup", EnsureIndexes)
+    app.add_event_handler("startup", start_outbox_worker)
+    app.add_event_handler("shutdown", stop_outbox_worker)
+
+    app.middleware("http")(trace_queries)
+    if QUERY_TRACE_LOG:
+        add_trace_hook(print_trace)
     app.add_middleware(GZipMiddleware, minimum_size=1000)
 
     # Register all routers
@@ -4,6 +4,7 @@ from fastapi import APIRouter
 #Import all routers
 from src.apis.authentication import router as auth_router
 from src.apis.account import router as accountRouter
+from src.apis.analytics import router as analyticsRouter
 from src.apis.clients import router as clientRouter
 from src.apis.currency import router as currencyRouter
 from src.apis.invoice import router as invoiceRouter
@@ -18,6 +19,7 @@ apis = APIRouter()
 #Register all routers
 apis.include_router(auth_router)
 apis.include_router(accountRouter)
+apis.include_router(analyticsRouter)
 apis.include_router(clientRouter)
 apis.include_router(currencyRouter)
 apis.include_router(invoiceRouter)
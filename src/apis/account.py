@@ -1,12 +1,18 @@
 import json
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Request
 
 from pydantic import BaseModel, Field
 from typing import List, Optional
 
 from starlette.exceptions import HTTPException
 from starlette.status import HTTP_400_BAD_REQUEST
-from src.config.database import DataAggregation, DataWriter, DeleteData, SingleDataReader, UpdateWriter
+from src.config.database import (
+    DataAggregation,
+    DataWriter,
+    DeleteData,
+    FindOneAndUpdate,
+    SingleDataReader,
+)
 from src.models.api_schemas import UpdatedAt
 from src.models.models import AccountInfoDB
 from src.utils.auth import get_utc_timestamp
@@ -14,6 +20,8 @@ from src.utils.auth import get_utc_timestamp
 # from src.prisma import prisma
 from src.utils.permissions import validate_jwt_token, OrgAdminAccess
 from src.utils.permissions import JWTRequired, OrgStaffAccess
+from src.utils.cache import cached_response, invalidate_cache
+from src.utils.reference_data import reference_data, with_organization
 
 router = APIRouter()
 
@@ -31,18 +39,10 @@ class UpdateAccountInfo(BaseModel):
 
 
 @router.get("/account", tags=["accounts"], dependencies=[Depends(JWTRequired), Depends(OrgStaffAccess)])
-async def get_all_accounts(user=Depends(validate_jwt_token)):
+async def get_all_accounts(request: Request, user=Depends(validate_jwt_token)):
 
     pipeline = [
         {"$match": {"orgId": user.orgId}},
-        {
-            "$lookup": {
-                "from": "Organization",
-                "localField": "orgId",
-                "foreignField": "id",
-                "as": "organization"
-            }
-        },
         {
             "$lookup": {
                 "from": "Transaction",
@@ -51,9 +51,6 @@ async def get_all_accounts(user=Depends(validate_jwt_token)):
                 "as": "transactions"
             }
         },
-        {
-            "$unwind": "$organization"
-        },
         {
             "$project": {
                 "_id": 0,
@@ -62,17 +59,19 @@ async def get_all_accounts(user=Depends(validate_jwt_token)):
                 }
             }
         },
-        {
-            "$unset": ["organization._id"]
-        },
         {"$sort": {"accountNumber": 1}}
     ]
-    return DataAggregation("AccountInfo", pipeline)
+    return await cached_response(
+        request,
+        "account",
+        user,
+        lambda: [with_organization(account) for account in DataAggregation("AccountInfo", pipeline)],
+    )
 
 
 @router.post("/account", tags=["accounts"], dependencies=[Depends(JWTRequired), Depends(OrgAdminAccess)])
 async def create_account(account: AccountInfo):
-    organization = SingleDataReader("Organization", {"id": account.orgId})
+    organization = reference_data.organization(account.orgId)
     if not organization:
         raise HTTPException(
             detail=f"Invalid Organization ID", status_code=HTTP_400_BAD_REQUEST
@@ -80,29 +79,16 @@ async def create_account(account: AccountInfo):
 
     created_account = AccountInfoDB(**account.dict())
     DataWriter("AccountInfo", created_account.dict())
+    invalidate_cache("account", "organization", org_id=created_account.orgId)
     pipeline = [
         {"$match": {"id": created_account.id}},
-        {
-            "$lookup": {
-                "from": "Organization",
-                "localField": "orgId",
-                "foreignField": "id",
-                "as": "organization"
-            }
-        },
-        {
-            "$unwind": "$organization"
-        },
         {
             "$project": {
                 "_id": 0,
             }
-        },
-        {
-            "$unset": ["organization._id"]
         }
     ]
-    return DataAggregation("AccountInfo", pipeline)[0]
+    return with_organization(DataAggregation("AccountInfo", pipeline)[0])
 
 
 @router.get("/account/{account_id}", tags=["accounts"], dependencies=[Depends(JWTRequired), Depends(OrgStaffAccess)])
@@ -110,14 +96,6 @@ async def get_account_by_id(account_id: str):
 
     pipeline = [
         {"$match": {"id": account_id}},
-        {
-            "$lookup": {
-                "from": "Organization",
-                "localField": "orgId",
-                "foreignField": "id",
-                "as": "organization"
-            }
-        },
         {
             "$lookup": {
                 "from": "Transaction",
@@ -126,9 +104,6 @@ async def get_account_by_id(account_id: str):
                 "as": "transactions"
             }
         },
-        {
-            "$unwind": "$organization"
-        },
         {
             "$project": {
                 "_id": 0,
@@ -136,9 +111,6 @@ async def get_account_by_id(account_id: str):
                     "_id": 0,
                 }
             }
-        },
-        {
-            "$unset": ["organization._id"]
         }
     ]
     account = DataAggregation("AccountInfo", pipeline)
@@ -146,7 +118,7 @@ async def get_account_by_id(account_id: str):
         raise HTTPException(
             detail=f"Invalid AccountInfo ID", status_code=HTTP_400_BAD_REQUEST
         )
-    return account
+    return [with_organization(row) for row in account]
 
 
 @router.post("/account/{account_id}", tags=["accounts"], dependencies=[Depends(JWTRequired), Depends(OrgAdminAccess)])
@@ -156,14 +128,6 @@ async def update_account_by_id(
 
     pipeline = [
         {"$match": {"id": account_id}},
-        {
-            "$lookup": {
-                "from": "Organization",
-                "localField": "orgId",
-                "foreignField": "id",
-                "as": "organization"
-            }
-        },
         {
             "$lookup": {
                 "from": "Transaction",
@@ -172,9 +136,6 @@ async def update_account_by_id(
                 "as": "transactions"
             }
         },
-        {
-            "$unwind": "$organization"
-        },
         {
             "$project": {
                 "_id": 0,
@@ -182,18 +143,15 @@ async def update_account_by_id(
                     "_id": 0,
                 }
             }
-        },
-        {
-            "$unset": ["organization._id"]
         }
     ]
-    account_detail = DataAggregation("AccountInfo", pipeline)[0]
-    account = AccountInfoDB(**account_detail)
-
-    if not account:
+    account_detail = DataAggregation("AccountInfo", pipeline)
+    if not account_detail:
         raise HTTPException(
             detail=f"Invalid AccountInfo ID", status_code=HTTP_400_BAD_REQUEST
         )
+    account_detail = account_detail[0]
+    account = AccountInfoDB(**account_detail)
 
     if update_info.orgId and update_info.orgId != account.orgId:
         organization = SingleDataReader("Organization", {"id": update_info.orgId})
@@ -218,45 +176,20 @@ async def update_account_by_id(
         "orgId": account.orgId,
     }
 
-    if json.dumps(prev_data) != json.dumps(update_info.dict()):
-        UpdateWriter("AccountInfo", {"id": account_id}, {**update_info.dict(), **UpdatedAt().dict()})
+    if json.dumps(prev_data) == json.dumps(update_info.dict()):
+        return with_organization(account_detail)
 
-    pipeline = [
-        {"$match": {"id": account_id}},
-        {
-            "$lookup": {
-                "from": "Organization",
-                "localField": "orgId",
-                "foreignField": "id",
-                "as": "organization"
-            }
-        },
-        {
-            "$lookup": {
-                "from": "Transaction",
-                "localField": "id",
-                "foreignField": "accountId",
-                "as": "transactions"
-            }
-        },
-        {
-            "$unwind": "$organization"
-        },
-        {
-            "$project": {
-                "_id": 0,
-                "transactions": {
-                    "_id": 0,
-                }
-            }
-        },
-        {
-            "$unset": ["organization._id"]
-        }
-    ]
-    updated_account = DataAggregation("AccountInfo", pipeline)[0]
-
-    return updated_account
+    updated_account = FindOneAndUpdate(
+        "AccountInfo",
+        {"id": account_id},
+        {"$set": {**update_info.dict(), **UpdatedAt().dict()}},
+        projection={"_id": 0},
+    )
+    invalidate_cache("account", "organization", org_id=account.orgId)
+    if update_info.orgId != account.orgId:
+        invalidate_cache("account", "organization", org_id=update_info.orgId)
+    # The transactions were read with the account and are not touched by the update
+    return with_organization({**updated_account, "transactions": account_detail["transactions"]})
 
 
 @router.delete("/account/{account_id}", tags=["accounts"], dependencies=[Depends(JWTRequired), Depends(OrgAdminAccess)])
@@ -264,14 +197,6 @@ async def delete_account_by_id(account_id: str):
 
     pipeline = [
         {"$match": {"id": account_id}},
-        {
-            "$lookup": {
-                "from": "Organization",
-                "localField": "orgId",
-                "foreignField": "id",
-                "as": "organization"
-            }
-        },
         {
             "$lookup": {
                 "from": "Transaction",
@@ -280,9 +205,6 @@ async def delete_account_by_id(account_id: str):
                 "as": "transactions"
             }
         },
-        {
-            "$unwind": "$organization"
-        },
         {
             "$project": {
                 "_id": 0,
@@ -290,9 +212,6 @@ async def delete_account_by_id(account_id: str):
                     "_id": 0,
                 }
             }
-        },
-        {
-            "$unset": ["organization._id"]
         }
     ]
     account = DataAggregation("AccountInfo", pipeline)
@@ -302,4 +221,5 @@ async def delete_account_by_id(account_id: str):
             detail=f"Invalid AccountInfo ID", status_code=HTTP_400_BAD_REQUEST
         )
     DeleteData("AccountInfo", {"id": account_id})
+    invalidate_cache("account", "organization", org_id=account[0]["orgId"])
     return {"status": "acknowledged"}
@@ -0,0 +1,169 @@
+from datetime import datetime
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Query, Request
+from starlette.concurrency import run_in_threadpool
+from starlette.exceptions import HTTPException
+from starlette.status import HTTP_404_NOT_FOUND
+
+from src.config.database import DataAggregation, MultiDataReader
+from src.utils.analytics import aging_report
+from src.utils.cache import cached_response
+from src.utils.metrics import metrics_dashboard
+from src.utils.permissions import validate_jwt_token, JWTRequired, OrgAdminAccess
+from src.utils.reporting import revenue_report, utilization_report
+
+router = APIRouter()
+
+
+@router.get("/analytics/balances", tags=["analytics"], dependencies=[Depends(JWTRequired), Depends(OrgAdminAccess)])
+async def get_balances(requestor=Depends(validate_jwt_token)):
+    accounts = list(
+        MultiDataReader("LedgerAccount", {"orgId": requestor.orgId}, {"_id": 0}).sort("accountNumber", 1)
+    )
+    totals = {}
+    for account in accounts:
+        total = totals.setdefault(account["currency"], {
+            "currency": account["currency"],
+            "currencySymbol": account["currencySymbol"],
+            "balance": 0,
+            "debitTotal": 0,
+            "creditTotal": 0,
+        })
+        total["balance"] += account["balance"]
+        total["debitTotal"] += account["debitTotal"]
+        total["creditTotal"] += account["creditTotal"]
+    return {"accounts": accounts, "organization": list(totals.values())}
+
+
+@router.get("/analytics/cashflow", tags=["analytics"], dependencies=[Depends(JWTRequired), Depends(OrgAdminAccess)])
+async def get_cash_flow(
+        start_period: Optional[str] = Query(None, description="First month, YYYY-MM"),
+        end_period: Optional[str] = Query(None, description="Last month, YYYY-MM"),
+        group_by: str = Query("currency", regex="^(currency|client)$", description="currency or client"),
+        requestor=Depends(validate_jwt_token)
+):
+    match = {"orgId": requestor.orgId}
+    if start_period or end_period:
+        match["period"] = {}
+        if start_period:
+            match["period"]["$gte"] = start_period
+        if end_period:
+            match["period"]["$lte"] = end_period
+
+    key = "$currencyId" if group_by == "currency" else "$clientId"
+    pipeline = [
+        {"$match": match},
+        {
+            "$group": {
+                "_id": {"period": "$period", "key": key},
+                "currency": {"$first": "$currency"},
+                "currencySymbol": {"$first": "$currencySymbol"},
+                "inflow": {"$sum": "$inflow"},
+                "outflow": {"$sum": "$outflow"},
+                "convertedInflow": {"$sum": "$convertedInflow"},
+                "convertedOutflow": {"$sum": "$convertedOutflow"},
+                "entries": {"$sum": "$entries"},
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "period": "$_id.period",
+                f"{group_by}Id": "$_id.key",
+                "inflow": 1,
+                "outflow": 1,
+                "net": {"$subtract": ["$inflow", "$outflow"]},
+                "convertedInflow": 1,
+                "convertedOutflow": 1,
+                "convertedNet": {"$subtract": ["$convertedInflow", "$convertedOutflow"]},
+                "entries": 1,
+            }
+        },
+    ]
+    if group_by == "currency":
+        # Amounts of different clients share the currency, keep its symbol
+        pipeline[2]["$project"]["currency"] = 1
+        pipeline[2]["$project"]["currencySymbol"] = 1
+    else:
+        # Original amounts of one client may mix currencies, only converted totals add up
+        for field in ("inflow", "outflow", "net"):
+            del pipeline[2]["$project"][field]
+        pipeline += [
+            {
+                "$lookup": {
+                    "from": "Client",
+                    "localField": "clientId",
+                    "foreignField": "id",
+                    "as": "client"
+                }
+            },
+            {"$unwind": {"path": "$client", "preserveNullAndEmptyArrays": True}},
+            {"$unset": ["client._id"]},
+        ]
+    pipeline.append({"$sort": {"period": 1, f"{group_by}Id": 1}})
+    return DataAggregation("CashFlowMonthly", pipeline)
+
+
+def snapshot_report(report):
+    if report is None:
+        raise HTTPException(
+            detail="No analytics snapshot for the organization yet",
+            status_code=HTTP_404_NOT_FOUND,
+        )
+    return report
+
+
+@router.get("/analytics/report/revenue", tags=["analytics"],
+            dependencies=[Depends(JWTRequired), Depends(OrgAdminAccess)])
+async def get_revenue_report(
+        start_period: Optional[str] = Query(None, description="First month, YYYY-MM"),
+        end_period: Optional[str] = Query(None, description="Last month, YYYY-MM"),
+        by_client: bool = Query(False, description="Split the invoice totals by client"),
+        requestor=Depends(validate_jwt_token)
+):
+    return snapshot_report(
+        await run_in_threadpool(revenue_report, requestor.orgId, start_period, end_period, by_client)
+    )
+
+
+@router.get("/analytics/report/utilization", tags=["analytics"],
+            dependencies=[Depends(JWTRequired), Depends(OrgAdminAccess)])
+async def get_utilization_report(
+        start_period: Optional[str] = Query(None, description="First month, YYYY-MM"),
+        end_period: Optional[str] = Query(None, description="Last month, YYYY-MM"),
+        group_by: str = Query("user", regex="^(user|client|workOrder)$", description="user, client or workOrder"),
+        requestor=Depends(validate_jwt_token)
+):
+    return snapshot_report(
+        await run_in_threadpool(utilization_report, requestor.orgId, start_period, end_period, group_by)
+    )
+
+
+@router.get("/analytics/dashboard", tags=["analytics"],
+            dependencies=[Depends(JWTRequired), Depends(OrgAdminAccess)])
+async def get_dashboard(
+        request: Request,
+        start_period: Optional[str] = Query(None, description="First month, YYYY-MM"),
+        end_period: Optional[str] = Query(None, description="Last month, YYYY-MM"),
+        group_by: str = Query(
+            "period", regex="^(organization|period|client|workOrder)$",
+            description="organization, period, client or workOrder"
+        ),
+        requestor=Depends(validate_jwt_token)
+):
+    return await cached_response(
+        request,
+        "metrics",
+        requestor,
+        lambda: metrics_dashboard(requestor.orgId, start_period, end_period, group_by),
+    )
+
+
+@router.get("/analytics/aging", tags=["analytics"], dependencies=[Depends(JWTRequired), Depends(OrgAdminAccess)])
+async def get_receivables_aging(
+        as_of: Optional[datetime] = Query(None, description="Count the days past due up to this date, now by default"),
+        convert: bool = Query(False, description="Also total in the organization default currency"),
+        requestor=Depends(validate_jwt_token)
+):
+    return await run_in_threadpool(aging_report, requestor.orgId, as_of, convert)
@@ -1,5 +1,5 @@
 import json
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Request
 
 from pydantic import BaseModel
 from typing import List, Optional
@@ -11,7 +11,10 @@ from src.models.api_schemas import UpdatedAt
 from src.models.models import Client
 
 # from src.prisma import prisma
+from src.utils.batching import gather_queries
+from src.utils.cache import cached_response, invalidate_cache
 from src.utils.permissions import validate_jwt_token, TokenRequired, OrgStaffAccess, OrgAdminAccess
+from src.utils.reference_data import reference_data, with_organization
 
 router = APIRouter()
 
@@ -54,18 +57,10 @@ class UpdateClient(BaseModel):
 
 
 @router.get("/client", tags=["clients"], dependencies=[Depends(TokenRequired), Depends(OrgStaffAccess)])
-async def read_clients(requestor=Depends(validate_jwt_token)):
+async def read_clients(request: Request, requestor=Depends(validate_jwt_token)):
     
     pipeline = [
             {"$match": {"orgId": requestor.orgId}},
-            {
-                "$lookup": {
-                    "from": "Organization",
-                    "localField": "orgId",
-                    "foreignField": "id",
-                    "as": "organization"
-                }
-            },
             {
                 "$lookup": {
                     "from": "WorkOrder",
@@ -74,9 +69,6 @@ async def read_clients(requestor=Depends(validate_jwt_token)):
                     "as": "workOrders"
                 }
             },
-            {
-                "$unwind": "$organization"
-            },
             {
                 "$project": {
                     "_id": 0,
@@ -85,67 +77,38 @@ async def read_clients(requestor=Depends(validate_jwt_token)):
                     }
                 }
             },
-            {
-                "$unset": ["organization._id"]
-            },
             {"$sort": {"createdAt": -1}}
         ]
-    return DataAggregation("Client", pipeline)
+    return await cached_response(
+        request,
+        "client",
+        requestor,
+        lambda: [with_organization(client) for client in DataAggregation("Client", pipeline)],
+    )
 
 
 @router.post("/client", tags=["clients"], dependencies=[Depends(TokenRequired), Depends(OrgAdminAccess)])
 async def create_client(client: CreateClient, requestor=Depends(validate_jwt_token)):
-    existing_client = SingleDataReader("Client", {"abr": client.abr})
-    if existing_client:
+    found = await gather_queries(
+        existing_client=lambda: SingleDataReader("Client", {"abr": client.abr}),
+        organization=lambda: reference_data.organization(client.orgId),
+    )
+    if found["existing_client"]:
         raise HTTPException(
             detail=f"Client with abbreviation {client.abr} already exists",
             status_code=HTTP_400_BAD_REQUEST,
         )
 
-    organization = SingleDataReader("Organization", {"id": client.orgId})
-    if not organization:
+    if not found["organization"]:
         raise HTTPException(
             detail="Invalid organization id",
             status_code=HTTP_400_BAD_REQUEST,
         )
     client_data = Client(**client.dict())
-    created_client = DataWriter("Client", {**(client_data.dict())})
-    
-    pipeline = [
-            {"$match": {"id": client_data.id}},
-            {
-                "$lookup": {
-                    "from": "Organization",
-                    "localField": "orgId",
-                    "foreignField": "id",
-                    "as": "organization"
-                }
-            },
-            {
-                "$lookup": {
-                    "from": "WorkOrder",
-                    "localField": "id",
-                    "foreignField": "clientId",
-                    "as": "workOrders"
-                }
-            },
-            {
-                "$unwind": "$organization"
-            },
-            {
-                "$project": {
-                    "_id": 0,
-                    "workOrders": {
-                        "_id": 0,
-                    }
-                }
-            },
-            {
-                "$unset": ["organization._id"]
-            }
-        ]
-    created_client = DataAggregation("Client", pipeline)
-    return created_client
+    DataWriter("Client", client_data.dict())
+    invalidate_cache("client", "organization", org_id=client_data.orgId)
+    # A new client has no work orders yet, nothing to read back
+    return [with_organization({**client_data.dict(), "workOrders": []})]
 
 
 @router.get("/client/{client_id}", tags=["clients"], dependencies=[Depends(TokenRequired), Depends(OrgStaffAccess)])
@@ -153,14 +116,6 @@ async def read_client(client_id: str, requestor=Depends(validate_jwt_token)):
     
     pipeline = [
             {"$match": {"id": client_id}},
-            {
-                "$lookup": {
-                    "from": "Organization",
-                    "localField": "orgId",
-                    "foreignField": "id",
-                    "as": "organization"
-                }
-            },
             {
                 "$lookup": {
                     "from": "WorkOrder",
@@ -169,9 +124,6 @@ async def read_client(client_id: str, requestor=Depends(validate_jwt_token)):
                     "as": "workOrders"
                 }
             },
-            {
-                "$unwind": "$organization"
-            },
             {
                 "$project": {
                     "_id": 0,
@@ -179,9 +131,6 @@ async def read_client(client_id: str, requestor=Depends(validate_jwt_token)):
                         "_id": 0,
                     }
                 }
-            },
-            {
-                "$unset": ["organization._id"]
             }
         ]
     client = DataAggregation("Client", pipeline)
@@ -190,7 +139,7 @@ async def read_client(client_id: str, requestor=Depends(validate_jwt_token)):
             detail="Invalid client id",
             status_code=HTTP_400_BAD_REQUEST,
         )
-    return client[0]
+    return with_organization(client[0])
 
 
 @router.post("/client/{client_id}", tags=["clients"], dependencies=[Depends(TokenRequired), Depends(OrgAdminAccess)])
@@ -284,20 +233,15 @@ async def update_organizations(
     if json.dumps(prev_data) != json.dumps(update_info.dict()):
         # await prisma.client.update(where={"id": client.id}, data=update_info.dict())
         UpdateWriter("Client", {"id": client.id}, {**update_info.dict(), **UpdatedAt().dict()})
+        invalidate_cache("client", "organization", org_id=client.orgId)
+        if update_info.orgId != client.orgId:
+            invalidate_cache("client", "organization", org_id=update_info.orgId)
 
     # updated_client = await prisma.client.find_unique(
     #     where={"id": client_id}, include={"organization": True, "workOrders": True}
     # )
     pipeline = [
             {"$match": {"id": client_id}},
-            {
-                "$lookup": {
-                    "from": "Organization",
-                    "localField": "orgId",
-                    "foreignField": "id",
-                    "as": "organization"
-                }
-            },
             {
                 "$lookup": {
                     "from": "WorkOrder",
@@ -306,9 +250,6 @@ async def update_organizations(
                     "as": "workOrders"
                 }
             },
-            {
-                "$unwind": "$organization"
-            },
             {
                 "$project": {
                     "_id": 0,
@@ -316,12 +257,9 @@ async def update_organizations(
                         "_id": 0,
                     }
                 }
-            },
-            {
-                "$unset": ["organization._id"]
             }
         ]
-    updated_client = DataAggregation("Client", pipeline)
+    updated_client = [with_organization(client) for client in DataAggregation("Client", pipeline)]
     return updated_client
 
 
@@ -334,4 +272,5 @@ async def delete_client(client_id: str, requestor=Depends(validate_jwt_token)):
             status_code=HTTP_400_BAD_REQUEST,
         )
     DeleteData("Client", {"id": client_id})
+    invalidate_cache("client", "organization", org_id=client["orgId"])
     return {"status": "acknowledged"}
@@ -1,18 +1,26 @@
 import json
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Query, Request
 
 from pydantic import BaseModel
 from typing import List, Optional
 
 from starlette.exceptions import HTTPException
 from starlette.status import HTTP_400_BAD_REQUEST
-from src.config.database import DataAggregation, DataWriter, DeleteData, SingleDataReader, UpdateWriter
+from src.config.database import (
+    DataAggregation,
+    DataWriter,
+    DeleteData,
+    FindOneAndUpdate,
+    SingleDataReader,
+)
 from src.models.api_schemas import UpdatedAt
 from src.models.models import CurrencyDb
 
 # from src.prisma import prisma
 from src.utils.permissions import validate_jwt_token, SuperAdminAccess
 from src.utils.permissions import JWTRequired, OrgStaffAccess
+from src.utils.cache import cached_response, invalidate_cache
+from src.utils.reference_data import reference_data
 
 router = APIRouter()
 
@@ -29,52 +37,70 @@ class UpdateCurrency(BaseModel):
     symbol: Optional[str]
 
 
-@router.get("/currency", tags=["currency"], dependencies=[Depends(JWTRequired), Depends(OrgStaffAccess)])
-async def get_all_currencies(user=Depends(validate_jwt_token)):
-    pipeline = [
-        {
-            '$lookup': {
-                'from': 'WorkOrder',
-                'localField': 'id',
-                'foreignField': 'currencyId',
-                'as': 'workOrders'
-            }
-        },
-        {
-            '$lookup': {
-                'from': 'Payment',
-                'localField': 'id',
-                'foreignField': 'currencyId',
-                'as': 'payments'
-            }
-        },
-        {
-            '$lookup': {
-                'from': 'Expense',
-                'localField': 'id',
-                'foreignField': 'currencyId',
-                'as': 'expenses'
+# Collections referencing a currency, by the field holding the currency id
+CURRENCY_USAGE = {
+    "workOrders": ("WorkOrder", "currencyId"),
+    "payments": ("Payment", "currencyId"),
+    "expenses": ("Expense", "currencyId"),
+    "defaultCurrencyOrganization": ("Organization", "defaultCurrencyId"),
+}
+
+
+def currency_pipeline(match: dict = None, expand: bool = False) -> list:
+    """Currencies with the number of documents using each of them
+
+    Only counts travel back unless expand is set, then the referencing
+    documents are embedded as well.
+    """
+    pipeline = [{"$match": match}] if match else []
+    for name, (collection_name, field) in CURRENCY_USAGE.items():
+        pipeline.append({
+            "$lookup": {
+                "from": collection_name,
+                "let": {"currencyId": "$id"},
+                "pipeline": [
+                    {"$match": {"$expr": {"$eq": [f"${field}", "$$currencyId"]}}},
+                    {"$count": "count"},
+                ],
+                "as": f"{name}Count"
             }
-        },
-        {
-            '$lookup': {
-                'from': 'Organization',
-                'localField': 'id',
-                'foreignField': 'defaultCurrencyId',
-                'as': 'defaultCurrencyOrganization'
+        })
+        if expand:
+            pipeline.append({
+                "$lookup": {
+                    "from": collection_name,
+                    "localField": "id",
+                    "foreignField": field,
+                    "as": name
+                }
+            })
+    pipeline += [
+        {
+            "$set": {
+                "usage": {
+                    name: {"$ifNull": [{"$arrayElemAt": [f"${name}Count.count", 0]}, 0]}
+                    for name in CURRENCY_USAGE
+                }
             }
         },
         {
-            "$project": {
-                "_id": 0
-            }
+            "$project": {"_id": 0, **{f"{name}Count": 0 for name in CURRENCY_USAGE}}
         },
-        {
-            "$unset": ["defaultCurrencyOrganization._id", "expenses._id", "payments._id", "workOrders._id"]
-        }
     ]
+    if expand:
+        pipeline.append({"$unset": [f"{name}._id" for name in CURRENCY_USAGE]})
+    return pipeline
+
 
-    return DataAggregation("Currency", pipeline)
+@router.get("/currency", tags=["currency"], dependencies=[Depends(JWTRequired), Depends(OrgStaffAccess)])
+async def get_all_currencies(
+        request: Request,
+        expand: bool = Query(False, description="Embed the referencing documents, not only their counts"),
+        user=Depends(validate_jwt_token)
+):
+    return await cached_response(
+        request, "currency", user, lambda: DataAggregation("Currency", currency_pipeline(expand=expand))
+    )
 
 
 @router.post("/currency", tags=["currency"], dependencies=[Depends(JWTRequired), Depends(SuperAdminAccess)])
@@ -89,57 +115,18 @@ async def create_currency(currency: Currency, user=Depends(validate_jwt_token)):
 
     created_currency = CurrencyDb(**currency.dict())
     DataWriter("Currency", created_currency.dict())
+    reference_data.invalidate()
+    invalidate_cache("currency")
     return created_currency
 
 
 @router.get("/currency/{currency_id}", tags=["currency"], dependencies=[Depends(JWTRequired), Depends(OrgStaffAccess)])
-async def get_currency_by_id(currency_id: str, user=Depends(validate_jwt_token)):
-
-    pipeline = [
-        {"$match": {"id": currency_id}},
-        {
-            '$lookup': {
-                'from': 'WorkOrder',
-                'localField': 'id',
-                'foreignField': 'currencyId',
-                'as': 'workOrders'
-            }
-        },
-        {
-            '$lookup': {
-                'from': 'Payment',
-                'localField': 'id',
-                'foreignField': 'currencyId',
-                'as': 'payments'
-            }
-        },
-        {
-            '$lookup': {
-                'from': 'Expense',
-                'localField': 'id',
-                'foreignField': 'currencyId',
-                'as': 'expenses'
-            }
-        },
-        {
-            '$lookup': {
-                'from': 'Organization',
-                'localField': 'id',
-                'foreignField': 'defaultCurrencyId',
-                'as': 'defaultCurrencyOrganization'
-            }
-        },
-        {
-            "$project": {
-                "_id": 0
-            }
-        },
-        {
-            "$unset": ["defaultCurrencyOrganization._id", "expenses._id", "payments._id", "workOrders._id"]
-        }
-    ]
-
-    currency = DataAggregation("Currency", pipeline)
+async def get_currency_by_id(
+        currency_id: str,
+        expand: bool = Query(False, description="Embed the referencing documents, not only their counts"),
+        user=Depends(validate_jwt_token)
+):
+    currency = DataAggregation("Currency", currency_pipeline({"id": currency_id}, expand))
 
     if not currency:
         raise HTTPException(
@@ -152,12 +139,13 @@ async def get_currency_by_id(currency_id: str, user=Depends(validate_jwt_token))
 async def update_currency_by_id(
         currency_id: str, update_info: UpdateCurrency, user=Depends(validate_jwt_token)
 ):
-    currency = SingleDataReader("Currency", {"id": currency_id})
-    currency = Currency(**currency)
-    if not currency:
+    current = DataAggregation("Currency", currency_pipeline({"id": currency_id}))
+    if not current:
         raise HTTPException(
             detail=f"Invalid Currency ID", status_code=HTTP_400_BAD_REQUEST
         )
+    current = current[0]
+    currency = Currency(**current)
 
     update_info.name = update_info.name if update_info.name else currency.name
     update_info.symbol = update_info.symbol if update_info.symbol else currency.symbol
@@ -182,57 +170,19 @@ async def update_currency_by_id(
         "symbol": currency.symbol,
     }
 
-    if json.dumps(prev_data) != json.dumps(update_info.dict()):
-        UpdateWriter("Currency", {"id": currency_id}, {**update_info.dict(), **UpdatedAt().dict()})
-
-    # Pipeline
-    pipeline = [
-        {"$match": {"id": currency_id}},
-        {
-            '$lookup': {
-                'from': 'WorkOrder',
-                'localField': 'id',
-                'foreignField': 'currencyId',
-                'as': 'workOrders'
-            }
-        },
-        {
-            '$lookup': {
-                'from': 'Payment',
-                'localField': 'id',
-                'foreignField': 'currencyId',
-                'as': 'payments'
-            }
-        },
-        {
-            '$lookup': {
-                'from': 'Expense',
-                'localField': 'id',
-                'foreignField': 'currencyId',
-                'as': 'expenses'
-            }
-        },
-        {
-            '$lookup': {
-                'from': 'Organization',
-                'localField': 'id',
-                'foreignField': 'defaultCurrencyId',
-                'as': 'defaultCurrencyOrganization'
-            }
-        },
-        {
-            "$project": {
-                "_id": 0
-            }
-        },
-        {
-            "$unset": ["defaultCurrencyOrganization._id", "expenses._id", "payments._id", "workOrders._id"]
-        }
-    ]
-
-    updated_currency = DataAggregation("Currency", pipeline)
+    if json.dumps(prev_data) == json.dumps(update_info.dict()):
+        return current
 
-    return updated_currency[0]
+    updated_currency = FindOneAndUpdate(
+        "Currency",
+        {"id": currency_id},
+        {"$set": {**update_info.dict(), **UpdatedAt().dict()}},
+        projection={"_id": 0},
+    )
+    reference_data.invalidate()
+    invalidate_cache("currency", "organization", "workOrder")
+    # Renaming a currency leaves the documents using it alone
+    return {**updated_currency, "usage": current["usage"]}
 
 
 @router.delete("/currency/{currency_id}", tags=["currency"],
@@ -244,4 +194,6 @@ async def delete_currency_by_id(currency_id: str, user=Depends(validate_jwt_toke
             detail=f"Invalid currency ID", status_code=HTTP_400_BAD_REQUEST
         )
     DeleteData("Currency", {"id": currency_id})
+    reference_data.invalidate()
+    invalidate_cache("currency", "organization", "workOrder")
     return {"status": "acknowledged"}
@@ -1,5 +1,5 @@
+import asyncio
 from functools import reduce
-import pandas as pd
 import io
 import os
 from datetime import datetime, timedelta
@@ -8,6 +8,7 @@ from fastapi import APIRouter, Depends, Query, Response, File, Form, UploadFile
 from pydantic import BaseModel
 from typing import List, Optional
 
+from starlette.concurrency import run_in_threadpool
 from starlette.exceptions import HTTPException
 from starlette.status import HTTP_400_BAD_REQUEST, HTTP_404_NOT_FOUND
 from src.config.database import CountDocuments, DataAggregation, DataWriter, DeleteData, SingleDataReader, UpdateWriter
@@ -19,9 +20,21 @@ from src.config.settings import GST_PCT, TEMPLATE_ENV
 from src.models.scalar import WorkOrderType
 from src.utils.permissions import validate_jwt_token
 from src.utils.convertors import get_base64_string
-from src.utils.communication import send_invoice
+from src.utils.auth import get_utc_timestamp
+from src.utils.batching import load
+from src.utils.cache import invalidate_cache
+from src.utils.communication import send_invoice, send_invoices
+from src.utils.ledger import record_ledger_transaction
+from src.utils.metrics import (
+    apply_invoice_metrics,
+    apply_metrics,
+    apply_time_charge_metrics,
+    metrics_period,
+    remove_invoice_metrics,
+)
 from src.utils.pdf_generation import generate_invoice_pdf
-from src.utils.storage import write_to_blob, read_blob, delete_blob
+from src.utils.storage import write_to_blob, read_blob, delete_blob, cache_blob
+from src.utils.timesheet import refresh_timesheet_daily
 
 router = APIRouter()
 
@@ -56,6 +69,14 @@ class ShareInvoice(BaseModel):
     cc_list: List[str]
 
 
+class BulkShareInvoice(BaseModel):
+    invoice_ids: Optional[List[str]]
+    start_date: Optional[datetime]
+    end_date: Optional[datetime]
+    to_list: List[str] = []
+    cc_list: List[str] = []
+
+
 class WorkOrderSetup(WorkOrder):
     client: Client
 
@@ -75,6 +96,82 @@ class InvoiceAPI(Invoice, WorkOrderWithCurrency):
     workOrder: WorkOrderWithCurrency
 
 
+def invoice_share_pipeline(match: dict, org_id: str) -> list:
+    return [
+        {
+            "$match": match
+        },
+        {
+            "$lookup": {
+                "from": "WorkOrder",
+                "localField": "workOrderId",
+                "foreignField": "id",
+                "as": "workOrder"
+            }
+        },
+        {
+            "$unwind": "$workOrder"
+        },
+        {
+            "$lookup": {
+                "from": "Client",
+                "localField": "workOrder.clientId",
+                "foreignField": "id",
+                "as": "workOrder.client"
+            }
+        },
+        {
+            "$unwind": "$workOrder.client"
+        },
+        {
+            "$match": {
+                "workOrder.client.orgId": org_id
+            }
+        },
+        {
+            "$lookup": {
+                "from": "Organization",
+                "localField": "workOrder.client.orgId",
+                "foreignField": "id",
+                "as": "workOrder.client.organization"
+            }
+        },
+        {
+            "$unwind": "$workOrder.client.organization"
+        },
+        {
+            "$lookup": {
+                "from": "Currency",
+                "localField": "currencyId",
+                "foreignField": "id",
+                "as": "currency"
+            }
+        },
+        {
+            "$unwind": {
+                "path": "$currency",
+                "preserveNullAndEmptyArrays": True
+            }
+        },
+        {
+            "$project": {
+                "_id": 0
+            }
+        },
+        {
+            "$unset": ["workOrder._id", "workOrder.client._id", "workOrder.client.organization._id", "currency._id"]
+        }
+    ]
+
+
+def invoice_share_status(invoice: dict) -> str:
+    if invoice.get("paidOn"):
+        return "PAID"
+    elif invoice.get("dueBy"):
+        return "DUE"
+    return "CANCELLED"
+
+
 @router.get("/invoice", tags=["invoice"])
 async def get_all_invoices(requestor=Depends(validate_jwt_token)):
     pipeline = [
@@ -438,6 +535,10 @@ async def delete_invoice(invoice_id: str, requestor=Depends(validate_jwt_token))
         )
 
     DeleteData("Invoice", {"id": invoice_id})
+    work_order = await load("WorkOrder", invoice["workOrderId"])
+    if work_order:
+        remove_invoice_metrics(requestor.orgId, work_order, invoice)
+    invalidate_cache("workOrder", "metrics", org_id=requestor.orgId)
     return {"status": "acknowledged"}
 
 
@@ -531,6 +632,8 @@ async def get_invoice_items(
             status_code=HTTP_400_BAD_REQUEST,
         )
     time_charged = [TimesheetDB(**row) for row in time_charged]
+    import pandas as pd
+
     charge_df = pd.DataFrame(
         list(
             map(
@@ -712,135 +815,31 @@ async def generate_invoice(
         "currencyId": work_order.currency.id,
     })
 
-    created_invoice = DataWriter("Invoice", created_invoice.dict())
-
-    DataWriter("InvoiceItem",
-               list(
-                   map(
-                       lambda item: InvoiceItem(**{
-                           "invoiceId": created_invoice.id,
-                           "description": item.description,
-                           "quantity": item.quantity,
-                           "rate": item.rate,
-                           "amount": item.amount,
-                       }).dict(),
-                       invoice.items,
-                   )
-               ),
-               True
-               )
-
-    pipeline = [
-        {
-            "$match": {
-                "id": created_invoice.id
-            }
-        },
-        {
-            "$lookup": {
-                "from": "InvoiceItem",
-                "localField": "id",
-                "foreignField": "invoiceId",
-                "as": "items"
-            }
-        },
-        {
-            "$lookup": {
-                "from": "Payment",
-                "localField": "id",
-                "foreignField": "invoiceId",
-                "as": "payments"
-            }
-        },
-        {
-            "$unwind": {
-                "path": "$payments",
-                "preserveNullAndEmptyArrays": True
-            }
-        },
-        {
-            "$lookup": {
-                "from": "WorkOrder",
-                "localField": "workOrderId",
-                "foreignField": "id",
-                "as": "workOrder"
-            }
-        },
-        {
-            "$unwind": {
-                "path": "$workOrder",
-                "preserveNullAndEmptyArrays": True
-            }
-        },
-        {
-            "$lookup": {
-                "from": "Client",
-                "localField": "workOrder.clientId",
-                "foreignField": "id",
-                "as": "workOrder.client"
-            }
-        },
-        {
-            "$unwind": {
-                "path": "$workOrder.client",
-                "preserveNullAndEmptyArrays": True
-            }
-        },
-        {
-            "$lookup": {
-                "from": "Organization",
-                "localField": "workOrder.client.orgId",
-                "foreignField": "id",
-                "as": "workOrder.client.organization"
-            }
-        },
-        {
-            "$unwind": {
-                "path": "$workOrder.client.organization",
-                "preserveNullAndEmptyArrays": True
-            }
-        },
-        {
-            "$lookup": {
-                "from": "Currency",
-                "localField": "workOrder.currencyId",
-                "foreignField": "id",
-                "as": "workOrder.currency"
-            }
-        },
-        {
-            "$unwind": {
-                "path": "$workOrder.currency",
-                "preserveNullAndEmptyArrays": True
-            }
-        },
-        {
-            "$lookup": {
-                "from": "Currency",
-                "localField": "currencyId",
-                "foreignField": "id",
-                "as": "currency"
-            }
-        },
-        {
-            "$unwind": {
-                "path": "$currency",
-                "preserveNullAndEmptyArrays": True
-            }
-        },
-        {
-            "$project": {
-                "_id": 0
-            }
-        },
-        {
-            "$unset": ["workOrder._id", "currency._id", "items._id", "workOrder.client._id",
-                       "workOrder.currency._id", "workOrder.client.organization._id", "payments._id"]
-        }
+    created_invoice.docUrl = f"invoices/{created_invoice.invoice_number}.pdf"
+    items = [
+        InvoiceItem(**{
+            "invoiceId": created_invoice.id,
+            "description": item.description,
+            "quantity": item.quantity,
+            "rate": item.rate,
+            "amount": item.amount,
+        }).dict()
+        for item in invoice.items
     ]
-
-    created_invoice = DataAggregation("Invoice", pipeline)
-    created_invoice = InvoiceAPI(**created_invoice[0])
+    DataWriter("Invoice", created_invoice.dict())
+    # insert_many adds _id to the documents it is given
+    DataWriter("InvoiceItem", [dict(item) for item in items], True)
+    apply_invoice_metrics(requestor.orgId, work_order.dict(), created_invoice.dict())
+    invalidate_cache("workOrder", "metrics", org_id=requestor.orgId)
+
+    # Everything the document shows is at hand, a new invoice has no payments yet
+    invoice_data = {
+        **created_invoice.dict(),
+        "items": items,
+        "payments": [],
+        "workOrder": work_order.dict(),
+        "currency": work_order.currency.dict(),
+    }
 
     pdf_options = {
         "page-size": "A4",
@@ -855,7 +854,7 @@ async def generate_invoice(
     }
 
     pdf = generate_invoice_pdf(
-        invoice_data=created_invoice.dict(),
+        invoice_data=invoice_data,
         pdf_options=pdf_options,
         template="templates/invoice.html",
     )
@@ -866,18 +865,10 @@ async def generate_invoice(
     if not pdf_url:
         # await prisma.invoice.delete(where={"id": created_invoice.id})
         DeleteData("Invoice", {"id": created_invoice.id})
+        apply_invoice_metrics(requestor.orgId, work_order.dict(), created_invoice.dict(), -1)
         raise HTTPException(
             detail="Error generating invoice", status_code=HTTP_400_BAD_REQUEST
         )
-    # await prisma.invoice.update(
-    #     where={"id": created_invoice.id},
-    #     data={"docUrl": f"invoices/{created_invoice.invoice_number}.pdf"},
-    # )
-    UpdateWriter(
-        "Invoice",
-        {"id": created_invoice.id},
-        {"docUrl": f"invoices/{created_invoice.invoice_number}.pdf"}
-    )
     if invoice.include_time_charges:
         # await prisma.timesheet.update_many(
         #     where={"id": {"in": list(map(lambda ts: ts.id, timesheets))}},
@@ -888,8 +879,11 @@ async def generate_invoice(
         # )
         UpdateWriter("Timesheet",
                      {"id": {"$in": list(map(lambda ts: ts.id, timesheets))}},
-                     {"$set": {"invoiced": True, "invoiceId": created_invoice.id}}
+                     {"invoiced": True, "invoiceId": created_invoice.id, "updatedAt": get_utc_timestamp()},
+                     True
                      )
+        refresh_timesheet_daily([ts.dict() for ts in timesheets])
+        apply_time_charge_metrics(requestor.orgId, work_order.dict(), [ts.dict() for ts in timesheets], charged=False)
     return Response(pdf, status_code=200, media_type="application/pdf")
 
 
@@ -1054,6 +1048,15 @@ async def cancel_invoice(invoice_id: str, requestor=Depends(validate_jwt_token))
     delete_blob(path=invoice.docUrl)
     write_to_blob(path=f"invoices/{invoice.invoice_number}.pdf", data=pdf)
     UpdateWriter("Invoice", {"id": invoice_id}, {"dueBy": None})
+    if invoice.dueBy and not invoice.paidOn:
+        apply_metrics(
+            requestor.orgId,
+            invoice.workOrder.dict(),
+            metrics_period(invoice.generatedOn),
+            invoice.currencyId,
+            cancelled=invoice.amount + (invoice.tax or 0),
+        )
+    invalidate_cache("workOrder", "metrics", org_id=requestor.orgId)
     return Response(
         pdf,
         media_type="application/octet-stream",
@@ -1181,7 +1184,7 @@ async def pay_invoice(
     if not invoice:
         raise HTTPException(detail="Invalid Invoice", status_code=HTTP_400_BAD_REQUEST)
 
-    invoice = InvoiceAPI(**invoice)
+    invoice = InvoiceAPI(**invoice[0])
     if invoice.paidOn:
         raise HTTPException(
             detail="Invoice already paid", status_code=HTTP_400_BAD_REQUEST
@@ -1193,6 +1196,10 @@ async def pay_invoice(
             status_code=HTTP_400_BAD_REQUEST,
         )
 
+    account = SingleDataReader("AccountInfo", {"id": account_id})
+    if not account:
+        raise HTTPException(detail="Invalid Account", status_code=HTTP_400_BAD_REQUEST)
+
     content = io.BytesIO(document.file.read())
     extension = os.path.splitext(document.filename)[1]
 
@@ -1203,29 +1210,32 @@ async def pay_invoice(
             "exchangeRate": exchange_rate,
             "invoiceId": invoice.id,
         })
-    DataWriter("Payment", payment.dict())
-    pdf_url = write_to_blob(
+    # Ids are generated here, so the document is uploaded before anything is written
+    payment.docUrl = write_to_blob(
         path=f"invoices/{TransactionType.payment.value}/{payment.id}{extension}",
         data=content,
     )
-    payment = UpdateWriter(
-        "Payment",
-        {"id": payment.id},
-        {"docUrl": pdf_url}
-    )
-    account = SingleDataReader("AccountInfo", {"id": account_id})
+    transaction = Transaction(**{
+        "debit": 0,
+        "credit": payment.amount * payment.exchangeRate,
+        "paymentId": payment.id,
+        "accountId": account["id"],
+    })
 
-    DataWriter(
-        "Transaction",
-        Transaction(**{
-            "debit": 0,
-            "credit": payment.amount * payment.exchangeRate,
-            "paymentId": payment.id if payment else None,
-            "accountId": account.id,
-        })
-    )
+    def mark_paid(session):
+        UpdateWriter("Invoice", {"id": invoice_id}, {"paidOn": datetime.now()}, session=session)
+        apply_metrics(
+            requestor.orgId,
+            invoice.workOrder.dict(),
+            metrics_period(payment.createdAt),
+            payment.currencyId,
+            session=session,
+            payments=1,
+            paid=payment.amount,
+        )
 
-    UpdateWriter("Invoice", {"id": invoice_id}, {"paidOn": datetime.now()})
+    record_ledger_transaction("Payment", payment, transaction, invoice.workOrder.client.id, also=mark_paid)
+    invalidate_cache("workOrder", "metrics", org_id=requestor.orgId)
 
     pipeline = [
         {
@@ -1336,7 +1346,7 @@ async def pay_invoice(
         }
     ]
     invoice = DataAggregation("Invoice", pipeline)
-    invoice = InvoiceAPI(**invoice)
+    invoice = InvoiceAPI(**invoice[0])
 
     pdf_options = {
         "page-size": "A4",
@@ -1364,6 +1374,89 @@ async def pay_invoice(
     )
 
 
+@router.post("/invoice/bulk/share", tags=["invoice"])
+async def bulk_share_invoices(
+        details: BulkShareInvoice,
+        requestor=Depends(validate_jwt_token)
+):
+    if details.invoice_ids:
+        match = {"id": {"$in": details.invoice_ids}}
+    elif details.start_date and details.end_date:
+        match = {"generatedOn": {"$gte": details.start_date, "$lte": details.end_date}}
+    else:
+        raise HTTPException(
+            detail="Provide the invoice ids or a period to share",
+            status_code=HTTP_400_BAD_REQUEST,
+        )
+
+    invoices = DataAggregation("Invoice", invoice_share_pipeline(match, requestor.orgId))
+
+    results = {}
+    found = {invoice["id"] for invoice in invoices}
+    for invoice_id in details.invoice_ids or []:
+        if invoice_id not in found:
+            results[invoice_id] = {"id": invoice_id, "status": "failed", "detail": "Invalid Invoice"}
+
+    shareable = []
+    for invoice in invoices:
+        if not invoice.get("docUrl"):
+            results[invoice["id"]] = {
+                "id": invoice["id"],
+                "invoice_number": invoice["invoice_number"],
+                "status": "failed",
+                "detail": "Invoice document not found",
+            }
+        else:
+            shareable.append(invoice)
+
+    documents = await asyncio.gather(
+        *[run_in_threadpool(cache_blob, path=invoice["docUrl"]) for invoice in shareable]
+    )
+
+    # One mail per set of recipients, carrying every invoice addressed to it
+    groups = {}
+    for invoice, document in zip(shareable, documents):
+        if document is None:
+            results[invoice["id"]] = {
+                "id": invoice["id"],
+                "invoice_number": invoice["invoice_number"],
+                "status": "failed",
+                "detail": "Invoice document could not be read",
+            }
+            continue
+        to_list = tuple(sorted(set(details.to_list + [invoice["workOrder"]["client"]["contact_email"]])))
+        cc_list = tuple(sorted(set(details.cc_list + [requestor.email])))
+        invoice["status"] = invoice_share_status(invoice)
+        invoice["total"] = invoice["amount"] + (invoice.get("tax") or 0)
+        groups.setdefault((to_list, cc_list), []).append((invoice, document))
+
+    for (to_list, cc_list), group in groups.items():
+        client = group[0][0]["workOrder"]["client"]
+        queued = await send_invoices(
+            to_list=list(to_list),
+            cc_list=list(cc_list),
+            reports=[
+                (f"{invoice['invoice_number'].replace('/', '-')}.pdf", document, invoice["docUrl"])
+                for invoice, document in group
+            ],
+            template_data={
+                "contact_name": client["contact_name"],
+                "org_name": client["organization"]["name"],
+                "invoices": [invoice for invoice, _ in group],
+                "requestor": requestor.dict(),
+            },
+        )
+        for invoice, _ in group:
+            results[invoice["id"]] = {
+                "id": invoice["id"],
+                "invoice_number": invoice["invoice_number"],
+                "status": "queued" if queued else "failed",
+                "recipients": list(to_list),
+            }
+
+    return {"results": list(results.values())}
+
+
 @router.post("/invoice/share/{invoice_id}", tags=["invoice"])
 async def share_invoice(
         invoice_id: str,
@@ -1483,12 +1576,16 @@ async def share_invoice(
     if not invoice:
         raise HTTPException(detail="Invalid Invoice", status_code=HTTP_400_BAD_REQUEST)
 
-    invoice = InvoiceAPI(**invoice)
+    invoice = InvoiceAPI(**invoice[0])
     if not invoice.docUrl:
         raise HTTPException(
             detail="Invoice document not found", status_code=HTTP_404_NOT_FOUND
         )
-    pdf = read_blob(path=invoice.docUrl)
+    pdf_path = await run_in_threadpool(cache_blob, path=invoice.docUrl)
+    if pdf_path is None:
+        raise HTTPException(
+            detail="Invoice document could not be read", status_code=HTTP_400_BAD_REQUEST
+        )
     invoice_data = invoice.dict()
     invoice_status = "CANCELLED"
     if invoice.paidOn:
@@ -1508,7 +1605,8 @@ async def share_invoice(
     mail_response = await send_invoice(
         to_list=emails.to_list,
         cc_list=emails.cc_list,
-        report=pdf,
+        report_path=pdf_path,
+        blob_path=invoice.docUrl,
         template_data=invoice_data,
     )
 
@@ -1,17 +1,27 @@
 import json
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Query, Request
 
 from pydantic import BaseModel
 from typing import List, Optional
 
 from starlette.exceptions import HTTPException
 from starlette.status import HTTP_400_BAD_REQUEST
-from src.config.database import DataAggregation, DataWriter, DeleteData, SingleDataReader, UpdateWriter
+from src.config.database import (
+    DataAggregation,
+    DataWriter,
+    DeleteData,
+    FindOneAndUpdate,
+    SingleDataReader,
+    UpdateWriter,
+)
 from src.models.api_schemas import UpdatedAt
 from src.models.models import Organization
 
 # from src.prisma import prisma
 from src.utils.permissions import validate_jwt_token, OrgAdminAccess, SuperAdminAccess, JWTRequired, OrgStaffAccess
+from src.utils.batching import load
+from src.utils.cache import cached_response, invalidate_cache
+from src.utils.reference_data import reference_data, with_currency
 
 router = APIRouter()
 
@@ -45,54 +55,72 @@ class UserInfo(BaseModel):
     user_id: str
 
 
-@router.get("/org", tags=["organization"], dependencies=[Depends(JWTRequired), Depends(SuperAdminAccess)])
-async def read_organizations(requestor=Depends(validate_jwt_token)):
-    pipeline = [
-            {
-                "$lookup": {
-                    "from": "AccountInfo",
-                    "localField": "id",
-                    "foreignField": "orgId",
-                    "as": "accounts"
-                }
-            },
-            {
-                "$lookup": {
-                    "from": "Client",
-                    "localField": "id",
-                    "foreignField": "orgId",
-                    "as": "clients"
-                }
-            },
-            {
-                "$lookup": {
-                    "from": "User",
-                    "localField": "id",
-                    "foreignField": "orgId",
-                    "as": "users"
-                }
-            },
-            {
-                "$lookup": {
-                    "from": "Currency",
-                    "localField": "defaultCurrencyId",
-                    "foreignField": "id",
-                    "as": "defaultCurrency"
-                }
-            },
-            {
-                "$unwind": "$defaultCurrency"
-            },
-            {
-                "$project": {
-                    "_id": 0
-                }
-            },
-            {
-                "$unset": ["accounts._id", "clients._id", "users._id", "defaultCurrency._id"]
+# Relations an organization detail can expand, by collection and the fields sent back
+ORGANIZATION_RELATIONS = {
+    "accounts": ("AccountInfo", ["id", "orgId", "accountName", "accountNumber", "createdAt", "updatedAt"]),
+    "clients": ("Client", [
+        "id", "orgId", "name", "abr", "registration", "domestic", "internal",
+        "contact_name", "contact_email", "contact_phone", "addressLine1", "addressLine2",
+        "addressLine3", "city", "country", "zip", "active", "createdAt", "updatedAt",
+    ]),
+    "users": ("User", [
+        "id", "orgId", "email", "name", "thumbURL", "photoURL", "birthDay", "gender", "phone",
+        "email_verified", "phone_verified", "active", "superUser", "staffUser", "createdAt", "updatedAt",
+    ]),
+}
+
+INCLUDE_DESCRIPTION = "Comma separated relations to expand: accounts, clients, users. All of them by default"
+
+
+def parse_include(include: Optional[str]) -> list:
+    if include is None:
+        return list(ORGANIZATION_RELATIONS)
+    relations = [relation.strip() for relation in include.split(",") if relation.strip()]
+    unknown = [relation for relation in relations if relation not in ORGANIZATION_RELATIONS]
+    if unknown:
+        raise HTTPException(
+            detail=f"Cannot include {', '.join(unknown)}",
+            status_code=HTTP_400_BAD_REQUEST,
+        )
+    return relations
+
+
+def organization_pipeline(match: dict = None, include: list = None) -> list:
+    """Organizations with their accounts, clients and users
+
+    Each relation is looked up with a sub-pipeline projecting only the fields
+    in ORGANIZATION_RELATIONS, so password hashes and Mongo ids never leave
+    the database.
+    """
+    include = list(ORGANIZATION_RELATIONS) if include is None else include
+    pipeline = [{"$match": match}] if match else []
+    for name in include:
+        collection_name, fields = ORGANIZATION_RELATIONS[name]
+        pipeline.append({
+            "$lookup": {
+                "from": collection_name,
+                "let": {"orgId": "$id"},
+                "pipeline": [
+                    {"$match": {"$expr": {"$eq": ["$orgId", "$$orgId"]}}},
+                    {"$project": {"_id": 0, **{field: 1 for field in fields}}},
+                ],
+                "as": name
             }
-        ]
-    return DataAggregation("Organization", pipeline)
+        })
+    pipeline.append({"$project": {"_id": 0}})
+    return pipeline
+
+
+@router.get("/org", tags=["organization"], dependencies=[Depends(JWTRequired), Depends(SuperAdminAccess)])
+async def read_organizations(
+        include: Optional[str] = Query(None, description=INCLUDE_DESCRIPTION),
+        requestor=Depends(validate_jwt_token)
+):
+    pipeline = organization_pipeline(include=parse_include(include))
+    return [
+        with_currency(organization, "defaultCurrencyId", "defaultCurrency")
+        for organization in DataAggregation("Organization", pipeline)
+    ]
 
 
 @router.post("/org", tags=["organization"], dependencies=[Depends(JWTRequired), Depends(SuperAdminAccess)])
@@ -107,70 +135,40 @@ async def create_organization(
         )
     organization_creation = Organization(**org.dict())
     DataWriter("Organization", organization_creation.dict())
+    reference_data.invalidate()
+    invalidate_cache("currency")
     return organization_creation
 
 
 @router.get("/org/{org_id}", tags=["organization"], dependencies=[Depends(JWTRequired), Depends(OrgStaffAccess)])
-async def read_organizations(org_id: str, requestor=Depends(validate_jwt_token)):
-    pipeline = [
-            {"$match": {"id": org_id}},
-            {
-                "$lookup": {
-                    "from": "AccountInfo",
-                    "localField": "id",
-                    "foreignField": "orgId",
-                    "as": "accounts"
-                }
-            },
-            {
-                "$lookup": {
-                    "from": "Client",
-                    "localField": "id",
-                    "foreignField": "orgId",
-                    "as": "clients"
-                }
-            },
-            {
-                "$lookup": {
-                    "from": "User",
-                    "localField": "id",
-                    "foreignField": "orgId",
-                    "as": "users"
-                }
-            },
-            {
-                "$lookup": {
-                    "from": "Currency",
-                    "localField": "defaultCurrencyId",
-                    "foreignField": "id",
-                    "as": "defaultCurrency"
-                }
-            },
-            {
-                "$unwind": "$defaultCurrency"
-            },
-            {
-                "$project": {
-                    "_id": 0
-                }
-            },
-            {
-                "$unset": ["accounts._id", "clients._id", "users._id", "defaultCurrency._id"]
-            }
-        ]
-    organization = DataAggregation("Organization", pipeline)
-    if not organization:
-        raise HTTPException(
-            detail="Invalid organization id",
-            status_code=HTTP_400_BAD_REQUEST,
-        )
-    return organization[0]
+async def read_organizations(
+        org_id: str,
+        request: Request,
+        include: Optional[str] = Query(None, description=INCLUDE_DESCRIPTION),
+        requestor=Depends(validate_jwt_token)
+):
+    pipeline = organization_pipeline({"id": org_id}, parse_include(include))
+
+    def read_organization():
+        organization = DataAggregation("Organization", pipeline)
+        if not organization:
+            raise HTTPException(
+                detail="Invalid organization id",
+                status_code=HTTP_400_BAD_REQUEST,
+            )
+        return with_currency(organization[0], "defaultCurrencyId", "defaultCurrency")
+
+    return await cached_response(request, "organization", requestor, read_organization, org_id=org_id)
 
 
 @router.post("/org/add/{org_id}", tags=["organization"], dependencies=[Depends(JWTRequired), Depends(OrgAdminAccess)])
 async def add_user(
-    org_id: str, userId: UserInfo, requestor=Depends(validate_jwt_token)
+    org_id: str,
+    userId: UserInfo,
+    include: Optional[str] = Query(None, description=INCLUDE_DESCRIPTION),
+    requestor=Depends(validate_jwt_token)
 ):
+    include = parse_include(include)
     organization = SingleDataReader("Organization", {"id": org_id})
     if not organization:
         raise HTTPException(
@@ -178,59 +176,25 @@ async def add_user(
             status_code=HTTP_400_BAD_REQUEST,
         )
 
-    user = SingleDataReader("User", {"id": userId.user_id})
+    user = await load("User", userId.user_id)
     if not user:
         raise HTTPException(
             detail="Invalid User id",
             status_code=HTTP_400_BAD_REQUEST,
         )
     UpdateWriter("User", {"id": userId.user_id}, {"orgId": org_id, **UpdatedAt().dict()})
-    pipeline = [
-            {"$match": {"id": org_id}},
-            {
-                "$lookup": {
-                    "from": "AccountInfo",
-                    "localField": "id",
-                    "foreignField": "orgId",
-                    "as": "accounts"
-                }
-            },
-            {
-                "$lookup": {
-                    "from": "Client",
-                    "localField": "id",
-                    "foreignField": "orgId",
-                    "as": "clients"
-                }
-            },
-            {
-                "$lookup": {
-                    "from": "User",
-                    "localField": "id",
-                    "foreignField": "orgId",
-                    "as": "users"
-                }
-            },
-            {
-                "$project": {
-                    "_id": 0
-                }
-            },
-            {
-                "$unset": ["accounts._id", "clients._id", "users._id"]
-            }
-        ]
-    organization = DataAggregation("Organization", pipeline)
-    for users in organization[0]["users"]:
-        del users["password"]
-
-    return organization
+    invalidate_cache("organization", org_id=org_id)
+    return DataAggregation("Organization", organization_pipeline({"id": org_id}, include))
 
 
 @router.post("/org/{org_id}", tags=["organization"], dependencies=[Depends(JWTRequired), Depends(SuperAdminAccess)])
 async def update_organizations(
-    org_id: str, update_info: UpdateOrganization, requestor=Depends(validate_jwt_token)
+    org_id: str,
+    update_info: UpdateOrganization,
+    include: Optional[str] = Query(None, description=INCLUDE_DESCRIPTION),
+    requestor=Depends(validate_jwt_token)
 ):
+    include = parse_include(include)
     organization = SingleDataReader("Organization", {"id": org_id})
     if not organization:
         raise HTTPException(
@@ -286,56 +250,20 @@ async def update_organizations(
         "zip": organization.zip,
     }
 
+    updated_org = organization.dict()
     if json.dumps(prev_data) != json.dumps(update_info.dict()):
-        UpdateWriter("Organization", {"id": organization.id}, { **update_info.dict(), **UpdatedAt().dict()})
-    pipeline = [
-            {"$match": {"id": org_id}},
-            {
-                "$lookup": {
-                    "from": "AccountInfo",
-                    "localField": "id",
-                    "foreignField": "orgId",
-                    "as": "accounts"
-                }
-            },
-            {
-                "$lookup": {
-                    "from": "Client",
-                    "localField": "id",
-                    "foreignField": "orgId",
-                    "as": "clients"
-                }
-            },
-            {
-                "$lookup": {
-                    "from": "User",
-                    "localField": "id",
-                    "foreignField": "orgId",
-                    "as": "users"
-                }
-            },
-            {
-                "$lookup": {
-                    "from": "Currency",
-                    "localField": "defaultCurrencyId",
-                    "foreignField": "id",
-                    "as": "defaultCurrency"
-                }
-            },
-            {
-                "$unwind": "$defaultCurrency"
-            },
-            {
-                "$project": {
-                    "_id": 0
-                }
-            },
-            {
-                "$unset": ["accounts._id", "clients._id", "users._id", "defaultCurrency._id"]
-            }
-        ]
-    updated_org = DataAggregation("Organization", pipeline)
-    return updated_org[0]
+        updated_org = FindOneAndUpdate(
+            "Organization",
+            {"id": organization.id},
+            {"$set": {**update_info.dict(), **UpdatedAt().dict()}},
+            projection={"_id": 0},
+        )
+        reference_data.invalidate()
+        invalidate_cache("organization", "client", "account", org_id=org_id)
+    if include:
+        # Expanding relations takes another read, an empty include= answers from the update alone
+        updated_org = DataAggregation("Organization", organization_pipeline({"id": org_id}, include))[0]
+    return with_currency(updated_org, "defaultCurrencyId", "defaultCurrency")
 
 
 @router.delete("/org/{org_id}", tags=["organization"], dependencies=[Depends(JWTRequired), Depends(SuperAdminAccess)])
@@ -347,4 +275,7 @@ async def delete_organizations(org_id: str, requestor=Depends(validate_jwt_token
             status_code=HTTP_400_BAD_REQUEST,
         )
     DeleteData("Organization", {"id": org_id})
+    reference_data.invalidate()
+    invalidate_cache("organization", "client", "account", org_id=org_id)
+    invalidate_cache("currency")
     return {"status": "acknowledged"}
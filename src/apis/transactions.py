@@ -1,13 +1,22 @@
 import io
 import os
-from fastapi import APIRouter, Depends, File, Form, UploadFile, Response
+from datetime import datetime
+from typing import Optional
+from fastapi import APIRouter, Depends, File, Form, Query, Request, UploadFile, Response
 
 from pydantic import BaseModel
 
+from starlette.concurrency import run_in_threadpool
 from starlette.exceptions import HTTPException
 from starlette.status import HTTP_400_BAD_REQUEST
-from src.config.database import DataAggregation, DataWriter, MultiDataReader, SingleDataReader, UpdateWriter
+from src.config.database import DataAggregation, MultiDataReader, SingleDataReader
+from src.config.settings import EXPORT_CHUNK_ROWS
 from src.models.models import PaymentDB, Transaction, ExpenseDB
+from src.utils.batching import load
+from src.utils.cache import invalidate_cache
+from src.utils.exports import data_watermark, export_chunks, export_response
+from src.utils.ledger import record_ledger_transaction
+from src.utils.metrics import apply_metrics, metrics_period
 
 # from src.prisma import prisma
 from src.models.scalar import TransactionType
@@ -15,9 +24,6 @@ from src.models.db_models import (
     PaymentBase,
     ExpenseBase,
     TransactionBase,
-    TransactionInDb,
-    PaymentInDb,
-    ExpenseInDb,
 )
 from src.utils.permissions import validate_jwt_token, JWTRequired, OrgAdminAccess
 from src.utils.storage import write_to_blob, read_blob
@@ -59,147 +65,94 @@ class RecordTransaction(BaseModel):
 
 
 @router.get("/transactions", tags=["transactions"], dependencies=[Depends(JWTRequired), Depends(OrgAdminAccess)])
-async def get_transactions(requestor=Depends(validate_jwt_token)):
-    pipeline = [
-        {
-            "$lookup": {
-                "from": "AccountInfo",
-                "localField": "accountId",
-                "foreignField": "id",
-                "as": "account"
-            }
-        },
-        {
-            "$unwind": "$account"
-        },
-        {
-            "$lookup": {
-                "from": "Organization",
-                "localField": "account.orgId",
-                "foreignField": "id",
-                "as": "account.organization"
-            }
-        },
-        {
-            "$unwind": "$account.organization"
-        },
-        {
-            "$match": {
-                "account.organization.id": requestor.orgId
-            }
-        },
-        {
-            "$lookup": {
-                "from": "Currency",
-                "localField": "account.organization.defaultCurrencyId",
-                "foreignField": "id",
-                "as": "account.organization.defaultCurrency"
-            }
-        },
-        {
-            "$unwind": "$account.organization.defaultCurrency"
-        },
-        {
-            "$lookup": {
-                "from": "Payment",
-                "localField": "paymentId",
-                "foreignField": "id",
-                "as": "payment"
-            }
-        },
-        {
-            "$unwind": {
-                "path": "$payment",
-                "preserveNullAndEmptyArrays": True
-            }
+async def get_transactions(
+        account_id: Optional[str] = Query(None, description="Only this account"),
+        start: Optional[int] = Query(None, description="From this transaction timestamp"),
+        end: Optional[int] = Query(None, description="Until this transaction timestamp"),
+        requestor=Depends(validate_jwt_token)
+):
+    query = {"orgId": requestor.orgId}
+    if account_id:
+        query["accountId"] = account_id
+    if start is not None or end is not None:
+        query["transaction_date"] = {}
+        if start is not None:
+            query["transaction_date"]["$gte"] = start
+        if end is not None:
+            query["transaction_date"]["$lte"] = end
+    entries = MultiDataReader("LedgerEntry", query, {"_id": 0})
+    return list(entries.sort([("transaction_date", -1), ("sequence", -1)]))
 
-        },
-        {
-            "$lookup": {
-                "from": "Currency",
-                "localField": "payment.currencyId",
-                "foreignField": "id",
-                "as": "payment.currency"
-            }
-        },
-        {
-            "$unwind": {
-                "path": "$payment.currency",
-                "preserveNullAndEmptyArrays": True
-            }
 
-        },
-        {
-            "$lookup": {
-                "from": "Expense",
-                "localField": "expenseId",
-                "foreignField": "id",
-                "as": "expense"
-            }
-        },
-        {
-            "$unwind": {
-                "path": "$expense",
-                "preserveNullAndEmptyArrays": True
-            }
-        },
-        {
-            "$lookup": {
-                "from": "Currency",
-                "localField": "expense.currencyId",
-                "foreignField": "id",
-                "as": "expense.currency"
-            }
-        },
-        {
-            "$unwind": {
-                "path": "$expense.currency",
-                "preserveNullAndEmptyArrays": True
-            }
+LEDGER_EXPORT_COLUMNS = [
+    "transaction_date", "sequence", "accountName", "accountNumber", "description", "debit", "credit",
+    "balance", "currency", "originalAmount", "originalCurrency", "exchangeRate", "clientId", "id",
+]
 
-        },
-        {
-            "$project": {
-                "_id": 0
-            }
-        },
-        {
-            "$unset": ["account._id", "account.organization._id", "account.organization.defaultCurrency._id", "payment._id", "expense._id",
-                       "payment.currency._id", "expense.currency._id"]
-        },
-        {
-            "$sort": {
-                "createdAt": -1
-            }
-        }
-    ]
 
-    transactions = DataAggregation("Transaction", pipeline)
-
-    transformed_data = []
-    for row in transactions:
-        transformed_data.append(
-            {
-                "id": row.id,
-                "description": row.expense.description
-                if row.expense
-                else row.payment.description,
-                "accountName": row.account.accountName,
-                "accountNumber": row.account.accountNumber,
-                "currency": row.account.organization.defaultCurrency.abr,
-                "currencySymbol": row.account.organization.defaultCurrency.symbol,
-                "debit": row.debit,
-                "credit": row.credit,
-                "originalCurrency": row.expense.currency.abr
-                if row.expense
-                else row.payment.currency.abr,
-                "originalCurrencySymbol": row.expense.currency.symbol
-                if row.expense
-                else row.payment.currency.symbol,
-                "transaction_date": row.createdAt,
-            }
+def ledger_export_rows(entries):
+    for entry in entries:
+        entry["transaction_date"] = datetime.utcfromtimestamp(entry["transaction_date"])
+        yield [entry.get(column) for column in LEDGER_EXPORT_COLUMNS]
+
+
+@router.get("/transactions/export", tags=["transactions"],
+            dependencies=[Depends(JWTRequired), Depends(OrgAdminAccess)])
+async def export_transactions(
+        request: Request,
+        account_id: Optional[str] = Query(None, description="Only this account"),
+        start: Optional[int] = Query(None, description="From this transaction timestamp"),
+        end: Optional[int] = Query(None, description="Until this transaction timestamp"),
+        format: str = Query("csv", regex="^(csv|xlsx)$"),
+        compress: Optional[str] = Query(None, regex="^gzip$", description="gzip the file"),
+        requestor=Depends(validate_jwt_token)
+):
+    query = {"orgId": requestor.orgId}
+    if account_id:
+        query["accountId"] = account_id
+    if start is not None or end is not None:
+        query["transaction_date"] = {}
+        if start is not None:
+            query["transaction_date"]["$gte"] = start
+        if end is not None:
+            query["transaction_date"]["$lte"] = end
+
+    def chunks():
+        # Called before the response starts, a failed read still gets a proper error
+        entries = MultiDataReader("LedgerEntry", query, {"_id": 0})
+        if entries is None:
+            raise HTTPException(detail="Ledger entries could not be read", status_code=HTTP_400_BAD_REQUEST)
+        rows = ledger_export_rows(
+            entries.sort([("transaction_date", 1), ("sequence", 1)]).batch_size(EXPORT_CHUNK_ROWS)
         )
-    return transformed_data
+        return export_chunks(format, LEDGER_EXPORT_COLUMNS, rows, "Ledger", compress is not None)
+
+    # Entries are only appended outside a ledger rebuild, which clears the exports
+    watermark = await run_in_threadpool(data_watermark, "LedgerEntry", query, "sequence")
+    return await export_response(
+        request, requestor.orgId, watermark, "ledger", format, compress is not None, chunks
+    )
+
+
+@router.get("/transactions/snapshots", tags=["transactions"],
+            dependencies=[Depends(JWTRequired), Depends(OrgAdminAccess)])
+async def get_ledger_snapshots(
+        account_id: Optional[str] = Query(None, description="Only this account"),
+        start_period: Optional[str] = Query(None, description="First month, YYYY-MM"),
+        end_period: Optional[str] = Query(None, description="Last month, YYYY-MM"),
+        requestor=Depends(validate_jwt_token)
+):
+    query = {"orgId": requestor.orgId}
+    if account_id:
+        query["accountId"] = account_id
+    if start_period or end_period:
+        query["period"] = {}
+        if start_period:
+            query["period"]["$gte"] = start_period
+        if end_period:
+            query["period"]["$lte"] = end_period
+    snapshots = MultiDataReader("LedgerSnapshot", query, {"_id": 0})
+    return list(snapshots.sort([("accountId", 1), ("period", 1)]))
 
 
 @router.post("/transactions/payment/invoice", tags=["transactions"],
@@ -210,46 +163,38 @@ async def pay_invoice(payment_info: PayInvoice, requestor=Depends(validate_jwt_t
     #     include={"workOrder": {"include": {"currency": True}}},
     # )
 
-    pipeline = [
-        {"$match": {"id": payment_info.invoiceId}},
-        {
-            "$lookup": {
-                "from": "WorkOrder",
-                "localField": "WorkOrder.id",
-                "foreignField": "id",
-                "as": "workOrder"
-            }
-        },
-        {
-            "$lookup": {
-                "from": "Currencies",
-                "localField": "WorkOrder.currencyId",
-                "foreignField": "id",
-                "as": "workOrder.currency"
-            }
-        },
-        {
-            "$project": {
-                "_id": 0
-            }
-        },
-        {
-            "$unset": ["workOrder._id", "workOrder.currency._id"]
-        }
-    ]
-    invoice = DataAggregation("Invoice", pipeline)
+    invoice = await load("Invoice", payment_info.invoiceId)
+    if not invoice:
+        raise HTTPException(detail="Invalid Invoice", status_code=HTTP_400_BAD_REQUEST)
+    work_order = await load("WorkOrder", invoice["workOrderId"])
+    if not work_order:
+        raise HTTPException(detail="Invalid Work-Order id", status_code=HTTP_400_BAD_REQUEST)
     payment_data = payment_info.dict()
-    payment_data["currencyId"] = invoice.workOrder.currencyId
+    payment_data["currencyId"] = work_order["currencyId"]
     del payment_data["accountId"]
-    created_payment = PaymentInDb(**payment_data)
-    DataWriter("Payment", created_payment)
-    transaction = TransactionInDb(**{
+    created_payment = PaymentDB(**payment_data)
+    transaction = Transaction(**{
                    "debit": 0,
                    "credit": created_payment.amount * created_payment.exchangeRate,
                    "paymentId": created_payment.id,
                    "accountId": payment_info.accountId,
                })
-    DataWriter("Transaction", transaction.dict())
+    record_ledger_transaction(
+        "Payment",
+        created_payment,
+        transaction,
+        work_order["clientId"],
+        also=lambda session: apply_metrics(
+            requestor.orgId,
+            work_order,
+            metrics_period(created_payment.createdAt),
+            created_payment.currencyId,
+            session=session,
+            payments=1,
+            paid=created_payment.amount,
+        ),
+    )
+    invalidate_cache("metrics", org_id=requestor.orgId)
     return {"status": "transaction recorded"}
 
 
@@ -260,14 +205,13 @@ async def record_payment(payment_info: Payment, requestor=Depends(validate_jwt_t
     del payment_data["accountId"]
 
     payment_data = PaymentDB(**payment_data)
-    DataWriter("Payment", payment_data.dict())
     transaction_data = Transaction(**({
                    "debit": 0,
                    "credit": payment_data.amount * payment_data.exchangeRate,
                    "paymentId": payment_data.id,
                    "accountId": payment_info.accountId,
                }))
-    DataWriter("Transaction", transaction_data.dict())
+    record_ledger_transaction("Payment", payment_data, transaction_data)
     return {"status": "transaction recorded"}
 
 
@@ -279,14 +223,13 @@ async def record_expense(expense_info: Payment, requestor=Depends(validate_jwt_t
 
     expense_data = ExpenseDB(**expense_data)
 
-    DataWriter("Expense", expense_data.dict())
     transaction_data = Transaction(**({
                    "debit": expense_data.amount * expense_data.exchangeRate,
                    "credit": 0,
                    "expenseId": expense_data.id,
                    "accountId": expense_info.accountId,
                }))
-    DataWriter("Transaction", transaction_data.dict())
+    record_ledger_transaction("Expense", expense_data, transaction_data)
     return {"status": "transaction recorded"}
 
 
@@ -302,179 +245,38 @@ async def record_transaction(
         account_id: str = Form(..., description="Account Id"),
         requestor=Depends(validate_jwt_token)
 ):
+    account = SingleDataReader("AccountInfo", {"id": account_id, "orgId": requestor.orgId})
+    if not account:
+        raise HTTPException(detail="Invalid Account", status_code=HTTP_400_BAD_REQUEST)
+
     data = {
         "description": description,
         "amount": amount,
         "currencyId": currency_id,
         "exchangeRate": exchange_rate,
     }
-    expense, payment = None, None
     content = io.BytesIO(document.file.read())
     extension = os.path.splitext(document.filename)[1]
     if type == TransactionType.expense:
-        expense = ExpenseInDb(**data)
-        DataWriter("Expense", data)
-        t_id = expense.id
+        source = ExpenseDB(**data)
+        collection_name = "Expense"
     else:
-        payment = PaymentInDb(**data)
-        DataWriter("Payment", payment)
-        t_id = payment.id
-    pdf_url = write_to_blob(
-        path=f"invoices/{type.value}/{t_id}{extension}", data=content
+        source = PaymentDB(**data)
+        collection_name = "Payment"
+    # Ids are generated here, so the document is uploaded before anything is written
+    source.docUrl = write_to_blob(
+        path=f"invoices/{type.value}/{source.id}{extension}", data=content
     )
 
-    if type == TransactionType.expense:
-        expense = UpdateWriter("Expense", {"id": t_id}, {"docUrl": pdf_url})
-    else:
-        payment = UpdateWriter("Payment", {"id": t_id}, {"docUrl": pdf_url})
-    account = SingleDataReader("Accounts", {"id": account_id})
-    transaction = TransactionInDb(**{
-        "debit": expense.amount * expense.exchangeRate if expense else 0,
-        "credit": payment.amount * payment.exchangeRate if payment else 0,
-        "expenseId": expense.id if expense else None,
-        "paymentId": payment.id if payment else None,
-        "accountId": account.id,
+    transaction = Transaction(**{
+        "debit": source.amount * source.exchangeRate if type == TransactionType.expense else 0,
+        "credit": source.amount * source.exchangeRate if type != TransactionType.expense else 0,
+        "expenseId": source.id if type == TransactionType.expense else None,
+        "paymentId": source.id if type != TransactionType.expense else None,
+        "accountId": account_id,
     })
-    DataWriter("Transaction", transaction.dict())
-
-    pipeline = [
-        {"$match": {"id": transaction.id}},
-        {
-            "$lookup": {
-                "from": "AccountInfo",
-                "localField": "accountId",
-                "foreignField": "id",
-                "as": "account"
-            }
-        },
-        {
-            "$unwind": "$account"
-        },
-        {
-            "$lookup": {
-                "from": "Organization",
-                "localField": "account.orgId",
-                "foreignField": "id",
-                "as": "account.organization"
-            }
-        },
-        {
-            "$unwind": "$account.organization"
-        },
-        {
-            "$match": {
-                "account.organization.id": requestor.orgId
-            }
-        },
-        {
-            "$lookup": {
-                "from": "Currency",
-                "localField": "account.organization.defaultCurrencyId",
-                "foreignField": "id",
-                "as": "account.organization.defaultCurrency"
-            }
-        },
-        {
-            "$unwind": "$account.organization.defaultCurrency"
-        },
-        {
-            "$lookup": {
-                "from": "Payment",
-                "localField": "paymentId",
-                "foreignField": "id",
-                "as": "payment"
-            }
-        },
-        {
-            "$unwind": {
-                "path": "$payment",
-                "preserveNullAndEmptyArrays": True
-            }
-
-        },
-        {
-            "$lookup": {
-                "from": "Currency",
-                "localField": "payment.currencyId",
-                "foreignField": "id",
-                "as": "payment.currency"
-            }
-        },
-        {
-            "$unwind": {
-                "path": "$payment.currency",
-                "preserveNullAndEmptyArrays": True
-            }
-
-        },
-        {
-            "$lookup": {
-                "from": "Expense",
-                "localField": "expenseId",
-                "foreignField": "id",
-                "as": "expense"
-            }
-        },
-        {
-            "$unwind": {
-                "path": "$expense",
-                "preserveNullAndEmptyArrays": True
-            }
-        },
-        {
-            "$lookup": {
-                "from": "Currency",
-                "localField": "expense.currencyId",
-                "foreignField": "id",
-                "as": "expense.currency"
-            }
-        },
-        {
-            "$unwind": {
-                "path": "$expense.currency",
-                "preserveNullAndEmptyArrays": True
-            }
-
-        },
-        {
-            "$project": {
-                "_id": 0
-            }
-        },
-        {
-            "$unset": ["account._id", "account.organization._id", "account.organization.defaultCurrency._id",
-                       "payment._id", "expense._id",
-                       "payment.currency._id", "expense.currency._id"]
-        },
-        {
-            "$sort": {
-                "createdAt": -1
-            }
-        }
-    ]
-
-    transaction = DataAggregation("Transaction", pipeline)[0]
-
-    data = {
-        "id": transaction.id,
-        "description": transaction.expense.description
-        if transaction.expense
-        else transaction.payment.description,
-        "accountName": transaction.account.accountName,
-        "accountNumber": transaction.account.accountNumber,
-        "currency": transaction.account.organization.defaultCurrency.abr,
-        "currencySymbol": transaction.account.organization.defaultCurrency.symbol,
-        "debit": transaction.debit,
-        "credit": transaction.credit,
-        "originalCurrency": transaction.expense.currency.abr
-        if transaction.expense
-        else transaction.payment.currency.abr,
-        "originalCurrencySymbol": transaction.expense.currency.symbol
-        if transaction.expense
-        else transaction.payment.currency.symbol,
-        "transaction_date": transaction.createdAt,
-    }
-    return data
+    entry = record_ledger_transaction(collection_name, source, transaction)
+    return entry.dict()
 
 
 @router.get("/transactions/document/{transaction_id}", tags=["transactions"],
@@ -6,7 +6,7 @@ from pydantic import BaseModel
 from starlette.exceptions import HTTPException
 from starlette.status import HTTP_400_BAD_REQUEST
 
-from src.config.database import DataAggregation, SingleDataReader, UpdateWriter, DeleteData, DataWriter
+from src.config.database import DataAggregation, SingleDataReader, UpdateWriter, DeleteData, DataWriter, FindOneAndUpdate
 from src.models.api_schemas import UpdatedAt
 from src.models.api_schemas import (
     UserCreate,
@@ -17,6 +17,9 @@ from src.models.db_models import UserInDb
 from src.models.models import User
 from src.models.scalar import Gender
 from src.utils.auth import encryptPassword
+from src.utils.batching import gather_queries, load
+from src.utils.cache import invalidate_cache
+from src.utils.reference_data import with_organization
 from src.utils.permissions import validate_jwt_token, JWTRequired, SuperAdminAccess, OrgAdminAccess, OrgStaffAccess
 
 router = APIRouter()
@@ -186,35 +189,19 @@ async def update_user_me(
         "phone": update_info.phone,
     }
 
+    updated_user = requestor.dict()
     if json.dumps(prev_data) != json.dumps(update_data):
         update_data = update_info.dict()
         update_data["gender"] = update_data["gender"].value
-        UpdateWriter("User", {"id": requestor.id}, {**update_data, **UpdatedAt().dict()})
-
-    pipeline = [
-        {
-            "$match": {
-                "id": requestor.id
-            }
-        },
-        {
-            "$lookup": {
-                "from": "Organization",
-                "localField": "orgId",
-                "foreignField": "id",
-                "as": "organization"
-            }
-        },
-        {
-            "$unwind": "$organization"
-        },
-        {
-            "$unset": ["organization._id"]
-        }
-    ]
-    updated_user = DataAggregation("User", pipeline)
+        updated_user = FindOneAndUpdate(
+            "User",
+            {"id": requestor.id},
+            {"$set": {**update_data, **UpdatedAt().dict()}},
+            projection={"_id": 0, "password": 0},
+        )
+        invalidate_cache("organization", org_id=requestor.orgId)
 
-    return UserDisplay(**updated_user[0])
+    return UserDisplay(**with_organization(updated_user))
 
 
 @router.get("/users", response_model=List[UserDisplay], tags=["users"], dependencies=[Depends(JWTRequired), Depends(OrgAdminAccess)])
@@ -248,14 +235,16 @@ async def read_users(requestor: UserInDb = Depends(validate_jwt_token)):
 async def create_user_app(
         user_info: UserCreate, requestor: UserInDb = Depends(validate_jwt_token)
 ):
-    existing_user_with_email = SingleDataReader("User", {"email": user_info.email})
-    if existing_user_with_email:
+    found = await gather_queries(
+        email=lambda: SingleDataReader("User", {"email": user_info.email}),
+        phone=lambda: SingleDataReader("User", {"phone": user_info.phone}),
+    )
+    if found["email"]:
         raise HTTPException(
             detail="The email is already taken. Cannot use this email.",
             status_code=HTTP_400_BAD_REQUEST,
         )
-    existing_user_with_phone = SingleDataReader("User", {"phone": user_info.phone})
-    if existing_user_with_phone:
+    if found["phone"]:
         raise HTTPException(
             detail="The phone is already taken. Cannot use this phone number.",
             status_code=HTTP_400_BAD_REQUEST,
@@ -264,29 +253,8 @@ async def create_user_app(
     user_data = user_info.dict()
     user_data = User(**user_data)
     DataWriter("User", {**user_data.dict()})
-    pipeline = [
-        {
-            "$match": {
-                "id": user_data.id
-            }
-        },
-        {
-            "$lookup": {
-                "from": "Organization",
-                "localField": "orgId",
-                "foreignField": "id",
-                "as": "organization"
-            }
-        },
-        {
-            "$unwind": "$organization"
-        },
-        {
-            "$unset": ["organization._id"]
-        }
-    ]
-    user_created = DataAggregation("User", pipeline)
-    return UserDisplay(**user_created[0])
+    invalidate_cache("organization", org_id=user_data.orgId)
+    return UserDisplay(**with_organization(user_data.dict()))
 
 
 @router.post("/users/org", response_model=UserDisplay, tags=["users"], dependencies=[Depends(JWTRequired), Depends(OrgAdminAccess)])
@@ -294,14 +262,16 @@ async def create_user_org(
         user_info: UserCreate, requestor: UserInDb = Depends(validate_jwt_token)
 ):
     user_info.orgId = requestor.orgId
-    existing_user_with_email = SingleDataReader("User", {"email": user_info.email})
-    if existing_user_with_email:
+    found = await gather_queries(
+        email=lambda: SingleDataReader("User", {"email": user_info.email}),
+        phone=lambda: SingleDataReader("User", {"phone": user_info.phone}),
+    )
+    if found["email"]:
         raise HTTPException(
             detail="The email is already taken. Cannot use this email.",
             status_code=HTTP_400_BAD_REQUEST,
         )
-    existing_user_with_phone = SingleDataReader("User", {"phone": user_info.phone})
-    if existing_user_with_phone:
+    if found["phone"]:
         raise HTTPException(
             detail="The phone is already taken. Cannot use this phone number.",
             status_code=HTTP_400_BAD_REQUEST,
@@ -309,29 +279,8 @@ async def create_user_org(
     user_info.password = encryptPassword(user_info.password)
     user_data = User(**user_info.dict())
     DataWriter("User", {**user_data.dict()})
-    pipeline = [
-        {
-            "$match": {
-                "id": user_data.id
-            }
-        },
-        {
-            "$lookup": {
-                "from": "Organization",
-                "localField": "orgId",
-                "foreignField": "id",
-                "as": "organization"
-            }
-        },
-        {
-            "$unwind": "$organization"
-        },
-        {
-            "$unset": ["organization._id"]
-        }
-    ]
-    user_created = DataAggregation("User", pipeline)
-    return UserDisplay(**user_created[0])
+    invalidate_cache("organization", org_id=user_data.orgId)
+    return UserDisplay(**with_organization(user_data.dict()))
 
 
 @router.get("/users/{userId}", response_model=UserDisplay, tags=["users"], dependencies=[Depends(JWTRequired), Depends(OrgAdminAccess)])
@@ -448,6 +397,7 @@ async def update_user(
 
     if json.dumps(prev_data) != json.dumps(update_info.dict()):
         UpdateWriter("User", {"id": user.id}, {**update_info.dict(), **UpdatedAt().dict()})
+        invalidate_cache("organization", org_id=user.orgId)
 
     pipeline = [
         {
@@ -477,14 +427,13 @@ async def update_user(
 
 @router.delete("/users/{user_id}", tags=["users"], dependencies=[Depends(JWTRequired), Depends(OrgAdminAccess)])
 async def delete_user(user_id: str, requestor: UserInDb = Depends(validate_jwt_token)):
-    user = SingleDataReader("User", {"id": user_id})
-    user = User(**user)
-
+    user = await load("User", user_id)
     if not user:
         raise HTTPException(
             detail="Invalid User ID",
             status_code=HTTP_400_BAD_REQUEST,
         )
+    user = User(**user)
 
     if user.id == requestor.id:
         raise HTTPException(
@@ -492,4 +441,5 @@ async def delete_user(user_id: str, requestor: UserInDb = Depends(validate_jwt_t
             status_code=HTTP_400_BAD_REQUEST,
         )
     DeleteData("User", {"id": user.id})
+    invalidate_cache("organization", org_id=user.orgId)
     return {"status": "acknowledged"}
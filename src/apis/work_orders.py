@@ -1,23 +1,52 @@
+import asyncio
 import io
 import os
 from datetime import datetime, timedelta
 from typing import List, Optional
 
-import pandas as pd
-from fastapi import APIRouter, Depends, File, Form, UploadFile, Response, Query
+from fastapi import APIRouter, Depends, File, Form, UploadFile, Request, Response, Query
 from pydantic import BaseModel
+from pymongo.errors import PyMongoError
+from starlette.concurrency import run_in_threadpool
 from starlette.exceptions import HTTPException
 from starlette.status import HTTP_400_BAD_REQUEST
 
-from src.config.database import DataAggregation, DataWriter, DeleteData, MultiDataReader, SingleDataReader, UpdateWriter
-from src.config.settings import CUT_OFF_DATE
-from src.models.models import WorkOrder, TimesheetDB
+from src.config.database import (
+    DataAggregation,
+    DataWriter,
+    DeleteData,
+    FindOneAndUpdate,
+    MultiDataReader,
+    RunTransaction,
+    SingleDataReader,
+    UpdateWriter,
+)
+from src.config.settings import BULK_CHARGE_MAX_ROWS, EXPORT_CHUNK_ROWS
+from src.models.api_schemas import UpdatedAt
+from src.models.models import Client, Organization, WorkOrder, TimesheetDB
 from src.models.scalar import WorkOrderType
+from src.utils.batching import gather_queries, load, loader
+from src.utils.cache import cached_response, invalidate_cache
 from src.utils.communication import send_timesheet
-from src.utils.date_time import format_seconds_to_hr_mm
+from src.utils.date_time import days_in_month, format_seconds_to_hr_mm, month_starts
+from src.utils.exports import data_watermark, export_chunks, export_response
+from src.utils.metrics import apply_time_charge_metrics, rebuild_work_order_metrics
 from src.utils.permissions import validate_jwt_token, OrgAdminAccess, JWTRequired, OrgStaffAccess
+from src.utils.reference_data import reference_data, with_currency, with_organization
 from src.utils.storage import write_to_blob, delete_blob, read_blob
-from src.utils.timesheet import generate_timesheet_calendar
+from src.utils.timesheet import (
+    MAX_TIME_CHARGE,
+    TIME_CHARGE_TOO_LONG,
+    find_overlaps,
+    generate_timesheet_calendar,
+    lock_time_charges,
+    overlapping_time_charge,
+    parse_time_charges_csv,
+    prepare_time_charges,
+    refresh_timesheet_daily,
+    summarize_charged_days,
+    timesheet_calendar_days,
+)
 
 router = APIRouter()
 
@@ -68,74 +97,95 @@ class TimeChargeMail(BaseModel):
     cc: List[str]
 
 
+class BulkTimeChargeMail(BaseModel):
+    start: datetime
+    end: datetime
+    work_order_ids: List[str]
+    to: List[str]
+    cc: List[str] = []
+
+
+class ClientWithOrganization(Client):
+    organization: Organization
+
+
+class WorkOrderWithClient(WorkOrder):
+    client: ClientWithOrganization
+
+
+def work_order_response(work_order: dict, client: dict) -> dict:
+    """Work order with its client, the client organization and its currency, from the reference data cache"""
+    work_order = {key: value for key, value in work_order.items() if key != "_id"}
+    client = {key: value for key, value in client.items() if key != "_id"}
+    work_order["client"] = with_organization(client)
+    return with_currency(work_order)
+
+
 @router.get("/workOrder", tags=["work_orders"], dependencies=[Depends(JWTRequired), Depends(OrgStaffAccess)])
 async def read_work_orders(requestor=Depends(validate_jwt_token)):
+    clients = {
+        client["id"]: client
+        for client in MultiDataReader("Client", {"orgId": requestor.orgId}, {"_id": 0})
+    }
+    # Per work order summaries only, charged time and invoices are fetched per work order on demand
     pipeline = [
+        {"$match": {"clientId": {"$in": list(clients)}}},
         {
             "$lookup": {
-                "from": "Client",
-                "localField": "clientId",
-                "foreignField": "id",
-                "as": "client"
-            }
-        },
-        {
-            "$unwind": "$client"
-        },
-        {
-            "$lookup": {
-                "from": "Organization",
-                "localField": "client.orgId",
-                "foreignField": "id",
-                "as": "client.organization"
+                "from": "TimesheetDaily",
+                "let": {"workOrderId": "$id"},
+                "pipeline": [
+                    {"$match": {"$expr": {"$eq": ["$workOrderId", "$$workOrderId"]}}},
+                    {
+                        "$group": {
+                            "_id": None,
+                            "seconds": {"$sum": "$seconds"},
+                            "invoicedSeconds": {"$sum": "$invoicedSeconds"},
+                            "lastChargedOn": {"$max": "$date"},
+                        }
+                    },
+                ],
+                "as": "charged"
             }
         },
-        {
-            "$unwind": "$client.organization"
-        },
         {
             "$lookup": {
                 "from": "Invoice",
-                "localField": "id",
-                "foreignField": "workOrderId",
-                "as": "invoices"
-            }
-        },
-        {
-            "$unwind": {
-                "path": "$invoices",
-                "preserveNullAndEmptyArrays": True
+                "let": {"workOrderId": "$id"},
+                "pipeline": [
+                    {"$match": {"$expr": {"$eq": ["$workOrderId", "$$workOrderId"]}}},
+                    {"$count": "count"},
+                ],
+                "as": "invoiceCount"
             }
         },
-        {
-            "$lookup": {
-                "from": "Timesheet",
-                "localField": "id",
-                "foreignField": "workOrderId",
-                "as": "changeability"
+        {"$unwind": {"path": "$charged", "preserveNullAndEmptyArrays": True}},
+        {
+            "$set": {
+                "hoursCharged": {"$divide": [{"$ifNull": ["$charged.seconds", 0]}, 3600]},
+                "uninvoicedHours": {
+                    "$divide": [
+                        {
+                            "$subtract": [
+                                {"$ifNull": ["$charged.seconds", 0]},
+                                {"$ifNull": ["$charged.invoicedSeconds", 0]},
+                            ]
+                        },
+                        3600,
+                    ]
+                },
+                "lastChargedOn": {"$ifNull": ["$charged.lastChargedOn", None]},
+                "invoiceCount": {"$ifNull": [{"$arrayElemAt": ["$invoiceCount.count", 0]}, 0]},
             }
         },
-        {
-            "$lookup": {
-                "from": "Currency",
-                "localField": "currencyId",
-                "foreignField": "id",
-                "as": "currency"
-            }
-        },
-        {
-            "$unwind": "$currency"
-        },
-        {
-            "$project": {
-                "_id": 0
-            }
-        },
-        {
-            "$unset": ["currency._id", "invoices._id", "changeability._id", "client.organization._id", "client._id"]
-        }
+        {"$project": {"_id": 0, "charged": 0}},
+        {"$sort": {"startDate": -1}},
     ]
-    return DataAggregation("WorkOrder", pipeline)
+    work_orders = DataAggregation("WorkOrder", pipeline)
+    for work_order in work_orders:
+        work_order["client"] = with_organization(dict(clients[work_order["clientId"]]))
+        with_currency(work_order)
+    return work_orders
 
 
 @router.post("/workOrder", tags=["work_orders"], dependencies=[Depends(JWTRequired), Depends(OrgAdminAccess)])
@@ -172,64 +222,18 @@ async def create_work_order(
     data["type"] = data["type"].value
 
     created_work_order = WorkOrder(**data)
-    DataWriter("WorkOrder", created_work_order.dict())
-    uploaded_path = write_to_blob(
+    created_work_order.docUrl = write_to_blob(
         data=content, path=f"work-orders/{created_work_order.id}{extension}"
-    )
-    if uploaded_path:
-        UpdateWriter("WorkOrder", {"id": created_work_order.id}, {"docUrl": uploaded_path})
-
-    pipeline = [
-        {"$match": {"id": created_work_order.id}},
-        {
-            "$lookup": {
-                "from": "Client",
-                "localField": "clientId",
-                "foreignField": "id",
-                "as": "client"
-            }
-        },
-        {
-            "$unwind": "$client"
-        },
-        {
-            "$lookup": {
-                "from": "Organization",
-                "localField": "client.orgId",
-                "foreignField": "id",
-                "as": "client.organization"
-            }
-        },
-        {
-            "$unwind": "$client.organization"
-        },
-        {
-            "$lookup": {
-                "from": "Currency",
-                "localField": "currencyId",
-                "foreignField": "id",
-                "as": "currency"
-            }
-        },
-        {
-            "$unwind": "$currency"
-        },
-        {
-            "$project": {
-                "_id": 0
-            }
-        },
-        {
-            "$unset": ["client._id", "client.organization._id", "currency._id"]
-        }
-    ]
-    created_work_order = DataAggregation("WorkOrder", pipeline)
-    return created_work_order[0]
+    ) or None
+    DataWriter("WorkOrder", created_work_order.dict())
+    invalidate_cache("client", "organization", org_id=client["orgId"])
+    invalidate_cache("currency")
+    return work_order_response(created_work_order.dict(), client)
 
 
 @router.get("/workOrder/{work_order_id}", tags=["work_orders"],
             dependencies=[Depends(JWTRequired), Depends(OrgStaffAccess)])
-async def read_work_order(work_order_id: str, requestor=Depends(validate_jwt_token)):
+async def read_work_order(work_order_id: str, request: Request, requestor=Depends(validate_jwt_token)):
     pipeline = [
         {"$match": {"id": work_order_id}},
         {
@@ -299,13 +303,17 @@ async def read_work_order(work_order_id: str, requestor=Depends(validate_jwt_tok
             "$unset": ["invoices._id", "changeability._id", "client._id", "currency._id"]
         }
     ]
-    work_order = DataAggregation("WorkOrder", pipeline)
-    if not work_order:
-        raise HTTPException(
-            detail="Invalid Work-Order id",
-            status_code=HTTP_400_BAD_REQUEST,
-        )
-    return work_order[0]
+
+    def read():
+        work_order = DataAggregation("WorkOrder", pipeline)
+        if not work_order:
+            raise HTTPException(
+                detail="Invalid Work-Order id",
+                status_code=HTTP_400_BAD_REQUEST,
+            )
+        return work_order[0]
+
+    return await cached_response(request, "workOrder", requestor, read)
 
 
 @router.post("/workOrder/{work_order_id}", tags=["work_orders"],
@@ -315,7 +323,14 @@ async def update_work_order(
         update_info: UpdateWorkOrder,
         requestor=Depends(validate_jwt_token)
 ):
-    work_order = SingleDataReader("WorkOrder", {"id": work_order_id})
+    lookups = {"work_order": lambda: SingleDataReader("WorkOrder", {"id": work_order_id})}
+    if update_info.clientId:
+        lookups["client"] = lambda: SingleDataReader("Client", {"id": update_info.clientId})
+    if update_info.currencyId:
+        lookups["currency"] = lambda: reference_data.currency(update_info.currencyId)
+    found = await gather_queries(**lookups)
+
+    work_order = found["work_order"]
     if not work_order:
         raise HTTPException(
             detail="Invalid Work-Order id",
@@ -324,21 +339,18 @@ async def update_work_order(
 
     work_order = WorkOrder(**work_order)
 
-    if update_info.clientId and update_info.clientId != work_order.clientId:
-        client = SingleDataReader("Client", {"id": update_info.clientId})
-        if not client:
-            raise HTTPException(
-                detail="Invalid Client id",
-                status_code=HTTP_400_BAD_REQUEST,
-            )
+    client = found.get("client")
+    if update_info.clientId and not client:
+        raise HTTPException(
+            detail="Invalid Client id",
+            status_code=HTTP_400_BAD_REQUEST,
+        )
 
-    if update_info.currencyId and update_info.currencyId != work_order.currencyId:
-        currency = SingleDataReader("Currency", {"id": update_info.currencyId})
-        if not currency:
-            raise HTTPException(
-                detail="Invalid currency id",
-                status_code=HTTP_400_BAD_REQUEST,
-            )
+    if update_info.currencyId and not found["currency"]:
+        raise HTTPException(
+            detail="Invalid currency id",
+            status_code=HTTP_400_BAD_REQUEST,
+        )
 
     if update_info.startDate and update_info.endDate:
         if update_info.startDate > update_info.endDate:
@@ -378,80 +390,23 @@ async def update_work_order(
     )
     update_info.docUrl = update_info.docUrl if update_info.docUrl else work_order.docUrl
 
-    UpdateWriter(
-        "WorkOrder", {"id": work_order_id}, update_info.dict()
-    )
-
-    pipeline = [
-        {"$match": {"id": work_order_id}},
-        {
-            "$lookup": {
-                "from": "Client",
-                "localField": "clientId",
-                "foreignField": "id",
-                "as": "client"
-            }
-        },
-        {
-            "$unwind": "$client"
-        },
-        {
-            "$lookup": {
-                "from": "Organization",
-                "localField": "client.orgId",
-                "foreignField": "id",
-                "as": "client.organization"
-            }
-        },
-        {
-            "$unwind": "$client.organization"
-        },
-        {
-            "$lookup": {
-                "from": "Invoice",
-                "localField": "id",
-                "foreignField": "workOrderId",
-                "as": "invoices"
-            }
-        },
-        {
-            "$unwind": {
-                "path": "$invoices",
-                "preserveNullAndEmptyArrays": True
-            }
-        },
-        {
-            "$lookup": {
-                "from": "Timesheet",
-                "localField": "id",
-                "foreignField": "workOrderId",
-                "as": "changeability"
-            }
-        },
-        {
-            "$lookup": {
-                "from": "Currency",
-                "localField": "currencyId",
-                "foreignField": "id",
-                "as": "currency"
-            }
-        },
-        {
-            "$unwind": "$currency"
-        },
-        {
-            "$project": {
-                "_id": 0
-            }
-        },
-        {
-            "$unset": ["currency._id", "invoices._id", "changeability._id", "client.organization._id", "client._id"]
-        }
-    ]
-
-    updated_work_order = DataAggregation("WorkOrder", pipeline)
-
-    return updated_work_order[0]
+    writes = {
+        "work_order": lambda: FindOneAndUpdate(
+            "WorkOrder",
+            {"id": work_order_id},
+            {"$set": {**update_info.dict(), **UpdatedAt().dict()}},
+            projection={"_id": 0},
+        )
+    }
+    if client is None:
+        writes["client"] = lambda: SingleDataReader("Client", {"id": update_info.clientId})
+    updated = await gather_queries(**writes)
+    if update_info.clientId != work_order.clientId or update_info.currencyId != work_order.currencyId:
+        # Cells carry the client and currency, the work order's history is booked again under the new ones
+        await run_in_threadpool(rebuild_work_order_metrics, requestor.orgId, updated["work_order"])
+    invalidate_cache("workOrder", "client", "organization", "metrics", org_id=requestor.orgId)
+    invalidate_cache("currency")
+    return work_order_response(updated["work_order"], updated.get("client", client))
 
 
 @router.delete("/workOrder/{work_order_id}", tags=["work_orders"],
@@ -460,7 +415,7 @@ async def delete_work_order(
         work_order_id: str,
         requestor=Depends(validate_jwt_token)
 ):
-    work_order = SingleDataReader("WorkOrder", {"id": work_order_id})
+    work_order = await load("WorkOrder", work_order_id)
     if not work_order:
         raise HTTPException(
             detail="Invalid Work-Order id",
@@ -471,9 +426,95 @@ async def delete_work_order(
         uploaded_file_name = work_order.docUrl.split("/")[-1]
         delete_blob(path=f"work-orders/{uploaded_file_name}")
     DeleteData("WorkOrder", {"id": work_order_id})
+    DeleteData("MetricsCube", {"workOrderId": work_order_id}, True)
+    invalidate_cache("workOrder", "client", "organization", "metrics", org_id=requestor.orgId)
+    invalidate_cache("currency")
     return {"status": "acknowledged"}
 
 
+@router.get("/workOrder/charge/overlaps", tags=["work_orders"],
+            dependencies=[Depends(JWTRequired), Depends(OrgAdminAccess)])
+async def time_charge_overlaps(
+        start: datetime = Query(..., description="Period start"),
+        end: datetime = Query(..., description="Period end"),
+        user_id: Optional[str] = Query(None, description="Only this user"),
+        requestor=Depends(validate_jwt_token)
+):
+    users = [
+        user["id"] for user in MultiDataReader("User", {"orgId": requestor.orgId}, {"_id": 0, "id": 1})
+    ]
+    if user_id:
+        users = [user for user in users if user == user_id]
+    # Sorted by the (chargedById, startTime) index, the overlaps come out of one pass
+    time_charges = MultiDataReader(
+        "Timesheet",
+        {"chargedById": {"$in": users}, "startTime": {"$lt": end}, "endTime": {"$gt": start}},
+        {"_id": 0, "id": 1, "chargedById": 1, "workOrderId": 1, "description": 1, "startTime": 1, "endTime": 1},
+    ).sort([("chargedById", 1), ("startTime", 1)])
+    return await run_in_threadpool(find_overlaps, time_charges)
+
+
+TIMESHEET_EXPORT_COLUMNS = ["id", "description", "startTime", "endTime", "hours", "chargedById", "invoiced", "invoiceId"]
+
+
+def timesheet_export_rows(time_charges):
+    for time_charge in time_charges:
+        hours = round((time_charge["endTime"] - time_charge["startTime"]).total_seconds() / 3600, 2)
+        yield [
+            time_charge["id"],
+            time_charge["description"],
+            time_charge["startTime"],
+            time_charge["endTime"],
+            hours,
+            time_charge.get("chargedById"),
+            time_charge.get("invoiced", False),
+            time_charge.get("invoiceId"),
+        ]
+
+
+@router.get("/workOrder/export/{work_order_id}", tags=["work_orders"],
+            dependencies=[Depends(JWTRequired), Depends(OrgAdminAccess)])
+async def export_timesheet(
+        work_order_id: str,
+        request: Request,
+        start: Optional[datetime] = Query(None, description="Charges starting from"),
+        end: Optional[datetime] = Query(None, description="Charges starting before"),
+        format: str = Query("csv", regex="^(csv|xlsx)$"),
+        compress: Optional[str] = Query(None, regex="^gzip$", description="gzip the file"),
+        requestor=Depends(validate_jwt_token)
+):
+    work_order = await load("WorkOrder", work_order_id)
+    client = await load("Client", work_order["clientId"]) if work_order else None
+    if not client or client["orgId"] != requestor.orgId:
+        raise HTTPException(
+            detail="Invalid Work-Order id",
+            status_code=HTTP_400_BAD_REQUEST,
+        )
+    query = {"workOrderId": work_order_id}
+    if start or end:
+        query["startTime"] = {}
+        if start:
+            query["startTime"]["$gte"] = start
+        if end:
+            query["startTime"]["$lt"] = end
+
+    def chunks():
+        # Called before the response starts, a failed read still gets a proper error
+        time_charges = MultiDataReader("Timesheet", query, {"_id": 0})
+        if time_charges is None:
+            raise HTTPException(
+                detail="Time charges could not be read",
+                status_code=HTTP_400_BAD_REQUEST,
+            )
+        rows = timesheet_export_rows(time_charges.sort("startTime", 1).batch_size(EXPORT_CHUNK_ROWS))
+        return export_chunks(format, TIMESHEET_EXPORT_COLUMNS, rows, "Timesheet", compress is not None)
+
+    watermark = await run_in_threadpool(data_watermark, "Timesheet", query, "updatedAt")
+    return await export_response(
+        request, requestor.orgId, watermark, f"timesheet-{work_order_id}", format, compress is not None, chunks
+    )
+
+
 @router.get("/workOrder/charge/{work_order_id}", tags=["work_orders"],
             dependencies=[Depends(JWTRequired), Depends(OrgStaffAccess)])
 async def week_summary(
@@ -482,127 +523,72 @@ async def week_summary(
         end_date: Optional[datetime] = Query(None),
         requestor=Depends(validate_jwt_token)
 ):
-    work_order = SingleDataReader("WorkOrder", {"id": work_order_id})
+    work_order = await load("WorkOrder", work_order_id)
     if not work_order:
         raise HTTPException(
             detail="Invalid Work-Order id",
             status_code=HTTP_400_BAD_REQUEST,
         )
-    timesheets = None
     work_order = WorkOrder(**work_order)
     if start_date and end_date:
-        pipeline = [
-            {
-                "$match": {
-                    "workOrderId": work_order_id,
-                    "startTime": {"$gte": start_date},
-                    "endTime": {"$lte": end_date},
-                    "chargedById": requestor.id,
-                }
-            },
-            {
-                "$sort": {"startTime": 1}
-            },
-            {
-                "$project": {
-                    "_id": 0
-                }
-            }
-        ]
-        timesheets = DataAggregation("Timesheet", pipeline)
+        match = {
+            "workOrderId": work_order_id,
+            "startTime": {"$gte": start_date},
+            "endTime": {"$lte": end_date},
+            "chargedById": requestor.id,
+        }
     elif start_date and not end_date:
-        pipeline = [
-            {
-                "$match": {
-                    "workOrderId": work_order_id,
-                    "startTime": {"$gte": start_date}
-                }
-            },
-            {
-                "$project": {
-                    "_id": 0
-                }
-            }
-        ]
-        timesheets = DataAggregation("Timesheet", pipeline)
+        match = {
+            "workOrderId": work_order_id,
+            "startTime": {"$gte": start_date}
+        }
     elif not start_date and end_date:
-        pipeline = [
-            {
-                "$match": {
-                    "workOrderId": work_order_id,
-                    "endTime": {"$lte": end_date}
-                }
-            },
-            {
-                "$project": {
-                    "_id": 0
-                }
-            }
-        ]
-        timesheets = DataAggregation("Timesheet", pipeline)
+        match = {
+            "workOrderId": work_order_id,
+            "endTime": {"$lte": end_date}
+        }
     else:
-        timesheets = MultiDataReader("Timesheet", {"workOrderId": work_order_id})
-    data = []
-    total_duration = 0
-    max_duration = 0
-    if len(timesheets) > 0:
-        df = pd.DataFrame(list(map(lambda x: x.dict(), timesheets)))
-        df = df[["id", "description", "startTime", "endTime", "invoiced"]]
-        df["duration"] = df["endTime"] - df["startTime"]
-        df["date"] = df["startTime"].dt.date
-        grouped_df = df.groupby("date")["duration"].sum().reset_index()
-        total_duration = grouped_df["duration"].sum()
-        max_duration = grouped_df["duration"].max()
-        data = grouped_df.to_dict("records")
-        for day in data:
-            day_data = df[df["date"] == day["date"]]
-            day_data["duration"] = day_data.apply(
-                lambda x: format_seconds_to_hr_mm(x.duration.total_seconds()), axis=1
-            )
-            day["timesheets"] = day_data.to_dict("records")
-    current_date = start_date
-    while current_date <= end_date:
-        date_to_search = current_date.date()
-        if not any(day["date"] == date_to_search for day in data):
-            data.append(
-                {
-                    "date": date_to_search,
-                    "duration": "0:00 hrs",
-                    "pct": 0,
-                    "invoiced": date_to_search < work_order.startDate.date()
-                                or date_to_search < CUT_OFF_DATE.date(),
-                    "timesheets": [],
-                }
-            )
-        else:
-            day = next((day for day in data if day["date"] == date_to_search), None)
-            day_duration = day["duration"]
+        match = {"workOrderId": work_order_id}
 
-            charge_df = df[df["date"] == date_to_search]
-            invoiced_list = charge_df["invoiced"].tolist()
-            day["invoiced"] = (
-                    len(set(invoiced_list)) == 1 and list(set(invoiced_list))[0] == True
-            )
-
-            day["pct"] = round(
-                (day["duration"].total_seconds() / max_duration.total_seconds()) * 100,
-                0,
-            )
-            hours = int(day_duration.total_seconds() // 3600)
-            minutes = int((day_duration.total_seconds() // 60) % 60)
-
-            if minutes == 0:
-                day["duration"] = f"{hours}:00 hrs"
-            else:
-                day["duration"] = f"{hours}:{minutes} hrs"
-        current_date += timedelta(days=1)
-    total_duration = total_duration if total_duration else timedelta(seconds=0)
-    sorted_data = sorted(data, key=lambda x: x["date"])
-    return {
-        "total_duration": format_seconds_to_hr_mm(total_duration.total_seconds()),
-        "total_duration_numeric": round(total_duration.total_seconds() / 3600, 2),
-        "details": sorted_data,
-    }
+    # Group the charges per day on the server so only one row per day leaves the database
+    pipeline = [
+        {
+            "$match": match
+        },
+        {
+            "$sort": {"startTime": 1}
+        },
+        {
+            "$group": {
+                "_id": {"$dateTrunc": {"date": "$startTime", "unit": "day"}},
+                "duration": {"$sum": {"$subtract": ["$endTime", "$startTime"]}},
+                "invoiced": {"$min": "$invoiced"},
+                "timesheets": {
+                    "$push": {
+                        "id": "$id",
+                        "description": "$description",
+                        "startTime": "$startTime",
+                        "endTime": "$endTime",
+                        "invoiced": "$invoiced",
+                    }
+                },
+            }
+        },
+        {
+            "$sort": {"_id": 1}
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "date": "$_id",
+                "duration": 1,
+                "invoiced": 1,
+                "timesheets": 1,
+            }
+        }
+    ]
+    charged_days = DataAggregation("Timesheet", pipeline)
+    return summarize_charged_days(charged_days, start_date, end_date, work_order)
 
 
 @router.get("/workOrder/statistics/{work_order_id}", tags=["work_orders"],
@@ -610,78 +596,85 @@ async def week_summary(
 async def monthly_summary(
         work_order_id: str,
         date: datetime = Query(None),
+        range_months: int = Query(1, alias="range", ge=1, le=12),
         requestor=Depends(validate_jwt_token)
 ):
-    work_order = SingleDataReader("WorkOrder", {"id": work_order_id})
+    work_order = await load("WorkOrder", work_order_id)
     if not work_order:
         raise HTTPException(
             detail="Invalid Work-Order id",
             status_code=HTTP_400_BAD_REQUEST,
         )
 
-    month, year = date.month, date.year
-
-    start_of_month = datetime(year, month, 1)
+    months = month_starts(date or datetime.now(), range_months)
+    period_end = months[-1] + timedelta(days=days_in_month(months[-1]))
 
-    next_month = start_of_month.replace(day=28) + timedelta(days=4)
-    end_of_month = next_month - timedelta(days=next_month.day)
-    end_of_month = end_of_month.replace(hour=23, minute=59, second=59)
-    current_date = start_of_month
+    # Every rollup row is one day, so summing 2^(day - 1) per month builds the day bitmaps
+    day_bit = {"$toLong": {"$pow": [2, {"$subtract": [{"$dayOfMonth": "$date"}, 1]}]}}
     pipeline = [
         {
             "$match": {
                 "workOrderId": work_order_id,
-                "startTime": {"$gte": start_of_month, "$lte": end_of_month},
                 "chargedById": requestor.id,
+                "date": {"$gte": months[0], "$lt": period_end},
             }
         },
         {
-            "$sort": {"startTime": 1}
+            "$group": {
+                "_id": {"$dateTrunc": {"date": "$date", "unit": "month"}},
+                "seconds": {"$sum": "$seconds"},
+                "invoicedSeconds": {"$sum": "$invoicedSeconds"},
+                "chargedDays": {"$sum": day_bit},
+                "invoicedDays": {"$sum": {"$cond": ["$invoiced", day_bit, 0]}},
+            }
         },
         {
             "$project": {
-                "_id": 0
+                "_id": 0,
+                "month": "$_id",
+                "seconds": 1,
+                "invoicedSeconds": 1,
+                "chargedDays": 1,
+                "invoicedDays": 1,
             }
         }
     ]
+    charged_months = {row["month"]: row for row in DataAggregation("TimesheetDaily", pipeline)}
 
-    time_charges = DataAggregation("Timesheet", pipeline)
-    available_days = []
-    total_invoiced_seconds = timedelta(seconds=0)
-    total_charged_seconds = timedelta(seconds=0)
-    if len(time_charges) > 0:
-        df = pd.DataFrame(list(map(lambda x: x.dict(), time_charges)))
-        df["date"] = df["startTime"].dt.date
-        grouped_df = df.groupby("date")["id"].count().reset_index()
-        available_days = grouped_df["date"].tolist()
-        df["duration"] = df["endTime"] - df["startTime"]
-        total_invoiced_seconds = df[df["invoiced"] == True]["duration"].sum()
-        total_charged_seconds = df["duration"].sum()
+    total_invoiced_seconds = 0
+    total_charged_seconds = 0
     day_info = []
-    while current_date <= end_of_month:
-        if current_date.date() in available_days:
-            charges = df[df["date"] == current_date.date()]
-            invoiced_list = charges["invoiced"].tolist()
-            day_is_invoiced = not False in invoiced_list
-            day_is_charged = True
-        else:
-            day_is_invoiced = False
-            day_is_charged = False
-
-        day_info.append(
+    month_info = []
+    for month_start in months:
+        row = charged_months.get(month_start, {})
+        charged_days = row.get("chargedDays", 0)
+        invoiced_days = row.get("invoicedDays", 0)
+        total_invoiced_seconds += row.get("invoicedSeconds", 0)
+        total_charged_seconds += row.get("seconds", 0)
+        for day in range(days_in_month(month_start)):
+            day_info.append(
+                {
+                    "date": (month_start + timedelta(days=day)).isoformat(),
+                    "isInvoiced": bool(invoiced_days >> day & 1),
+                    "isCharged": bool(charged_days >> day & 1),
+                }
+            )
+        month_info.append(
             {
-                "date": current_date.isoformat(),
-                "isInvoiced": day_is_invoiced,
-                "isCharged": day_is_charged,
+                "month": month_start.strftime("%Y-%m"),
+                "days": days_in_month(month_start),
+                "chargedDays": charged_days,
+                "invoicedDays": invoiced_days,
+                "invoiced": format_seconds_to_hr_mm(row.get("invoicedSeconds", 0)),
+                "charged": format_seconds_to_hr_mm(row.get("seconds", 0)),
             }
         )
 
-        current_date += timedelta(days=1)
-
     return {
         "detail": day_info,
-        "invoiced": format_seconds_to_hr_mm(total_invoiced_seconds.total_seconds()),
-        "charged": format_seconds_to_hr_mm(total_charged_seconds.total_seconds()),
+        "months": month_info,
+        "invoiced": format_seconds_to_hr_mm(total_invoiced_seconds),
+        "charged": format_seconds_to_hr_mm(total_charged_seconds),
     }
 
 
@@ -692,7 +685,7 @@ async def charge_time(
         work_order_id: str,
         requestor=Depends(validate_jwt_token)
 ):
-    work_order = SingleDataReader("WorkOrder", {"id": work_order_id})
+    work_order = await load("WorkOrder", work_order_id)
     if not work_order:
         raise HTTPException(
             detail="Invalid Work-Order id",
@@ -704,14 +697,122 @@ async def charge_time(
             detail="Start Time Cannot be greater than the endTime",
             status_code=HTTP_400_BAD_REQUEST,
         )
+    if time_to_charge.endTime - time_to_charge.startTime > MAX_TIME_CHARGE:
+        raise HTTPException(
+            detail=TIME_CHARGE_TOO_LONG,
+            status_code=HTTP_400_BAD_REQUEST,
+        )
     time_charge = time_to_charge.dict()
     time_charge["chargedById"] = requestor.id
     time_charge["workOrderId"] = work_order_id
     time_sheet = TimesheetDB(**time_charge)
-    DataWriter("Timesheet", time_sheet.dict())
+
+    def record(session):
+        lock_time_charges(requestor.id, session)
+        overlapping = overlapping_time_charge(
+            requestor.id, time_to_charge.startTime, time_to_charge.endTime, session
+        )
+        if not overlapping:
+            DataWriter("Timesheet", time_sheet.dict(), session=session)
+        return overlapping
+
+    overlapping = await run_in_threadpool(RunTransaction, record)
+    if overlapping:
+        raise HTTPException(
+            detail=f"Overlaps the time charged from {overlapping['startTime']} to {overlapping['endTime']}",
+            status_code=HTTP_400_BAD_REQUEST,
+        )
+    refresh_timesheet_daily([time_sheet.dict()])
+    apply_time_charge_metrics(requestor.orgId, work_order, [time_sheet.dict()])
+    invalidate_cache("workOrder", "metrics", org_id=requestor.orgId)
     return time_sheet
 
 
+async def charge_time_rows(work_order_id: str, rows: list, requestor) -> dict:
+    """Validate and insert many time charges of the requestor on one work order"""
+    work_order = await load("WorkOrder", work_order_id)
+    if not work_order:
+        raise HTTPException(
+            detail="Invalid Work-Order id",
+            status_code=HTTP_400_BAD_REQUEST,
+        )
+    if not rows:
+        raise HTTPException(
+            detail="No time charges given",
+            status_code=HTTP_400_BAD_REQUEST,
+        )
+    if len(rows) > BULK_CHARGE_MAX_ROWS:
+        raise HTTPException(
+            detail=f"At most {BULK_CHARGE_MAX_ROWS} time charges per request",
+            status_code=HTTP_400_BAD_REQUEST,
+        )
+
+    def record(session):
+        lock_time_charges(requestor.id, session)
+        timesheets, errors = prepare_time_charges(rows, work_order_id, requestor.id, session)
+        documents = [timesheet.dict() for timesheet in timesheets]
+        # insert_many adds _id to the documents it is given
+        copies = [dict(document) for document in documents]
+        if copies and DataWriter("Timesheet", copies, True, session=session) is None:
+            # Without a transaction an ordered insert_many stops at its first failure, keep what was written
+            saved = {
+                timesheet["id"]
+                for timesheet in MultiDataReader(
+                    "Timesheet", {"id": {"$in": [document["id"] for document in documents]}}, {"_id": 0, "id": 1}
+                ) or []
+            }
+            failed = {row["row"] for row in errors}
+            valid_rows = [row for row in range(1, len(rows) + 1) if row not in failed]
+            errors = sorted(errors + [
+                {"row": row, "detail": "Time charge could not be saved"}
+                for row, document in zip(valid_rows, documents) if document["id"] not in saved
+            ], key=lambda error: error["row"])
+            documents = [document for document in documents if document["id"] in saved]
+        return documents, errors
+
+    try:
+        documents, errors = await run_in_threadpool(RunTransaction, record)
+    except PyMongoError:
+        # Inside a transaction a failed insert aborts it, nothing was written
+        raise HTTPException(
+            detail="Time charges could not be saved",
+            status_code=HTTP_400_BAD_REQUEST,
+        )
+    if documents:
+        refresh_timesheet_daily(documents)
+        apply_time_charge_metrics(requestor.orgId, work_order, documents)
+        invalidate_cache("workOrder", "metrics", org_id=requestor.orgId)
+    return {"charged": len(documents), "timesheets": documents, "errors": errors}
+
+
+@router.post("/workOrder/charge/bulk/{work_order_id}", tags=["work_orders"],
+             dependencies=[Depends(JWTRequired), Depends(OrgStaffAccess)])
+async def bulk_charge_time(
+        time_charges: List[dict],
+        work_order_id: str,
+        requestor=Depends(validate_jwt_token)
+):
+    # Rows are validated one by one in prepare_time_charges, so a bad row is reported instead of failing the request
+    return await charge_time_rows(work_order_id, time_charges, requestor)
+
+
+@router.post("/workOrder/charge/bulk/{work_order_id}/csv", tags=["work_orders"],
+             dependencies=[Depends(JWTRequired), Depends(OrgStaffAccess)])
+async def bulk_charge_time_csv(
+        work_order_id: str,
+        document: UploadFile = File(..., description="CSV with description, startTime and endTime columns"),
+        requestor=Depends(validate_jwt_token)
+):
+    try:
+        rows = parse_time_charges_csv(document.file.read())
+    except ValueError as e:
+        raise HTTPException(
+            detail=str(e),
+            status_code=HTTP_400_BAD_REQUEST,
+        )
+    return await charge_time_rows(work_order_id, rows, requestor)
+
+
 @router.post("/workOrder/charge/edit/{timesheet_id}", tags=["work_orders"],
              dependencies=[Depends(JWTRequired), Depends(OrgStaffAccess)])
 async def update_charged_time(
@@ -719,7 +820,7 @@ async def update_charged_time(
         timesheet_id: str,
         requestor=Depends(validate_jwt_token)
 ):
-    timesheet = SingleDataReader("Timesheet", {"id": timesheet_id})
+    timesheet = await load("Timesheet", timesheet_id)
     if not timesheet:
         raise HTTPException(
             detail="Invalid Timesheet id",
@@ -727,9 +828,13 @@ async def update_charged_time(
         )
     timesheet = TimesheetDB(**timesheet)
     if update_info.description and update_info.description != timesheet.description:
-        UpdateWriter("Timesheet", {"id": timesheet_id}, {"description": update_info.description})
-        timesheet = SingleDataReader("Timesheet", {"id": timesheet_id})
-        timesheet = TimesheetDB(**timesheet)
+        UpdateWriter(
+            "Timesheet", {"id": timesheet_id}, {"description": update_info.description, **UpdatedAt().dict()}
+        )
+        loader("Timesheet").forget(timesheet_id)
+        timesheet.description = update_info.description
+        refresh_timesheet_daily([timesheet.dict()])
+        invalidate_cache("workOrder", org_id=requestor.orgId)
 
     return timesheet
 
@@ -740,7 +845,7 @@ async def delete_charged_time(
         timesheet_id: str,
         requestor=Depends(validate_jwt_token)
 ):
-    timesheet = SingleDataReader("Timesheet", {"id": timesheet_id})
+    timesheet = await load("Timesheet", timesheet_id)
     if not timesheet:
         raise HTTPException(
             detail="Invalid Timesheet id",
@@ -748,6 +853,11 @@ async def delete_charged_time(
         )
 
     DeleteData("Timesheet", {"id": timesheet_id})
+    refresh_timesheet_daily([timesheet])
+    work_order = await load("WorkOrder", timesheet["workOrderId"])
+    if work_order:
+        apply_time_charge_metrics(requestor.orgId, work_order, [timesheet], -1)
+    invalidate_cache("workOrder", "metrics", org_id=requestor.orgId)
 
     return {"status": "acknowledged"}
 
@@ -905,33 +1015,14 @@ async def download_work_order_document(
         )
     work_order = WorkOrder(**work_order[0])
 
-    pipeline = [
-        {
-            "$match": {
-                "workOrderId": work_order.id,
-                "startTime": {"$gte": details.start},
-                "endTime": {"$lte": details.end},
-            }
-        },
-        {
-            "$sort": {"startTime": 1}
-        },
-        {
-            "$project": {
-                "_id": 0
-            }
-        }
-    ]
-
-    time_charges = DataAggregation("Timesheet", pipeline)
-
-    if len(time_charges) == 0:
+    days = timesheet_calendar_days([work_order.id], details.start, details.end).get(work_order.id)
+    if not days:
         raise HTTPException(
             detail="No time charges found",
             status_code=HTTP_400_BAD_REQUEST,
         )
 
-    _, report = generate_timesheet_calendar(time_charges, details, work_order)
+    _, report = generate_timesheet_calendar(days, details, work_order)
     return Response(report, status_code=200, media_type="application/pdf")
 
 
@@ -950,7 +1041,7 @@ async def download_work_order_document(
         {"$match": {"id": details.work_order_id}},
         {
             "$lookup": {
-                "from": "Clients",
+                "from": "Client",
                 "localField": "clientId",
                 "foreignField": "id",
                 "as": "client"
@@ -958,7 +1049,7 @@ async def download_work_order_document(
         },
         {
             "$lookup": {
-                "from": "Organizations",
+                "from": "Organization",
                 "localField": "client.orgId",
                 "foreignField": "id",
                 "as": "client.organization"
@@ -993,46 +1084,16 @@ async def download_work_order_document(
             detail="Invalid Work-Order id",
             status_code=HTTP_400_BAD_REQUEST,
         )
-    # time_charges = await prisma.timesheet.find_many(
-    #     where={
-    #         "workOrderId": work_order.id,
-    #         "startTime": {"gte": details.start},
-    #         "endTime": {"lte": details.end},
-    #     },
-    #     order={
-    #         "startTime": "asc",
-    #     },
-    # )
-
-    pipeline = [
-        {
-            "$match": {
-                "workOrderId": work_order.id,
-                "startTime": {"$gte": details.start},
-                "endTime": {"$lte": details.end}
-            }
-        },
-        {
-            "$sort": {
-                "startTime": 1
-            }
-        },
-        {
-            "$project": {
-                "_id": 0
-            }
-        }
-    ]
-
-    time_charges = DataAggregation("Timesheet", pipeline)
+    work_order = WorkOrderWithClient(**work_order[0])
 
-    if len(time_charges) == 0:
+    days = timesheet_calendar_days([work_order.id], details.start, details.end).get(work_order.id)
+    if not days:
         raise HTTPException(
             detail="No time charges found",
             status_code=HTTP_400_BAD_REQUEST,
         )
 
-    total_hours, report = generate_timesheet_calendar(time_charges, details, work_order)
+    total_hours, report = generate_timesheet_calendar(days, details, work_order)
     data = {
         "requestor_name": requestor.name,
         "requestor_email": requestor.email,
@@ -1047,3 +1108,93 @@ async def download_work_order_document(
         to_list=details.to, cc_list=cc_list, report=report, template_data=data
     )
     return Response(report, status_code=200, media_type="application/pdf")
+
+
+@router.post("/workOrder/timesheet/send/bulk", tags=["work_orders"],
+             dependencies=[Depends(JWTRequired), Depends(OrgAdminAccess)])
+async def bulk_send_timesheets(
+        details: BulkTimeChargeMail,
+        requestor=Depends(validate_jwt_token)
+):
+    pipeline = [
+        {"$match": {"id": {"$in": details.work_order_ids}}},
+        {
+            "$lookup": {
+                "from": "Client",
+                "localField": "clientId",
+                "foreignField": "id",
+                "as": "client"
+            }
+        },
+        {
+            "$unwind": "$client"
+        },
+        {
+            "$match": {"client.orgId": requestor.orgId}
+        },
+        {
+            "$lookup": {
+                "from": "Organization",
+                "localField": "client.orgId",
+                "foreignField": "id",
+                "as": "client.organization"
+            }
+        },
+        {
+            "$unwind": "$client.organization"
+        },
+        {
+            "$project": {
+                "_id": 0
+            }
+        },
+        {
+            "$unset": ["client.organization._id", "client._id"]
+        }
+    ]
+    work_orders = {
+        work_order["id"]: WorkOrderWithClient(**work_order)
+        for work_order in DataAggregation("WorkOrder", pipeline)
+    }
+
+    days = await run_in_threadpool(timesheet_calendar_days, list(work_orders), details.start, details.end)
+
+    results = []
+    reportable = []
+    for work_order_id in details.work_order_ids:
+        if work_order_id not in work_orders:
+            results.append({"id": work_order_id, "status": "failed", "detail": "Invalid Work-Order id"})
+        elif work_order_id not in days:
+            results.append({"id": work_order_id, "status": "failed", "detail": "No time charges found"})
+        else:
+            reportable.append(work_orders[work_order_id])
+
+    reports = await asyncio.gather(
+        *[
+            run_in_threadpool(generate_timesheet_calendar, days[work_order.id], details, work_order)
+            for work_order in reportable
+        ]
+    )
+
+    cc_list = details.cc + [requestor.email]
+    for work_order, (total_hours, report) in zip(reportable, reports):
+        data = {
+            "requestor_name": requestor.name,
+            "requestor_email": requestor.email,
+            "start_date": datetime.strftime(details.start, "%Y-%m-%d"),
+            "end_date": datetime.strftime(details.end, "%Y-%m-%d"),
+            "billable_hours": total_hours,
+            "org_name": work_order.client.organization.name,
+        }
+        queued = await send_timesheet(
+            to_list=details.to, cc_list=cc_list, report=report, template_data=data
+        )
+        results.append(
+            {
+                "id": work_order.id,
+                "status": "queued" if queued else "failed",
+                "billable_hours": total_hours,
+            }
+        )
+
+    return {"results": results}
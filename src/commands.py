@@ -0,0 +1,204 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+from src.apis.organization import ORGANIZATION_RELATIONS, organization_pipeline
+from src.config.database import DataAggregation, EnsureIndexes
+from src.utils.analytics import rebuild_cash_flow
+from src.utils.date_time import month_starts
+from src.utils.exports import clear_exports
+from src.utils.ledger import rebuild_ledger
+from src.utils.metrics import rebuild_metrics
+from src.utils.snapshots import snapshot_analytics
+from src.utils.timesheet import TOP_DESCRIPTIONS, fold_calendar_days, rebuild_timesheet_daily, timesheet_calendar_data
+
+
+def rebuild_timesheet_daily_command(args):
+    EnsureIndexes()
+    rebuild_timesheet_daily(args.work_order_id)
+    print("TimesheetDaily rebuilt", flush=True)
+
+
+def rebuild_ledger_command(args):
+    EnsureIndexes()
+    rebuild_ledger(args.org_id)
+    clear_exports()
+    print("Ledger rebuilt", flush=True)
+
+
+def rebuild_analytics_command(args):
+    EnsureIndexes()
+    if not args.skip_ledger:
+        rebuild_ledger(args.org_id)
+        clear_exports()
+    rebuild_cash_flow(args.org_id)
+    print("Cash flow aggregates rebuilt", flush=True)
+
+
+def rebuild_metrics_command(args):
+    EnsureIndexes()
+    rebuild_metrics(args.org_id)
+    print("Metrics cube rebuilt", flush=True)
+
+
+def snapshot_analytics_command(args):
+    snapshot_analytics(args.org_id)
+    print("Analytics snapshot written", flush=True)
+
+
+def synthetic_rollups(start: datetime, days: int, users: int, per_day: int) -> list:
+    """TimesheetDaily rows of users charging per_day descriptions a day, descriptions repeating across days"""
+    rollups = []
+    for day in range(days):
+        for user in range(users):
+            descriptions = [
+                {"description": f"Task {(day * 3 + user + slot) % 40}", "seconds": 2700 - slot, "longest": 2700 - slot}
+                for slot in range(per_day)
+            ]
+            rollups.append({
+                "workOrderId": "benchmark",
+                "date": start + timedelta(days=day),
+                "seconds": sum(description["seconds"] for description in descriptions),
+                "descriptions": descriptions[:TOP_DESCRIPTIONS],
+            })
+    return rollups
+
+
+def benchmark_calendar_command(args):
+    start = datetime(2023, 1, 1)
+    for months in args.months:
+        end = month_starts(start, months + 1)[-1] - timedelta(days=1)
+        rollups = synthetic_rollups(start, (end - start).days + 1, args.users, args.charges_per_day)
+        timings = []
+        for _ in range(args.repeat):
+            began = time.perf_counter()
+            timesheet_calendar_data(fold_calendar_days(rollups)["benchmark"], start, end)
+            timings.append((time.perf_counter() - began) * 1000)
+        print(
+            f"{months:>3} month(s), {len(rollups):>6} daily rollups: "
+            f"median {statistics.median(timings):8.1f} ms, best {min(timings):8.1f} ms",
+            flush=True,
+        )
+
+
+def unprojected_organization_pipeline(org_id: str) -> list:
+    """Organization detail with whole related documents, the baseline the projected lookups are compared to"""
+    return [{"$match": {"id": org_id}}] + [
+        {"$lookup": {"from": collection_name, "localField": "id", "foreignField": "orgId", "as": name}}
+        for name, (collection_name, _) in ORGANIZATION_RELATIONS.items()
+    ] + [{"$project": {"_id": 0}}]
+
+
+def benchmark_payload_command(args):
+    variants = [("unprojected", unprojected_organization_pipeline(args.org_id))]
+    variants.append(("include=<default>", organization_pipeline({"id": args.org_id})))
+    variants += [
+        (f"include={name}", organization_pipeline({"id": args.org_id}, [name])) for name in ORGANIZATION_RELATIONS
+    ]
+    variants.append(("include=", organization_pipeline({"id": args.org_id}, [])))
+    for label, pipeline in variants:
+        timings = []
+        for _ in range(args.repeat):
+            began = time.perf_counter()
+            organization = DataAggregation("Organization", pipeline)
+            timings.append((time.perf_counter() - began) * 1000)
+        if not organization:
+            print(f"Organization {args.org_id} not found", flush=True)
+            sys.exit(1)
+        size = len(json.dumps(organization[0], default=str).encode("utf-8"))
+        print(f"{label:<20} {size / 1024:>10.1f} KiB  median {statistics.median(timings):8.1f} ms", flush=True)
+
+
+# Dependencies that must only be imported on first use, never while the app starts
+LAZY_MODULES = ("pandas", "numpy", "azure", "pdfkit")
+
+
+def import_profile_command(args):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import manage"],
+        capture_output=True,
+        text=True,
+    )
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules.append((name.strip(), int(self_us), int(cumulative_us)))
+
+    total_ms = sum(self_us for _, self_us, _ in modules) / 1000
+    print(f"Startup imports: {len(modules)} modules in {total_ms:.0f} ms (budget {args.budget_ms} ms)")
+    for name, _, cumulative_us in sorted(modules, key=lambda x: x[2], reverse=True)[:args.top]:
+        print(f"{cumulative_us / 1000:>10.1f} ms  {name}")
+
+    eager = sorted({name for name, _, _ in modules if name.split(".")[0] in LAZY_MODULES})
+    if eager:
+        print("Imported at startup but expected to be lazy:", ", ".join(eager))
+    if result.returncode != 0 or eager or total_ms > args.budget_ms:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GoApp maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    rebuild_daily = commands.add_parser("rebuild-timesheet-daily", help="Backfill the TimesheetDaily rollups")
+    rebuild_daily.add_argument("--work-order-id", default=None, help="Only rebuild this work order")
+    rebuild_daily.set_defaults(func=rebuild_timesheet_daily_command)
+
+    rebuild_ledger_parser = commands.add_parser("rebuild-ledger", help="Backfill ledger entries and snapshots")
+    rebuild_ledger_parser.add_argument("--org-id", default=None, help="Only rebuild this organization")
+    rebuild_ledger_parser.set_defaults(func=rebuild_ledger_command)
+
+    rebuild_analytics = commands.add_parser(
+        "rebuild-analytics", help="Backfill the ledger and the monthly cash flow aggregates"
+    )
+    rebuild_analytics.add_argument("--org-id", default=None, help="Only rebuild this organization")
+    rebuild_analytics.add_argument("--skip-ledger", action="store_true", help="Reuse the current ledger entries")
+    rebuild_analytics.set_defaults(func=rebuild_analytics_command)
+
+    rebuild_metrics_parser = commands.add_parser(
+        "rebuild-metrics", help="Recompute the revenue and utilization metrics cube, e.g. nightly"
+    )
+    rebuild_metrics_parser.add_argument("--org-id", default=None, help="Only rebuild this organization")
+    rebuild_metrics_parser.set_defaults(func=rebuild_metrics_command)
+
+    snapshot = commands.add_parser(
+        "snapshot-analytics", help="Write the columnar snapshots the reports read, run it periodically"
+    )
+    snapshot.add_argument("--org-id", default=None, help="Only snapshot this organization")
+    snapshot.set_defaults(func=snapshot_analytics_command)
+
+    benchmark_calendar = commands.add_parser(
+        "benchmark-calendar", help="Time the timesheet calendar build over synthetic daily rollups"
+    )
+    benchmark_calendar.add_argument(
+        "--months", type=int, nargs="+", default=[1, 12, 60], help="Lengths of the calendar periods"
+    )
+    benchmark_calendar.add_argument("--users", type=int, default=3, help="Users charging time on every day")
+    benchmark_calendar.add_argument("--charges-per-day", type=int, default=8, help="Descriptions per user and day")
+    benchmark_calendar.add_argument("--repeat", type=int, default=5, help="Runs per period length")
+    benchmark_calendar.set_defaults(func=benchmark_calendar_command)
+
+    benchmark_payload = commands.add_parser(
+        "benchmark-payload", help="Compare organization detail sizes with and without include="
+    )
+    benchmark_payload.add_argument("--org-id", required=True, help="Organization to read, ideally a large one")
+    benchmark_payload.add_argument("--repeat", type=int, default=5, help="Reads per variant")
+    benchmark_payload.set_defaults(func=benchmark_payload_command)
+
+    import_profile = commands.add_parser("import-profile", help="Report the import time of the app startup")
+    import_profile.add_argument("--budget-ms", type=int, default=2000, help="Fail above this total import time")
+    import_profile.add_argument("--top", type=int, default=20, help="Number of slowest imports to list")
+    import_profile.set_defaults(func=import_profile_command)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@ import sys
 import traceback
 import urllib
 
+from pymongo import ReturnDocument
 from pymongo.mongo_client import MongoClient
 from bson import json_util
 from pymongo.server_api import ServerApi
@@ -10,7 +11,16 @@ from pymongo.server_api import ServerApi
 from src.models.db_models import CollectionName
 
 
+_mongo_database = None
+_transactions_supported = None
+
+
 def getMongoClient():
+    """Database handle on a process-wide MongoClient, the client keeps its own connection pool"""
+    global _mongo_database
+    if _mongo_database is not None:
+        return _mongo_database
+
     username = urllib.parse.quote_plus(f"{os.getenv('MONGO_DB_USER')}")
     password = urllib.parse.quote_plus(f"{os.getenv('MONGO_DB_PASSWORD')}")
     host = os.getenv("MONGO_HOST_NAME")
@@ -24,23 +34,56 @@ def getMongoClient():
         client.admin.command("ping")
         cursor = client["GoApp"]
         print(cursor, flush=True)
+        _mongo_database = cursor
         return cursor
     except Exception as e:
         print(e)
         return None
 
 
+def TransactionsSupported() -> bool:
+    """Multi-document transactions need a replica set or a sharded cluster"""
+    global _transactions_supported
+    if _transactions_supported is None:
+        setting = os.getenv("MONGO_TRANSACTIONS", "auto").lower()
+        if setting in ("auto", ""):
+            try:
+                hello = getMongoClient().client.admin.command("hello")
+                _transactions_supported = bool(hello.get("setName")) or hello.get("msg") == "isdbgrid"
+            except Exception as e:
+                print(e)
+                _transactions_supported = False
+        else:
+            _transactions_supported = setting in ("1", "true", "yes")
+    return _transactions_supported
+
+
+def RunTransaction(callback):
+    """Run callback(session) as one multi-document transaction
+
+    The helpers below take that session and re-raise their errors inside it, so a
+    failing write aborts the whole transaction. On a standalone server callback(None)
+    runs the same writes without a transaction.
+    """
+    if not TransactionsSupported():
+        return callback(None)
+    with getMongoClient().client.start_session() as session:
+        return session.with_transaction(callback)
+
+
 # Single point of contact(DataReader)
-def SingleDataReader(collection_name, data, requiredFields=None):
+def SingleDataReader(collection_name, data, requiredFields=None, session=None, sort=None):
     try:
         cursor = getMongoClient()
         collection = cursor[collection_name]
         if requiredFields is None:
-            documents = collection.find_one(data)
+            documents = collection.find_one(data, session=session, sort=sort)
         else:
-            documents = collection.find_one(data, requiredFields)
+            documents = collection.find_one(data, requiredFields, session=session, sort=sort)
         return documents
     except Exception as ex:
+        if session is not None:
+            raise
         ex_type, ex_value, ex_traceback = sys.exc_info()
         print("Exception : ", ex)
         print("Exception type : ", ex_type.__name__)
@@ -50,16 +93,18 @@ def SingleDataReader(collection_name, data, requiredFields=None):
 
 
 # Single point of contact(Multi data Reader)
-def MultiDataReader(collection_name: str, data, requiredFields=None):
+def MultiDataReader(collection_name: str, data, requiredFields=None, session=None):
     try:
         cursor = getMongoClient()
         collection = cursor[collection_name]
         if requiredFields is None:
-            documents = collection.find(data)
+            documents = collection.find(data, session=session)
         else:
-            documents = collection.find(data, requiredFields)
+            documents = collection.find(data, requiredFields, session=session)
         return documents
     except Exception as ex:
+        if session is not None:
+            raise
         ex_type, ex_value, ex_traceback = sys.exc_info()
         print("Exception : ", ex)
         print("Exception type : ", ex_type.__name__)
@@ -69,16 +114,18 @@ def MultiDataReader(collection_name: str, data, requiredFields=None):
 
 
 # Single point of contact(DataWriter)
-def DataWriter(collection_name: str, data, insertMany: bool = False, requiredFields=None):
+def DataWriter(collection_name: str, data, insertMany: bool = False, requiredFields=None, session=None):
     try:
         cursor = getMongoClient()
         collection = cursor[collection_name]
         if not insertMany:
-            documents = collection.insert_one(data)
+            documents = collection.insert_one(data, session=session)
         else:
-            documents = collection.insert_many(data)
+            documents = collection.insert_many(data, session=session)
         return documents
     except Exception as ex:
+        if session is not None:
+            raise
         ex_type, ex_value, ex_traceback = sys.exc_info()
         print("Exception : ", ex)
         print("Exception type : ", ex_type.__name__)
@@ -88,13 +135,18 @@ def DataWriter(collection_name: str, data, insertMany: bool = False, requiredFie
 
 
 # Single point of contact(DataWriter)
-def UpdateWriter(collection_name: str, data, requiredFields=None):
+def UpdateWriter(collection_name: str, data, requiredFields=None, multi: bool = False, session=None):
     try:
         cursor = getMongoClient()
         collection = cursor[collection_name]
-        documents = collection.update_one(filter=data, update={"$set": requiredFields})
+        if not multi:
+            documents = collection.update_one(filter=data, update={"$set": requiredFields}, session=session)
+        else:
+            documents = collection.update_many(filter=data, update={"$set": requiredFields}, session=session)
         return documents
     except Exception as ex:
+        if session is not None:
+            raise
         ex_type, ex_value, ex_traceback = sys.exc_info()
         print("Exception : ", ex)
         print("Exception type : ", ex_type.__name__)
@@ -103,19 +155,74 @@ def UpdateWriter(collection_name: str, data, requiredFields=None):
         print("UpdateWriter Exception: ", str(ex))
 
 
+# Single point of contact(Upsert)
+def UpsertWriter(collection_name: str, data, requiredFields=None, increments=None, defaults=None, session=None):
+    try:
+        cursor = getMongoClient()
+        collection = cursor[collection_name]
+        update = {}
+        if requiredFields:
+            update["$set"] = requiredFields
+        if increments:
+            update["$inc"] = increments
+        if defaults:
+            update["$setOnInsert"] = defaults
+        documents = collection.update_one(filter=data, update=update, upsert=True, session=session)
+        return documents
+    except Exception as ex:
+        if session is not None:
+            raise
+        ex_type, ex_value, ex_traceback = sys.exc_info()
+        print("Exception : ", ex)
+        print("Exception type : ", ex_type.__name__)
+        print("Exception message : ", ex_value)
+        traceback.print_exc()
+        print("UpsertWriter Exception: ", str(ex))
+
+
+# Single point of contact(Find and Update)
+def FindOneAndUpdate(
+        collection_name: str, data, update, sort=None, upsert: bool = False, projection=None, session=None
+):
+    try:
+        cursor = getMongoClient()
+        collection = cursor[collection_name]
+        documents = collection.find_one_and_update(
+            filter=data,
+            update=update,
+            projection=projection,
+            sort=sort,
+            upsert=upsert,
+            return_document=ReturnDocument.AFTER,
+            session=session,
+        )
+        return documents
+    except Exception as ex:
+        if session is not None:
+            raise
+        ex_type, ex_value, ex_traceback = sys.exc_info()
+        print("Exception : ", ex)
+        print("Exception type : ", ex_type.__name__)
+        print("Exception message : ", ex_value)
+        traceback.print_exc()
+        print("FindOneAndUpdate Exception: ", str(ex))
+
+
 # Single point of contact(DataWriter)
-def DataAggregation(collection_name: str, aggregation, requiredFields=None):
+def DataAggregation(collection_name: str, aggregation, requiredFields=None, session=None):
     try:
         cursor = getMongoClient()
         collection = cursor[collection_name]
         if requiredFields is None:
-            documents = list(collection.aggregate(aggregation))
+            documents = list(collection.aggregate(aggregation, session=session))
             # documents = [json_util.loads(json_util.dumps(doc)) for doc in documents]
             documents = [{item: data[item] for item in data if item != "_id"} for data in documents]
         else:
             documents = collection.find(aggregation, {"$project": requiredFields})
         return documents
     except Exception as ex:
+        if session is not None:
+            raise
         ex_type, ex_value, ex_traceback = sys.exc_info()
         print("Exception : ", ex)
         print("Exception type : ", ex_type.__name__)
@@ -125,15 +232,17 @@ def DataAggregation(collection_name: str, aggregation, requiredFields=None):
 
 
 # Single point of contact(Delete)
-def DeleteData(collection_name: str, data, multi: bool = False):
+def DeleteData(collection_name: str, data, multi: bool = False, session=None):
     try:
         cursor = getMongoClient()
         collection = cursor[collection_name]
         if not multi:
-            collection.delete_one(data)
+            collection.delete_one(data, session=session)
         else:
-            collection.delete_many(data)
+            collection.delete_many(data, session=session)
     except Exception as ex:
+        if session is not None:
+            raise
         ex_type, ex_value, ex_traceback = sys.exc_info()
         print("Exception : ", ex)
         print("Exception type : ", ex_type.__name__)
@@ -157,4 +266,80 @@ def CountDocuments(collection_name: str):
         print("UpdateWriter Exception: ", str(ex))
 
 
+# Indexes backing the read models, created on application startup
+CollectionIndexes = {
+    "WorkOrder": [([("currencyId", 1)], {}), ([("clientId", 1)], {})],
+    "Client": [([("orgId", 1)], {})],
+    "User": [([("orgId", 1)], {})],
+    "AccountInfo": [([("orgId", 1)], {})],
+    "Invoice": [
+        ([("workOrderId", 1)], {}),
+        # Open invoices only, for the receivables aging report
+        (
+            [("workOrderId", 1), ("dueBy", 1)],
+            {"partialFilterExpression": {"paidOn": {"$type": "null"}, "dueBy": {"$type": "date"}}},
+        ),
+    ],
+    "Payment": [([("currencyId", 1)], {})],
+    "Expense": [([("currencyId", 1)], {})],
+    "Organization": [([("defaultCurrencyId", 1)], {})],
+    "ReferenceVersion": [([("id", 1)], {"unique": True})],
+    "Timesheet": [
+        ([("chargedById", 1), ("startTime", 1)], {}),
+        ([("workOrderId", 1), ("startTime", 1)], {}),
+    ],
+    "TimeChargeLock": [([("id", 1)], {"unique": True})],
+    "TimesheetDaily": [
+        ([("id", 1)], {"unique": True}),
+        ([("workOrderId", 1), ("chargedById", 1), ("date", 1)], {"unique": True}),
+        # Calendars read every user's days of a work order over a period
+        ([("workOrderId", 1), ("date", 1)], {}),
+    ],
+    "MailOutbox": [
+        ([("id", 1)], {"unique": True}),
+        ([("status", 1), ("nextAttemptAt", 1)], {}),
+    ],
+    "LedgerAccount": [
+        ([("id", 1)], {"unique": True}),
+        ([("orgId", 1)], {}),
+    ],
+    "LedgerEntry": [
+        ([("id", 1)], {"unique": True}),
+        ([("accountId", 1), ("sequence", 1)], {"unique": True}),
+        ([("orgId", 1), ("transaction_date", -1)], {}),
+        # Latest rate per currency for the converted aging totals
+        ([("orgId", 1), ("currencyId", 1), ("transaction_date", -1)], {}),
+        ([("accountId", 1), ("transaction_date", -1)], {}),
+    ],
+    "LedgerSnapshot": [
+        ([("accountId", 1), ("period", 1)], {"unique": True}),
+        ([("orgId", 1), ("period", 1)], {}),
+    ],
+    "CashFlowMonthly": [
+        ([("id", 1)], {"unique": True}),
+        ([("orgId", 1), ("period", 1), ("currencyId", 1), ("clientId", 1)], {"unique": True}),
+    ],
+    "MetricsCube": [
+        ([("id", 1)], {"unique": True}),
+        ([("orgId", 1), ("workOrderId", 1), ("period", 1), ("clientId", 1), ("currencyId", 1)], {"unique": True}),
+        ([("orgId", 1), ("period", 1)], {}),
+    ],
+}
+
+
+def EnsureIndexes():
+    try:
+        cursor = getMongoClient()
+        for collection_name, indexes in CollectionIndexes.items():
+            for keys, options in indexes:
+                cursor[collection_name].create_index(keys, **options)
+    except Exception as ex:
+        ex_type, ex_value, ex_traceback = sys.exc_info()
+        print("Exception : ", ex)
+        print("Exception type : ", ex_type.__name__)
+        print("Exception message : ", ex_value)
+        traceback.print_exc()
+        print("EnsureIndexes Exception: ", str(ex))
+
+
 CollectionList = CollectionName()
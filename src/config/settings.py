@@ -1,4 +1,5 @@
 import os
+import tempfile
 from pathlib import Path
 import jinja2
 from datetime import datetime
@@ -6,6 +7,10 @@ from fastapi_mail import ConnectionConfig
 
 
 STORAGE_ACCOUNT_NAME = os.environ.get("STORAGE_ACCOUNT_NAME")
+# Local copies of blobs and generated documents, mail attachments are read from here
+DOCUMENT_CACHE_DIR = os.getenv(
+    "DOCUMENT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "goapp-documents")
+)
 
 # AZURE_TENANT_ID = os.environ.get("AZURE_TENANT_ID")
 # AZURE_CLIENT_ID = os.environ.get("AZURE_CLIENT_ID")
@@ -27,6 +32,49 @@ MAIL_PORT = int(os.getenv("MAIL_PORT", "80"))
 MAIL_SERVER = os.getenv("MAIL_SERVER", "localhost")
 MAIL_FROM_NAME = os.getenv("MAIL_FROM_NAME", "Reetesh")
 
+# Outbound mail queue: "smtp" delivers through the pooled connection, "debug" only records the messages
+MAIL_BACKEND = os.getenv("MAIL_BACKEND", "smtp")
+MAIL_POOL_SIZE = int(os.getenv("MAIL_POOL_SIZE", "2"))
+MAIL_BATCH_SIZE = int(os.getenv("MAIL_BATCH_SIZE", "20"))
+MAIL_MAX_ATTEMPTS = int(os.getenv("MAIL_MAX_ATTEMPTS", "5"))
+MAIL_RETRY_SECONDS = int(os.getenv("MAIL_RETRY_SECONDS", "30"))
+MAIL_POLL_SECONDS = int(os.getenv("MAIL_POLL_SECONDS", "10"))
+
+# Read response cache: "memory" keeps an LRU per process, "redis" shares it through REDIS_URL
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "memory")
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "300"))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+# Seconds between checks of the currency/organization cache version
+REFERENCE_DATA_TTL_SECONDS = float(os.getenv("REFERENCE_DATA_TTL_SECONDS", "30"))
+
+# Most time charges accepted by one bulk charge request
+BULK_CHARGE_MAX_ROWS = int(os.getenv("BULK_CHARGE_MAX_ROWS", "5000"))
+# Longest single time charge, it bounds the index range an overlap check scans
+MAX_TIME_CHARGE_HOURS = int(os.getenv("MAX_TIME_CHARGE_HOURS", "24"))
+
+# Columnar snapshots of timesheets, invoices and ledger entries read by the reports
+ANALYTICS_SNAPSHOT_DIR = os.getenv(
+    "ANALYTICS_SNAPSHOT_DIR", os.path.join(tempfile.gettempdir(), "goapp-snapshots")
+)
+
+# Rows written per chunk of a streamed export
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "1000"))
+
+# Seconds an unused local copy of a blob is kept, mail workers fetch it again when needed
+DOCUMENT_CACHE_SECONDS = int(os.getenv("DOCUMENT_CACHE_SECONDS", "86400"))
+
+# Seconds a finished export stays on disk for resumed (Range) downloads
+EXPORT_CACHE_SECONDS = int(os.getenv("EXPORT_CACHE_SECONDS", "3600"))
+
+# Print the critical path of the concurrent queries of every request
+QUERY_TRACE_LOG = os.getenv("QUERY_TRACE_LOG", "false").lower() in ("1", "true", "yes")
+
+MAIL_TEMPLATE_ENV = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(searchpath=Path(__file__).parent / "email_templates")
+)
+
 billing_email_conf = ConnectionConfig(
     MAIL_USERNAME=BILLING_MAIL_USERNAME,
     MAIL_PASSWORD=MAIL_PASSWORD,
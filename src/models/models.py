@@ -2,7 +2,7 @@ from datetime import datetime
 
 from src.utils.auth import get_utc_timestamp
 
-from typing import Optional
+from typing import List, Optional
 from uuid import uuid4
 from pydantic import BaseModel, Field, validator
 
@@ -113,6 +113,26 @@ class TimesheetDB(BaseModel):
     chargedById: Optional[str]
 
 
+class TimesheetDescription(BaseModel):
+    description: str
+    seconds: float
+    longest: float
+
+
+class TimesheetDaily(BaseModel):
+    id: str
+    workOrderId: str
+    chargedById: Optional[str]
+    date: datetime
+    seconds: float = 0
+    entries: int = 0
+    invoicedSeconds: float = 0
+    invoicedEntries: int = 0
+    invoiced: bool = False
+    descriptions: List[TimesheetDescription] = []
+    updatedAt: int = Field(default_factory=get_utc_timestamp)
+
+
 class Invoice(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid4().hex))
     invoice_number: str
@@ -175,6 +195,95 @@ class Transaction(BaseModel):
     updatedAt: int = Field(default_factory=get_utc_timestamp)
 
 
+class LedgerAccount(BaseModel):
+    id: str
+    orgId: str
+    accountName: str
+    accountNumber: str
+    currency: str
+    currencySymbol: str
+    balance: float = 0
+    debitTotal: float = 0
+    creditTotal: float = 0
+    entries: int = 0
+    createdAt: int = Field(default_factory=get_utc_timestamp)
+    updatedAt: int = Field(default_factory=get_utc_timestamp)
+
+
+class LedgerEntry(BaseModel):
+    id: str
+    orgId: str
+    accountId: str
+    sequence: int
+    period: str
+    description: Optional[str]
+    accountName: str
+    accountNumber: str
+    currency: str
+    currencySymbol: str
+    debit: float = 0
+    credit: float = 0
+    balance: float
+    originalAmount: Optional[float]
+    exchangeRate: Optional[float]
+    currencyId: Optional[str]
+    originalCurrency: Optional[str]
+    originalCurrencySymbol: Optional[str]
+    clientId: Optional[str]
+    paymentId: Optional[str]
+    expenseId: Optional[str]
+    transaction_date: int
+
+
+class LedgerSnapshot(BaseModel):
+    id: str
+    orgId: str
+    accountId: str
+    period: str
+    openingBalance: float
+    closingBalance: float
+    debit: float = 0
+    credit: float = 0
+    entries: int = 0
+    firstSequence: int
+    lastSequence: int
+    updatedAt: int = Field(default_factory=get_utc_timestamp)
+
+
+class CashFlowMonthly(BaseModel):
+    id: str
+    orgId: str
+    period: str
+    currencyId: Optional[str]
+    clientId: Optional[str]
+    currency: Optional[str]
+    currencySymbol: Optional[str]
+    inflow: float = 0
+    outflow: float = 0
+    convertedInflow: float = 0
+    convertedOutflow: float = 0
+    entries: int = 0
+    updatedAt: int = Field(default_factory=get_utc_timestamp)
+
+
+class MetricsCube(BaseModel):
+    id: str
+    orgId: str
+    clientId: str
+    workOrderId: str
+    currencyId: str
+    period: str
+    hoursCharged: float = 0
+    hoursInvoiced: float = 0
+    invoices: int = 0
+    invoiced: float = 0
+    tax: float = 0
+    cancelled: float = 0
+    payments: int = 0
+    paid: float = 0
+    updatedAt: int = Field(default_factory=get_utc_timestamp)
+
+
 class AccountInfoDB(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid4().hex))
     orgId: str
@@ -191,3 +300,31 @@ class CurrencyDb(BaseModel):
     symbol: str
     createdAt: int = Field(default_factory=get_utc_timestamp)
     updatedAt: int = Field(default_factory=get_utc_timestamp)
+
+
+class MailAttachment(BaseModel):
+    filename: str
+    path: str
+    blobPath: Optional[str]
+    temporary: bool = False
+    mimeType: str = "application"
+    mimeSubtype: str = "pdf"
+
+
+class MailOutbox(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid4().hex))
+    subject: str
+    sender: str
+    recipients: List[str]
+    cc: List[str] = []
+    html: str
+    attachments: List[MailAttachment] = []
+    host: Optional[str]
+    status: str = "queued"
+    attempts: int = 0
+    nextAttemptAt: datetime = Field(default_factory=datetime.utcnow)
+    claimedAt: Optional[datetime]
+    sentAt: Optional[datetime]
+    lastError: Optional[str]
+    createdAt: int = Field(default_factory=get_utc_timestamp)
+    updatedAt: int = Field(default_factory=get_utc_timestamp)
@@ -0,0 +1,211 @@
+from datetime import datetime
+
+from src.config.database import DataAggregation, DeleteData, MultiDataReader, UpsertWriter
+from src.models.models import LedgerEntry
+from src.utils.auth import get_utc_timestamp
+from src.utils.reference_data import reference_data
+
+# Aging buckets as (label, first day overdue), "current" is not due yet
+AGING_BUCKETS = [("current", None), ("1-30", 1), ("31-60", 31), ("61-90", 61), ("90+", 91)]
+
+# Matches the partial Invoice index, so only open invoices with a due date are read
+OPEN_INVOICES = {"paidOn": {"$type": "null"}, "dueBy": {"$type": "date"}}
+
+
+def cash_flow_id(org_id: str, period: str, currency_id: str, client_id: str) -> str:
+    return f"{org_id}:{period}:{currency_id or '-'}:{client_id or '-'}"
+
+
+def apply_cash_flow(entry: LedgerEntry, session=None):
+    """Add a ledger entry to the monthly cash flow of its currency and client
+
+    inflow/outflow are in the original currency of the payment or expense,
+    the converted totals in the organization default currency.
+    """
+    original_amount = entry.originalAmount or 0
+    UpsertWriter(
+        "CashFlowMonthly",
+        {
+            "orgId": entry.orgId,
+            "period": entry.period,
+            "currencyId": entry.currencyId,
+            "clientId": entry.clientId,
+        },
+        requiredFields={
+            "currency": entry.originalCurrency,
+            "currencySymbol": entry.originalCurrencySymbol,
+            "updatedAt": get_utc_timestamp(),
+        },
+        increments={
+            "inflow": original_amount if entry.credit else 0,
+            "outflow": original_amount if entry.debit else 0,
+            "convertedInflow": entry.credit,
+            "convertedOutflow": entry.debit,
+            "entries": 1,
+        },
+        defaults={"id": cash_flow_id(entry.orgId, entry.period, entry.currencyId, entry.clientId)},
+        session=session,
+    )
+
+
+def rebuild_cash_flow(org_id: str = None):
+    """Recompute CashFlowMonthly from the ledger entries"""
+    match = {"orgId": org_id} if org_id else {}
+    DeleteData("CashFlowMonthly", match, True)
+    DataAggregation("LedgerEntry", [
+        {"$match": match},
+        {
+            "$group": {
+                "_id": {
+                    "orgId": "$orgId",
+                    "period": "$period",
+                    "currencyId": "$currencyId",
+                    "clientId": "$clientId",
+                },
+                "currency": {"$first": "$originalCurrency"},
+                "currencySymbol": {"$first": "$originalCurrencySymbol"},
+                "inflow": {"$sum": {"$cond": [{"$gt": ["$credit", 0]}, {"$ifNull": ["$originalAmount", 0]}, 0]}},
+                "outflow": {"$sum": {"$cond": [{"$gt": ["$debit", 0]}, {"$ifNull": ["$originalAmount", 0]}, 0]}},
+                "convertedInflow": {"$sum": "$credit"},
+                "convertedOutflow": {"$sum": "$debit"},
+                "entries": {"$sum": 1},
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "id": {
+                    "$concat": [
+                        "$_id.orgId", ":", "$_id.period", ":",
+                        {"$ifNull": ["$_id.currencyId", "-"]}, ":",
+                        {"$ifNull": ["$_id.clientId", "-"]},
+                    ]
+                },
+                "orgId": "$_id.orgId",
+                "period": "$_id.period",
+                "currencyId": {"$ifNull": ["$_id.currencyId", None]},
+                "clientId": {"$ifNull": ["$_id.clientId", None]},
+                "currency": 1,
+                "currencySymbol": 1,
+                "inflow": 1,
+                "outflow": 1,
+                "convertedInflow": 1,
+                "convertedOutflow": 1,
+                "entries": 1,
+                "updatedAt": {"$literal": get_utc_timestamp()},
+            }
+        },
+        {"$merge": {"into": "CashFlowMonthly", "on": "id", "whenMatched": "replace", "whenNotMatched": "insert"}},
+    ])
+
+
+def aging_bucket_expression(as_of: datetime) -> dict:
+    days_overdue = {"$floor": {"$divide": [{"$subtract": [as_of, "$dueBy"]}, 86400000]}}
+    branches = [
+        {"case": {"$gte": ["$$daysOverdue", first_day]}, "then": label}
+        for label, first_day in reversed(AGING_BUCKETS) if first_day is not None
+    ]
+    return {
+        "$let": {
+            "vars": {"daysOverdue": days_overdue},
+            "in": {"$switch": {"branches": branches, "default": AGING_BUCKETS[0][0]}},
+        }
+    }
+
+
+def latest_exchange_rates(org_id: str, currency_ids: list) -> dict:
+    """Rate of the organization's latest ledger entry in each currency, {currencyId: rate}
+
+    Ledger entries are posted in the organization default currency, their
+    exchangeRate converts the original amount into it.
+    """
+    rows = DataAggregation("LedgerEntry", [
+        {"$match": {"orgId": org_id, "currencyId": {"$in": currency_ids}, "exchangeRate": {"$ne": None}}},
+        {"$sort": {"currencyId": 1, "transaction_date": -1}},
+        {"$group": {"_id": "$currencyId", "exchangeRate": {"$first": "$exchangeRate"}}},
+    ])
+    return {row["_id"]: row["exchangeRate"] for row in rows}
+
+
+def aging_report(org_id: str, as_of: datetime = None, convert: bool = False) -> dict:
+    """Open receivables by client and currency in aging buckets of days past due
+
+    Args:
+        org_id (str): organization
+        as_of (datetime): day the ages are counted to, now by default
+        convert (bool): also total everything in the organization default currency, at the
+            exchange rate of the organization's latest ledger entry in each currency
+
+    Returns:
+        dict: rows per client and currency, totals per currency and the converted totals
+    """
+    as_of = as_of or datetime.utcnow()
+    labels = [label for label, _ in AGING_BUCKETS]
+    client_ids = [client["id"] for client in MultiDataReader("Client", {"orgId": org_id}, {"_id": 0, "id": 1})]
+    work_orders = {
+        work_order["id"]: work_order["clientId"]
+        for work_order in MultiDataReader(
+            "WorkOrder", {"clientId": {"$in": client_ids}}, {"_id": 0, "id": 1, "clientId": 1}
+        )
+    }
+    groups = DataAggregation("Invoice", [
+        {"$match": {"workOrderId": {"$in": list(work_orders)}, **OPEN_INVOICES}},
+        {
+            "$group": {
+                "_id": {
+                    "workOrderId": "$workOrderId",
+                    "currencyId": "$currencyId",
+                    "bucket": aging_bucket_expression(as_of),
+                },
+                "amount": {"$sum": {"$add": ["$amount", {"$ifNull": ["$tax", 0]}]}},
+                "invoices": {"$sum": 1},
+            }
+        },
+    ])
+
+    # Work orders of one client fold into its row, there are few enough groups to do it here
+    rows, totals = {}, {}
+    for group in groups:
+        key = group["_id"]
+        client_id = work_orders[key["workOrderId"]]
+        for target in (
+            rows.setdefault((client_id, key["currencyId"]), {"clientId": client_id, "currencyId": key["currencyId"]}),
+            totals.setdefault(key["currencyId"], {"currencyId": key["currencyId"]}),
+        ):
+            target.setdefault("buckets", dict.fromkeys(labels, 0))
+            target["buckets"][key["bucket"]] += group["amount"]
+            target["total"] = target.get("total", 0) + group["amount"]
+            target["invoices"] = target.get("invoices", 0) + group["invoices"]
+    for row in [*rows.values(), *totals.values()]:
+        currency = reference_data.currency(row["currencyId"]) or {}
+        row["currency"] = currency.get("abr")
+        row["currencySymbol"] = currency.get("symbol")
+
+    report = {
+        "asOf": as_of,
+        "buckets": labels,
+        "rows": sorted(rows.values(), key=lambda row: (row["clientId"], row["currency"] or "")),
+        "totals": sorted(totals.values(), key=lambda row: row["currency"] or ""),
+    }
+    if convert:
+        default_currency_id = (reference_data.organization(org_id) or {}).get("defaultCurrencyId")
+        default_currency = reference_data.currency(default_currency_id) or {}
+        rates = latest_exchange_rates(
+            org_id, [currency_id for currency_id in totals if currency_id != default_currency_id]
+        )
+        rates[default_currency_id] = 1
+        converted = dict.fromkeys(labels, 0)
+        for currency_id, total in totals.items():
+            if currency_id in rates:
+                for label in labels:
+                    converted[label] += total["buckets"][label] * rates[currency_id]
+        report["converted"] = {
+            "currencyId": default_currency_id,
+            "currency": default_currency.get("abr"),
+            "currencySymbol": default_currency.get("symbol"),
+            "buckets": converted,
+            "total": sum(converted.values()),
+            "rates": {currency_id: rates[currency_id] for currency_id in totals if currency_id in rates},
+            "missingRates": [currency_id for currency_id in totals if currency_id not in rates],
+        }
+    return report
@@ -0,0 +1,202 @@
+import asyncio
+import time
+from contextvars import ContextVar
+
+from fastapi import Request
+from starlette.concurrency import run_in_threadpool
+
+from src.config.database import MultiDataReader
+
+_current_trace: ContextVar = ContextVar("query_trace", default=None)
+_current_loaders: ContextVar = ContextVar("data_loaders", default=None)
+_trace_hooks = []
+
+
+class QueryTrace:
+    """Timings of the queries a request ran through gather_queries
+
+    Each gather_queries call is one batch, its queries ran side by side so
+    only the slowest of them adds to the time the request waited.
+    """
+
+    def __init__(self, label: str):
+        self.label = label
+        self.started = time.perf_counter()
+        self.batches = []
+
+    def record(self, timings: list):
+        self.batches.append(timings)
+
+    @property
+    def queries(self) -> int:
+        return sum(len(batch) for batch in self.batches)
+
+    @property
+    def critical_path(self) -> float:
+        """Seconds the request spent waiting on its queries"""
+        return sum(max(seconds for _, seconds in batch) for batch in self.batches if batch)
+
+    @property
+    def query_time(self) -> float:
+        """Seconds the queries took one after the other"""
+        return sum(seconds for batch in self.batches for _, seconds in batch)
+
+
+def add_trace_hook(hook):
+    """Call hook(trace) after every request that ran queries through gather_queries"""
+    _trace_hooks.append(hook)
+
+
+def print_trace(trace: QueryTrace):
+    elapsed = time.perf_counter() - trace.started
+    batches = " | ".join(
+        ", ".join(f"{name} {seconds * 1000:.1f}ms" for name, seconds in batch) for batch in trace.batches
+    )
+    print(
+        f"{trace.label}: {trace.queries} queries, critical path {trace.critical_path * 1000:.1f}ms "
+        f"of {trace.query_time * 1000:.1f}ms, request {elapsed * 1000:.1f}ms [{batches}]",
+        flush=True,
+    )
+
+
+async def _timed(name: str, query):
+    started = time.perf_counter()
+    result = await run_in_threadpool(query)
+    return result, (name, time.perf_counter() - started)
+
+
+async def gather_queries(**queries) -> dict:
+    """Run independent reads concurrently on the threadpool
+
+    Args:
+        **queries: name=callable without arguments, e.g.
+            client=lambda: SingleDataReader("Client", {"id": client_id})
+
+    Returns:
+        dict: the result of each query under its name
+    """
+    names = list(queries)
+    outcomes = await asyncio.gather(*[_timed(name, queries[name]) for name in names])
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.record([timing for _, timing in outcomes])
+    return {name: result for name, (result, _) in zip(names, outcomes)}
+
+
+class DataLoader:
+    """Coalesces the id lookups of one collection into a single $in query
+
+    Every load issued before the event loop gets back to the loader, e.g.
+    from one asyncio.gather, is answered by the same query. Documents are
+    memoized for the loader's lifetime, which is one request when obtained
+    through loader().
+    """
+
+    def __init__(self, collection_name: str, projection: dict = None):
+        self.collection_name = collection_name
+        self.projection = projection or {"_id": 0}
+        self._documents = {}
+        self._pending = []
+        # The loop only keeps weak references to tasks, running dispatches are held here
+        self._tasks = set()
+
+    def load(self, document_id: str) -> asyncio.Future:
+        """Document with the id, None when there is none; a failed read raises and is not memoized"""
+        future = self._documents.get(document_id)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self._documents[document_id] = loop.create_future()
+            if not self._pending:
+                loop.call_soon(self._start_dispatch)
+            self._pending.append(document_id)
+        return future
+
+    async def load_many(self, document_ids: list) -> list:
+        return list(await asyncio.gather(*[self.load(document_id) for document_id in document_ids]))
+
+    def prime(self, document: dict):
+        """Remember a document the request wrote or already read"""
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(document)
+        self._documents[document["id"]] = future
+
+    def forget(self, document_id: str):
+        """Drop the memoized document, the next load reads it again"""
+        self._documents.pop(document_id, None)
+
+    def _start_dispatch(self):
+        task = asyncio.ensure_future(self._dispatch())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _dispatch(self):
+        document_ids, self._pending = self._pending, []
+
+        def read():
+            documents = MultiDataReader(
+                self.collection_name, {"id": {"$in": document_ids}}, self.projection
+            )
+            if documents is None:
+                raise RuntimeError(f"{self.collection_name} documents could not be read")
+            return list(documents)
+
+        try:
+            found = await gather_queries(**{f"{self.collection_name}[{len(document_ids)}]": read})
+            documents = {document["id"]: document for document in next(iter(found.values()))}
+        except Exception as e:
+            print("DataLoader Exception: ", e, flush=True)
+            # Callers see the error instead of a missing document, the next load reads again
+            for document_id in document_ids:
+                future = self._documents.pop(document_id, None)
+                if future is not None and not future.done():
+                    future.set_exception(e)
+            return
+        for document_id in document_ids:
+            future = self._documents.get(document_id)
+            if future is not None and not future.done():
+                future.set_result(documents.get(document_id))
+
+
+def loader(collection_name: str) -> DataLoader:
+    """The request's loader for the collection, a new one outside of a request"""
+    loaders = _current_loaders.get()
+    if loaders is None:
+        return DataLoader(collection_name)
+    if collection_name not in loaders:
+        loaders[collection_name] = DataLoader(collection_name)
+    return loaders[collection_name]
+
+
+async def load(collection_name: str, document_id: str) -> dict:
+    """Document of the collection by id through the request's loader"""
+    return await loader(collection_name).load(document_id)
+
+
+async def load_many(collection_name: str, document_ids: list) -> list:
+    return await loader(collection_name).load_many(document_ids)
+
+
+async def trace_queries(request: Request, call_next):
+    """Middleware giving each request its data loaders and query trace
+
+    The trace is reported as a Server-Timing header and to the trace hooks.
+    """
+    trace = QueryTrace(f"{request.method} {request.url.path}")
+    trace_token = _current_trace.set(trace)
+    loaders_token = _current_loaders.set({})
+    try:
+        response = await call_next(request)
+    finally:
+        _current_loaders.reset(loaders_token)
+        _current_trace.reset(trace_token)
+    if trace.batches:
+        response.headers["Server-Timing"] = (
+            f'db;dur={trace.critical_path * 1000:.1f};desc="critical path", '
+            f'dbtotal;dur={trace.query_time * 1000:.1f};desc="query time"'
+        )
+        for hook in _trace_hooks:
+            try:
+                hook(trace)
+            except Exception as e:
+                print("Query trace hook failed: ", e, flush=True)
+    return response
@@ -0,0 +1,199 @@
+import hashlib
+import inspect
+import json
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+
+from src.config.settings import (
+    REDIS_URL,
+    RESPONSE_CACHE_BACKEND,
+    RESPONSE_CACHE_SIZE,
+    RESPONSE_CACHE_TTL_SECONDS,
+)
+
+
+class LRUBackend:
+    """In-process cache, invalidation only reaches the process doing the write"""
+
+    def __init__(self, max_entries: int = RESPONSE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                return None
+            payload, expires_at = value
+            if expires_at < datetime.now(timezone.utc).timestamp():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return payload
+
+    def set(self, key: str, payload: bytes, ttl: int):
+        with self._lock:
+            self._entries[key] = (payload, datetime.now(timezone.utc).timestamp() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def counter(self, key: str) -> int:
+        with self._lock:
+            return self._counters.get(key, 0)
+
+    def incr(self, key: str) -> int:
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+
+class RedisBackend:
+    """Cache shared by every process, pass client=fakeredis.FakeRedis() in tests"""
+
+    def __init__(self, client=None, url: str = REDIS_URL, prefix: str = "goapp:cache:"):
+        if client is None:
+            import redis
+
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key: str):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key: str, payload: bytes, ttl: int):
+        self.client.set(self.prefix + key, payload, ex=ttl)
+
+    def counter(self, key: str) -> int:
+        return int(self.client.get(self.prefix + key) or 0)
+
+    def incr(self, key: str) -> int:
+        return self.client.incr(self.prefix + key)
+
+
+class ResponseCache:
+    """Caches serialized read responses per (namespace, route, params, org, role)
+
+    Each namespace has a global and a per-organization generation counter that
+    are part of every key, invalidating bumps a counter instead of deleting keys.
+    """
+
+    def __init__(self, backend=None, ttl: int = RESPONSE_CACHE_TTL_SECONDS):
+        self._backend = backend
+        self.ttl = ttl
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = RedisBackend() if RESPONSE_CACHE_BACKEND == "redis" else LRUBackend()
+        return self._backend
+
+    def generation(self, namespace: str, org_id: str) -> str:
+        """Current global and organization generation of the namespace"""
+        generation = self.backend.counter(f"generation:{namespace}")
+        org_generation = self.backend.counter(f"generation:{namespace}:{org_id}")
+        return f"{generation}:{org_generation}"
+
+    def key(self, request: Request, namespace: str, org_id: str, role: str) -> str:
+        generation = self.generation(namespace, org_id)
+        params = "&".join(f"{k}={v}" for k, v in sorted(request.query_params.multi_items()))
+        return f"response:{namespace}:{generation}:{request.url.path}?{params}:{org_id}:{role}"
+
+    def invalidate(self, namespace: str, org_id: str = None):
+        if org_id is None:
+            self.backend.incr(f"generation:{namespace}")
+        else:
+            self.backend.incr(f"generation:{namespace}:{org_id}")
+
+
+response_cache = ResponseCache()
+
+
+def requestor_role(requestor) -> str:
+    if requestor.superUser:
+        return "super"
+    return "staff" if requestor.staffUser else "member"
+
+
+def last_modified(content) -> datetime:
+    """Latest updatedAt of the returned document(s)"""
+    documents = content if isinstance(content, list) else [content]
+    timestamps = [
+        document.get("updatedAt") for document in documents
+        if isinstance(document, dict) and isinstance(document.get("updatedAt"), (int, float))
+    ]
+    if not timestamps:
+        return None
+    return datetime.fromtimestamp(max(timestamps), tz=timezone.utc)
+
+
+def not_modified(request: Request, etag: str, modified: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*"
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and modified:
+        try:
+            return parsedate_to_datetime(modified) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+async def cached_response(
+        request: Request, namespace: str, requestor, producer, org_id: str = None
+) -> Response:
+    """Serve a read endpoint from the response cache
+
+    Args:
+        request (Request): incoming request, its path and query are part of the key
+        namespace (str): invalidation namespace, e.g. "client"
+        requestor (UserInDb): caller, scopes the entry to its organization and role
+        producer (callable): builds the response content on a miss, may be async
+        org_id (str): organization the content belongs to, the requestor's by default
+
+    Returns:
+        Response: JSON body with ETag and Last-Modified, or 304 when the client copy is current
+    """
+    org_id = org_id or requestor.orgId
+    key = response_cache.key(request, namespace, org_id, requestor_role(requestor))
+    cached = response_cache.backend.get(key)
+    if cached is not None:
+        entry = json.loads(cached)
+    else:
+        content = producer()
+        if inspect.isawaitable(content):
+            content = await content
+        content = jsonable_encoder(content)
+        body = json.dumps(content, separators=(",", ":"))
+        modified = last_modified(content)
+        entry = {
+            "body": body,
+            "etag": f'"{hashlib.sha1(body.encode()).hexdigest()}"',
+            "modified": format_datetime(modified, usegmt=True) if modified else None,
+        }
+        response_cache.backend.set(key, json.dumps(entry).encode(), response_cache.ttl)
+
+    headers = {"ETag": entry["etag"], "Cache-Control": "private, no-cache"}
+    if entry["modified"]:
+        headers["Last-Modified"] = entry["modified"]
+    if not_modified(request, entry["etag"], entry["modified"]):
+        return Response(status_code=304, headers=headers)
+    return Response(entry["body"], media_type="application/json", headers=headers)
+
+
+def invalidate_cache(*namespaces: str, org_id: str = None):
+    """Drop cached responses of the namespaces, for one organization or for all of them"""
+    for namespace in namespaces:
+        try:
+            response_cache.invalidate(namespace, org_id)
+        except Exception as e:
+            print("Cache invalidation failed: ", e, flush=True)
@@ -1,26 +1,40 @@
-from typing import Dict
-from datetime import datetime
-import requests
-import io
-from fastapi import UploadFile
-import tempfile
-from pydantic import EmailStr
-from fastapi_mail import FastMail, MessageSchema
-
-from src.config.settings import billing_email_conf
-
-
-def create_temp_file_from_bytes(file_bytes, filename):
-    return UploadFile(file=io.BytesIO(file_bytes), filename=filename)
-
-
-async def send_email(message: MessageSchema, template_name: str):
-    fm = FastMail(billing_email_conf)
+from src.utils.mailer import enqueue_mail
+from src.utils.storage import spool_document
+
+
+def pdf_attachment(filename: str, path: str, temporary: bool = False, blob_path: str = None) -> dict:
+    """Attachment read from path, a worker without the file downloads it again from blob_path"""
+    return {
+        "filename": filename,
+        "path": path,
+        "blobPath": blob_path,
+        "temporary": temporary,
+        "mimeType": "application",
+        "mimeSubtype": "pdf",
+    }
+
+
+async def send_email(
+    subject: str,
+    recipients: list,
+    cc: list = None,
+    template_name: str = None,
+    template_body: dict = None,
+    html: str = "",
+    attachments: list = None,
+) -> bool:
     try:
-        await fm.send_message(message, template_name=template_name)
+        enqueue_mail(
+            subject=subject,
+            recipients=recipients,
+            cc=cc,
+            template_name=template_name,
+            template_body=template_body,
+            html=html,
+            attachments=attachments,
+        )
         return True
     except Exception as e:
-        print("Hii")
         print(e)
         return False
 
@@ -28,95 +42,58 @@ async def send_email(message: MessageSchema, template_name: str):
 async def send_timesheet(
     to_list: list, cc_list: list, report: bytes, template_data: dict
 ) -> bool:
-    pdf_file: UploadFile = create_temp_file_from_bytes(report, "file.pdf")
-    attachments = [
-        {
-            "file": pdf_file,
-            "headers": {
-                "Content-ID": "<attached_pdf@fastapi-mail>",
-                "Content-Disposition": 'attachment; filename="timesheet.pdf"',
-            },
-            "mime_type": "application",
-            "mime_subtype": "pdf",
-        }
-    ]
-    message = MessageSchema(
+    attachments = [pdf_attachment("timesheet.pdf", spool_document(report), temporary=True)]
+    return await send_email(
         subject=f"Monthly Timesheet ({template_data['start_date']} - {template_data['end_date']})",
         recipients=to_list,
         cc=cc_list,
+        template_name="timesheet_share.html",
         template_body=template_data,
         attachments=attachments,
     )
-    return await send_email(message, "timesheet_share.html")
 
 
 async def send_invoice(
-    to_list: list, cc_list: list, report: bytes, template_data: dict
+    to_list: list, cc_list: list, report_path: str, blob_path: str, template_data: dict
+) -> bool:
+    attachments = [pdf_attachment(f"{template_data['invoice_number']}.pdf", report_path, blob_path=blob_path)]
+    return await send_email(
+        subject=f"GoApp Solutions | Invoice({(template_data['invoicePeriodStart'].strftime('%B %d, %Y'))} - {template_data['invoicePeriodStart'].strftime('%B %d, %Y')})",
+        recipients=to_list,
+        cc=cc_list,
+        template_name="invoice_share.html",
+        template_body=template_data,
+        attachments=attachments,
+    )
+
+
+async def send_invoices(
+    to_list: list, cc_list: list, reports: list, template_data: dict
 ) -> bool:
-    pdf_file: UploadFile = create_temp_file_from_bytes(report, "file.pdf")
     attachments = [
-        {
-            "file": pdf_file,
-            "headers": {
-                "Content-ID": "<attached_pdf@fastapi-mail>",
-                "Content-Disposition": f'attachment; filename="{template_data["invoice_number"]}.pdf"',
-            },
-            "mime_type": "application",
-            "mime_subtype": "pdf",
-        }
+        pdf_attachment(filename, report_path, blob_path=blob_path) for filename, report_path, blob_path in reports
     ]
-    message = MessageSchema(
-        subject=f"GoApp Solutions | Invoice({(template_data['invoicePeriodStart'].strftime('%B %d, %Y'))} - {template_data['invoicePeriodStart'].strftime('%B %d, %Y')})",
+    return await send_email(
+        subject=f"GoApp Solutions | Invoices ({len(reports)})",
         recipients=to_list,
         cc=cc_list,
+        template_name="invoice_bulk_share.html",
         template_body=template_data,
         attachments=attachments,
     )
-    return await send_email(message, "invoice_share.html")
 
 
 async def send_test_mail(email):
     html = """<p>Hi this test mail, thanks for using Fastapi-mail</p> """
-
-    message = MessageSchema(
-        subject="Fastapi-Mail module", recipients=[email], body=html
-    )
-
-    fm = FastMail(billing_email_conf)
-    try:
-        await fm.send_message(message)
-        return True
-    except Exception as e:
-        print(e)
-        return False
+    return await send_email(subject="Fastapi-Mail module", recipients=[email], html=html)
 
 
 async def send_attachment_test_mail(email, file):
     html = """<p>Hi this test mail, thanks for using Fastapi-mail</p> """
-    pdf_file: UploadFile = create_temp_file_from_bytes(file, "file.pdf")
-    attachments = [
-        {
-            "file": pdf_file,
-            "headers": {
-                "Content-ID": "<attached_pdf@fastapi-mail>",
-                "Content-Disposition": 'attachment; filename="timesheet.pdf"',
-            },
-            "mime_type": "application",
-            "mime_subtype": "pdf",
-        }
-    ]
-    message = MessageSchema(
+    attachments = [pdf_attachment("timesheet.pdf", spool_document(file), temporary=True)]
+    return await send_email(
         subject="Fastapi-Mail module",
         recipients=[email],
-        body=html,
+        html=html,
         attachments=attachments,
-        template_body={},
     )
-
-    fm = FastMail(conf)
-    try:
-        await fm.send_message(message)
-        return True
-    except Exception as e:
-        print(e)
-        return False
@@ -1,3 +1,7 @@
+import calendar
+from datetime import datetime, timezone
+
+
 def format_seconds_to_hr_mm(seconds):
     """Convert seconds to hours and minutes
 
@@ -35,3 +39,33 @@ def generate_calendar_table(data):
         weekly_duration[week] = format_seconds_to_hr_mm(total_duration)
 
     return calendar_data, weekly_duration
+
+
+def month_starts(date, months):
+    """First day of each month of a range
+
+    Args:
+        date (datetime): any day of the first month
+        months (int): number of consecutive months
+
+    Returns:
+        list: datetime of the first day of every month in the range
+    """
+    starts = []
+    year, month = date.year, date.month
+    for _ in range(months):
+        starts.append(datetime(year, month, 1))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return starts
+
+
+def naive_utc(date):
+    """The datetime in UTC without tzinfo, the way Mongo hands datetimes back"""
+    if date is None or date.tzinfo is None:
+        return date
+    return date.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def days_in_month(month_start):
+    """Number of days in the month of the given date"""
+    return calendar.monthrange(month_start.year, month_start.month)[1]
@@ -0,0 +1,334 @@
+import csv
+import hashlib
+import io
+import os
+import re
+import shutil
+import time
+import zipfile
+import zlib
+from datetime import datetime
+from uuid import uuid4
+from xml.sax.saxutils import escape
+
+from fastapi import Request, Response
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+
+from src.config.database import DataAggregation
+from src.config.settings import DOCUMENT_CACHE_DIR, EXPORT_CACHE_SECONDS, EXPORT_CHUNK_ROWS
+
+EXPORT_DIR = os.path.join(DOCUMENT_CACHE_DIR, "exports")
+FILE_CHUNK_BYTES = 256 * 1024
+
+EXPORT_FORMATS = {
+    "csv": ("text/csv", ".csv"),
+    "xlsx": ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", ".xlsx"),
+}
+
+# Characters XML 1.0 does not allow, even escaped
+ILLEGAL_XML_CHARACTERS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+CONTENT_TYPES_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '</Types>'
+)
+ROOT_RELS_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+WORKBOOK_RELS_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+    'Target="worksheets/sheet1.xml"/>'
+    '</Relationships>'
+)
+WORKBOOK_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets><sheet name="{name}" sheetId="1" r:id="rId1"/></sheets>'
+    '</workbook>'
+)
+
+
+def export_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def chunked(rows, size: int = EXPORT_CHUNK_ROWS):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def csv_chunks(headers: list, rows):
+    """Encoded CSV, one piece per EXPORT_CHUNK_ROWS rows"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(headers)
+    for chunk in chunked(rows):
+        writer.writerows([[export_value(value) for value in row] for row in chunk])
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+class ZipSink:
+    """Write-only stream for ZipFile, the archive is drained as it is written
+
+    Without tell/seek ZipFile writes data descriptors after each member,
+    so nothing already produced has to be revisited.
+    """
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data) -> int:
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data, self._parts = b"".join(self._parts), []
+        return data
+
+
+def xlsx_cell(value) -> str:
+    value = export_value(value)
+    if value is None:
+        return "<c/>"
+    if isinstance(value, bool):
+        return f'<c t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float)):
+        return f"<c><v>{value}</v></c>"
+    text = escape(ILLEGAL_XML_CHARACTERS.sub("", str(value)))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def xlsx_row(values) -> str:
+    return "<row>" + "".join(xlsx_cell(value) for value in values) + "</row>"
+
+
+def xlsx_member(name: str) -> zipfile.ZipInfo:
+    """Archive member with a fixed timestamp, so the same rows always give the same bytes
+
+    A resumed download may be served from a regenerated file, its bytes have to
+    line up with the part the client already has.
+    """
+    member = zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0))
+    member.compress_type = zipfile.ZIP_DEFLATED
+    return member
+
+
+def xlsx_chunks(headers: list, rows, sheet_name: str = "Export"):
+    """A single sheet workbook with inline strings, built and drained piece by piece"""
+    sink = ZipSink()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr(xlsx_member("[Content_Types].xml"), CONTENT_TYPES_XML)
+        archive.writestr(xlsx_member("_rels/.rels"), ROOT_RELS_XML)
+        archive.writestr(xlsx_member("xl/workbook.xml"), WORKBOOK_XML.format(name=escape(sheet_name[:31])))
+        archive.writestr(xlsx_member("xl/_rels/workbook.xml.rels"), WORKBOOK_RELS_XML)
+        with archive.open(xlsx_member("xl/worksheets/sheet1.xml"), "w", force_zip64=True) as sheet:
+            sheet.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+            )
+            sheet.write(xlsx_row(headers).encode("utf-8"))
+            for chunk in chunked(rows):
+                sheet.write("".join(xlsx_row(row) for row in chunk).encode("utf-8"))
+                yield sink.drain()
+            sheet.write(b"</sheetData></worksheet>")
+    yield sink.drain()
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export_chunks(export_format: str, headers: list, rows, sheet_name: str, compress: bool = False):
+    chunks = xlsx_chunks(headers, rows, sheet_name) if export_format == "xlsx" else csv_chunks(headers, rows)
+    return gzip_chunks(chunks) if compress else chunks
+
+
+def data_watermark(collection_name: str, query: dict, field: str) -> str:
+    """Count and latest field value of the exported documents, one indexed aggregation
+
+    It moves with every insert, delete and update that stamps field, whichever
+    process or command wrote it.
+    """
+    rows = DataAggregation(collection_name, [
+        {"$match": query},
+        {"$group": {"_id": None, "count": {"$sum": 1}, "latest": {"$max": f"${field}"}}},
+    ])
+    row = rows[0] if rows else {}
+    return f"{row.get('count', 0)}:{row.get('latest')}"
+
+
+def export_key(request: Request, org_id: str, watermark: str) -> str:
+    """Name of the cached export, changes with the query and the watermark of the exported data"""
+    params = "&".join(f"{k}={v}" for k, v in sorted(request.query_params.multi_items()))
+    return hashlib.sha1(f"{request.url.path}?{params}:{org_id}:{watermark}".encode()).hexdigest()
+
+
+def clear_exports():
+    """Drop every cached export, for rewrites that leave the watermarks alone such as a ledger rebuild"""
+    shutil.rmtree(EXPORT_DIR, ignore_errors=True)
+
+
+def prune_exports():
+    """Drop exports older than EXPORT_CACHE_SECONDS"""
+    cutoff = time.time() - EXPORT_CACHE_SECONDS
+    for entry in os.scandir(EXPORT_DIR):
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+
+def tee_to_file(chunks, path: str):
+    """Pass the chunks through while keeping a copy at path, kept only once complete"""
+    partial_path = f"{path}.{uuid4().hex}.part"
+    completed = False
+    try:
+        with open(partial_path, "wb") as file:
+            for chunk in chunks:
+                file.write(chunk)
+                yield chunk
+        completed = True
+    finally:
+        if completed:
+            os.replace(partial_path, path)
+        elif os.path.exists(partial_path):
+            os.remove(partial_path)
+
+
+def write_export(chunks, path: str):
+    for _ in tee_to_file(chunks, path):
+        pass
+
+
+def requested_range(request: Request, etag: str, size: int):
+    """(start, end) of a satisfiable single byte range, None for the whole file, False when unsatisfiable"""
+    header = request.headers.get("range")
+    if not header:
+        return None
+    if_range = request.headers.get("if-range")
+    if if_range and if_range.strip() != etag:
+        return None
+    match = re.fullmatch(r"\s*bytes=(\d*)-(\d*)\s*", header)
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+    if match.group(1) == "":
+        start, end = max(size - int(match.group(2)), 0), size - 1
+    else:
+        start = int(match.group(1))
+        end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def file_chunks(path: str, start: int, end: int):
+    with open(path, "rb") as file:
+        file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = file.read(min(FILE_CHUNK_BYTES, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+async def export_response(
+        request: Request,
+        org_id: str,
+        watermark: str,
+        filename: str,
+        export_format: str,
+        compress: bool,
+        chunks_factory,
+) -> Response:
+    """Stream an export, keeping a copy on disk so interrupted downloads can resume with Range
+
+    Args:
+        request (Request): incoming request, its path and query name the export
+        org_id (str): organization the export belongs to
+        watermark (str): data_watermark of the exported documents, a new one outdates the export
+        filename (str): download name without extension
+        export_format (str): "csv" or "xlsx"
+        compress (bool): gzip the file
+        chunks_factory (callable): returns the iterator of encoded chunks, only called when not cached;
+            it runs before the response starts, so it may raise HTTPException
+
+    Returns:
+        Response: the export, a 206 for a satisfiable Range, 416 for an unsatisfiable one
+    """
+    media_type, extension = EXPORT_FORMATS[export_format]
+    if compress:
+        media_type, extension = "application/gzip", f"{extension}.gz"
+    key = export_key(request, org_id, watermark)
+    etag = f'"{key}"'
+    path = os.path.join(EXPORT_DIR, f"{key}{extension}")
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f'attachment; filename="{filename}{extension}"',
+    }
+
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    if not os.path.exists(path):
+        await run_in_threadpool(prune_exports)
+        if not request.headers.get("range"):
+            return StreamingResponse(tee_to_file(chunks_factory(), path), media_type=media_type, headers=headers)
+        # A resume of an export that is no longer on disk, the offsets only hold for a complete file
+        await run_in_threadpool(write_export, chunks_factory(), path)
+
+    size = os.path.getsize(path)
+    byte_range = requested_range(request, etag, size)
+    if byte_range is False:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+    if byte_range is None:
+        return StreamingResponse(
+            file_chunks(path, 0, size - 1),
+            media_type=media_type,
+            headers={**headers, "Content-Length": str(size)},
+        )
+    start, end = byte_range
+    return StreamingResponse(
+        file_chunks(path, start, end),
+        status_code=206,
+        media_type=media_type,
+        headers={**headers, "Content-Length": str(end - start + 1), "Content-Range": f"bytes {start}-{end}/{size}"},
+    )
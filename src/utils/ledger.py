@@ -0,0 +1,291 @@
+from datetime import datetime
+
+from src.config.database import (
+    DataAggregation,
+    DataWriter,
+    DeleteData,
+    FindOneAndUpdate,
+    MultiDataReader,
+    RunTransaction,
+    SingleDataReader,
+)
+from src.models.models import (
+    ExpenseDB,
+    LedgerAccount,
+    LedgerEntry,
+    LedgerSnapshot,
+    PaymentDB,
+    Transaction,
+)
+from src.utils.analytics import apply_cash_flow
+from src.utils.auth import get_utc_timestamp
+from src.utils.cache import invalidate_cache
+from src.utils.reference_data import reference_data
+
+
+def ledger_period(timestamp: int) -> str:
+    return datetime.utcfromtimestamp(timestamp).strftime("%Y-%m")
+
+
+def ledger_context(account_id: str, session=None) -> dict:
+    """Account details and the organization currency denormalized onto ledger documents
+
+    Returns:
+        dict: account fields with currency and currencySymbol, None for an unknown account
+    """
+    context = SingleDataReader(
+        "AccountInfo",
+        {"id": account_id},
+        {"_id": 0, "id": 1, "orgId": 1, "accountName": 1, "accountNumber": 1},
+        session=session,
+    )
+    if not context:
+        return None
+    organization = reference_data.organization(context["orgId"]) or {}
+    default_currency = reference_data.currency(organization.get("defaultCurrencyId")) or {}
+    context["currency"] = default_currency.get("abr")
+    context["currencySymbol"] = default_currency.get("symbol")
+    return context
+
+
+def ledger_entry(
+        transaction, source, context: dict, sequence: int, balance: float, client_id: str = None
+) -> LedgerEntry:
+    original_currency = reference_data.currency(source.currencyId if source else None) or {}
+    return LedgerEntry(
+        id=transaction.id,
+        orgId=context["orgId"],
+        accountId=transaction.accountId,
+        sequence=sequence,
+        period=ledger_period(transaction.createdAt),
+        description=source.description if source else None,
+        accountName=context["accountName"],
+        accountNumber=context["accountNumber"],
+        currency=context["currency"],
+        currencySymbol=context["currencySymbol"],
+        debit=transaction.debit,
+        credit=transaction.credit,
+        balance=balance,
+        originalAmount=source.amount if source else None,
+        exchangeRate=source.exchangeRate if source else None,
+        currencyId=source.currencyId if source else None,
+        originalCurrency=original_currency.get("abr"),
+        originalCurrencySymbol=original_currency.get("symbol"),
+        clientId=client_id,
+        paymentId=transaction.paymentId,
+        expenseId=transaction.expenseId,
+        transaction_date=transaction.createdAt,
+    )
+
+
+def apply_ledger_snapshot(entry: LedgerEntry, session=None):
+    """Fold one entry into the monthly snapshot of its account
+
+    Opening and closing balances follow the entry sequence, so concurrent
+    postings landing out of order still leave the right balances behind.
+    """
+    net = entry.credit - entry.debit
+    FindOneAndUpdate(
+        "LedgerSnapshot",
+        {"accountId": entry.accountId, "period": entry.period},
+        [
+            {
+                "$set": {
+                    "id": f"{entry.accountId}:{entry.period}",
+                    "orgId": entry.orgId,
+                    "debit": {"$add": [{"$ifNull": ["$debit", 0]}, entry.debit]},
+                    "credit": {"$add": [{"$ifNull": ["$credit", 0]}, entry.credit]},
+                    "entries": {"$add": [{"$ifNull": ["$entries", 0]}, 1]},
+                    "openingBalance": {
+                        "$cond": [
+                            {"$lt": [entry.sequence, {"$ifNull": ["$firstSequence", entry.sequence + 1]}]},
+                            entry.balance - net,
+                            "$openingBalance",
+                        ]
+                    },
+                    "firstSequence": {"$min": [{"$ifNull": ["$firstSequence", entry.sequence]}, entry.sequence]},
+                    "closingBalance": {
+                        "$cond": [
+                            {"$gt": [entry.sequence, {"$ifNull": ["$lastSequence", 0]}]},
+                            entry.balance,
+                            "$closingBalance",
+                        ]
+                    },
+                    "lastSequence": {"$max": [{"$ifNull": ["$lastSequence", entry.sequence]}, entry.sequence]},
+                    "updatedAt": get_utc_timestamp(),
+                }
+            }
+        ],
+        upsert=True,
+        session=session,
+    )
+
+
+def post_ledger_entry(transaction, source, client_id: str = None, session=None) -> LedgerEntry:
+    """Append a recorded transaction to the ledger of its account and to the cash flow aggregates
+
+    Args:
+        transaction (Transaction): the transaction that was just written
+        source (PaymentDB | ExpenseDB): payment or expense the transaction records
+        client_id (str): client the money came from, for invoice payments
+        session (ClientSession): transaction the ledger writes join
+
+    Returns:
+        LedgerEntry: the entry with the account balance after it, None for an unknown account
+    """
+    context = ledger_context(transaction.accountId, session)
+    if context is None:
+        return None
+    account = FindOneAndUpdate(
+        "LedgerAccount",
+        {"id": transaction.accountId},
+        {
+            "$inc": {
+                "balance": transaction.credit - transaction.debit,
+                "debitTotal": transaction.debit,
+                "creditTotal": transaction.credit,
+                "entries": 1,
+            },
+            "$set": {
+                "orgId": context["orgId"],
+                "accountName": context["accountName"],
+                "accountNumber": context["accountNumber"],
+                "currency": context["currency"],
+                "currencySymbol": context["currencySymbol"],
+                "updatedAt": get_utc_timestamp(),
+            },
+            "$setOnInsert": {"createdAt": get_utc_timestamp()},
+        },
+        upsert=True,
+        session=session,
+    )
+    entry = ledger_entry(transaction, source, context, account["entries"], account["balance"], client_id)
+    DataWriter("LedgerEntry", entry.dict(), session=session)
+    apply_ledger_snapshot(entry, session)
+    apply_cash_flow(entry, session)
+    return entry
+
+
+def record_ledger_transaction(
+        collection_name: str, source, transaction, client_id: str = None, also=None
+) -> LedgerEntry:
+    """Write a payment or expense, its transaction and the ledger posting in one commit
+
+    Args:
+        collection_name (str): "Payment" or "Expense"
+        source (PaymentDB | ExpenseDB): the payment or expense, with its docUrl already set
+        transaction (Transaction): the transaction recording it
+        client_id (str): client the money came from, for invoice payments
+        also (callable): further writes taking the session, e.g. marking the invoice paid
+
+    Returns:
+        LedgerEntry: the posted ledger entry
+    """
+    def write(session):
+        DataWriter(collection_name, source.dict(), session=session)
+        DataWriter("Transaction", transaction.dict(), session=session)
+        if also is not None:
+            also(session)
+        return post_ledger_entry(transaction, source, client_id, session)
+
+    entry = RunTransaction(write)
+    if entry is not None:
+        invalidate_cache("account", org_id=entry.orgId)
+        invalidate_cache("currency")
+    return entry
+
+
+def rebuild_ledger(org_id: str = None):
+    """Recompute ledger accounts, entries and snapshots from the recorded transactions"""
+    accounts = MultiDataReader("AccountInfo", {"orgId": org_id} if org_id else {}, {"_id": 0, "id": 1})
+    for account in list(accounts):
+        account_id = account["id"]
+        for collection_name in ("LedgerAccount", "LedgerEntry", "LedgerSnapshot"):
+            key = "id" if collection_name == "LedgerAccount" else "accountId"
+            DeleteData(collection_name, {key: account_id}, True)
+
+        context = ledger_context(account_id)
+        if context is None:
+            continue
+        rows = DataAggregation("Transaction", [
+            {"$match": {"accountId": account_id}},
+            {"$sort": {"createdAt": 1}},
+            {
+                "$lookup": {
+                    "from": "Payment",
+                    "localField": "paymentId",
+                    "foreignField": "id",
+                    "as": "payment"
+                }
+            },
+            {
+                "$lookup": {
+                    "from": "Expense",
+                    "localField": "expenseId",
+                    "foreignField": "id",
+                    "as": "expense"
+                }
+            },
+            {
+                "$lookup": {
+                    "from": "Invoice",
+                    "localField": "payment.invoiceId",
+                    "foreignField": "id",
+                    "as": "invoice"
+                }
+            },
+            {
+                "$lookup": {
+                    "from": "WorkOrder",
+                    "localField": "invoice.workOrderId",
+                    "foreignField": "id",
+                    "as": "workOrder"
+                }
+            },
+            {"$addFields": {"clientId": {"$arrayElemAt": ["$workOrder.clientId", 0]}}},
+            {"$project": {"_id": 0, "payment._id": 0, "expense._id": 0, "invoice": 0, "workOrder": 0}},
+        ])
+
+        balance, entries, snapshots = 0, [], {}
+        for sequence, row in enumerate(rows, start=1):
+            payment, expense = row.pop("payment"), row.pop("expense")
+            client_id = row.pop("clientId", None)
+            source = PaymentDB(**payment[0]) if payment else ExpenseDB(**expense[0]) if expense else None
+            transaction = Transaction(**row)
+            balance += transaction.credit - transaction.debit
+            entry = ledger_entry(transaction, source, context, sequence, balance, client_id)
+            entries.append(entry.dict())
+
+            snapshot = snapshots.get(entry.period)
+            if snapshot is None:
+                snapshot = snapshots[entry.period] = LedgerSnapshot(
+                    id=f"{account_id}:{entry.period}",
+                    orgId=entry.orgId,
+                    accountId=account_id,
+                    period=entry.period,
+                    openingBalance=balance - (entry.credit - entry.debit),
+                    closingBalance=balance,
+                    firstSequence=sequence,
+                    lastSequence=sequence,
+                )
+            snapshot.debit += entry.debit
+            snapshot.credit += entry.credit
+            snapshot.entries += 1
+            snapshot.closingBalance = balance
+            snapshot.lastSequence = sequence
+
+        DataWriter("LedgerAccount", LedgerAccount(
+            id=account_id,
+            orgId=context["orgId"],
+            accountName=context["accountName"],
+            accountNumber=context["accountNumber"],
+            currency=context["currency"],
+            currencySymbol=context["currencySymbol"],
+            balance=balance,
+            debitTotal=sum(entry["debit"] for entry in entries),
+            creditTotal=sum(entry["credit"] for entry in entries),
+            entries=len(entries),
+        ).dict())
+        if entries:
+            DataWriter("LedgerEntry", entries, True)
+            DataWriter("LedgerSnapshot", [snapshot.dict() for snapshot in snapshots.values()], True)
@@ -0,0 +1,337 @@
+import asyncio
+import base64
+import mmap
+import os
+import socket
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from email.mime.base import MIMEBase
+from email.utils import formataddr
+
+import aiosmtplib
+from starlette.concurrency import run_in_threadpool
+
+from src.config.database import DataWriter, FindOneAndUpdate, UpdateWriter
+from src.config.settings import (
+    BILLING_MAIL_USERNAME,
+    MAIL_BACKEND,
+    MAIL_BATCH_SIZE,
+    MAIL_FROM_NAME,
+    MAIL_MAX_ATTEMPTS,
+    MAIL_PASSWORD,
+    MAIL_POLL_SECONDS,
+    MAIL_POOL_SIZE,
+    MAIL_PORT,
+    MAIL_RETRY_SECONDS,
+    MAIL_SERVER,
+    MAIL_TEMPLATE_ENV,
+    billing_email_conf,
+)
+from src.models.models import MailAttachment, MailOutbox
+from src.utils.auth import get_utc_timestamp
+from src.utils.storage import cache_blob
+
+# A message still "sending" after this long belongs to a worker that died, it is picked up again
+CLAIM_TIMEOUT = timedelta(minutes=10)
+# Mail with an attachment that has no blob to fetch it from, e.g. a spooled file, only exists on the host that queued it
+HOSTNAME = socket.gethostname()
+
+
+class DebugSMTP:
+    """Stand-in for an SMTP session that records messages instead of delivering them"""
+
+    sent = []
+
+    def __init__(self):
+        self.is_connected = False
+
+    async def connect(self):
+        self.is_connected = True
+
+    async def noop(self):
+        return None
+
+    async def send_message(self, message: EmailMessage):
+        DebugSMTP.sent.append(message)
+        print(f"[mail] {message['Subject']} -> {message['To']}", flush=True)
+
+    async def quit(self):
+        self.is_connected = False
+
+
+class SMTPPool:
+    """A small pool of authenticated SMTP sessions reused across messages"""
+
+    def __init__(self, size: int = MAIL_POOL_SIZE, backend: str = MAIL_BACKEND):
+        self.size = size
+        self.backend = backend
+        self._idle = []
+        self._semaphore = None
+
+    async def _connect(self):
+        if self.backend == "debug":
+            session = DebugSMTP()
+            await session.connect()
+            return session
+
+        session = aiosmtplib.SMTP(
+            hostname=MAIL_SERVER,
+            port=MAIL_PORT,
+            use_tls=billing_email_conf.MAIL_SSL,
+            validate_certs=billing_email_conf.VALIDATE_CERTS,
+        )
+        await session.connect()
+        if billing_email_conf.MAIL_TLS:
+            await session.starttls()
+        if billing_email_conf.USE_CREDENTIALS:
+            await session.login(BILLING_MAIL_USERNAME, MAIL_PASSWORD)
+        return session
+
+    async def _acquire(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.size)
+        await self._semaphore.acquire()
+        while self._idle:
+            session = self._idle.pop()
+            try:
+                await session.noop()
+                return session
+            except Exception:
+                pass
+        try:
+            return await self._connect()
+        except Exception:
+            self._semaphore.release()
+            raise
+
+    def _release(self, session, healthy: bool):
+        if healthy and session.is_connected:
+            self._idle.append(session)
+        self._semaphore.release()
+
+    @asynccontextmanager
+    async def connection(self):
+        session = await self._acquire()
+        healthy = True
+        try:
+            yield session
+        except aiosmtplib.SMTPServerDisconnected:
+            healthy = False
+            raise
+        finally:
+            self._release(session, healthy)
+
+    async def close(self):
+        while self._idle:
+            session = self._idle.pop()
+            try:
+                await session.quit()
+            except Exception:
+                pass
+
+
+smtp_pool = SMTPPool()
+_outbox_wakeup = None
+_outbox_worker = None
+
+
+def enqueue_mail(
+        subject: str,
+        recipients: list,
+        cc: list = None,
+        template_name: str = None,
+        template_body: dict = None,
+        html: str = "",
+        attachments: list = None,
+) -> str:
+    """Store a message in the durable outbox, the background worker delivers it
+
+    Args:
+        subject (str): mail subject
+        recipients (list): to addresses
+        cc (list): cc addresses
+        template_name (str): e-mail template rendered with template_body, replaces html
+        template_body (dict): template variables
+        html (str): html body when no template is used
+        attachments (list): MailAttachment compatible dicts, files are read at delivery time; a file
+            with a blobPath is downloaded again by a worker that does not have it
+
+    Returns:
+        str: id of the outbox entry
+    """
+    if template_name:
+        html = MAIL_TEMPLATE_ENV.get_template(template_name).render(**(template_body or {}))
+    attachments = attachments or []
+    mail = MailOutbox(
+        subject=subject,
+        sender=formataddr((MAIL_FROM_NAME, BILLING_MAIL_USERNAME)),
+        recipients=recipients,
+        cc=cc or [],
+        html=html,
+        attachments=attachments,
+        host=HOSTNAME if any(not attachment.get("blobPath") for attachment in attachments) else None,
+    )
+    DataWriter("MailOutbox", mail.dict())
+    if _outbox_wakeup is not None:
+        _outbox_wakeup.set()
+    return mail.id
+
+
+def attachment_path(attachment: MailAttachment) -> str:
+    """Local file of an attachment, downloaded from its blob when this host does not have it"""
+    if os.path.exists(attachment.path) or not attachment.blobPath:
+        return attachment.path
+    path = cache_blob(path=attachment.blobPath)
+    if path is None:
+        raise FileNotFoundError(f"Attachment {attachment.filename} could not be read from {attachment.blobPath}")
+    return path
+
+
+def attachment_part(attachment: MailAttachment, policy) -> MIMEBase:
+    """MIME part for a file attachment, base64 encoded straight from a read-only mapping"""
+    part = MIMEBase(attachment.mimeType, attachment.mimeSubtype, policy=policy)
+    with open(attachment_path(attachment), "rb") as file:
+        if os.fstat(file.fileno()).st_size:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                part.set_payload(base64.encodebytes(mapped).decode("ascii"))
+        else:
+            part.set_payload("")
+    part["Content-Transfer-Encoding"] = "base64"
+    part.add_header("Content-Disposition", "attachment", filename=attachment.filename)
+    return part
+
+
+def discard_attachments(mail: MailOutbox):
+    for attachment in mail.attachments:
+        if attachment.temporary:
+            try:
+                os.remove(attachment.path)
+            except OSError:
+                pass
+
+
+def build_message(mail: MailOutbox) -> EmailMessage:
+    message = EmailMessage()
+    message["Subject"] = mail.subject
+    message["From"] = mail.sender
+    message["To"] = ", ".join(mail.recipients)
+    if mail.cc:
+        message["Cc"] = ", ".join(mail.cc)
+    message.set_content(mail.html, subtype="html")
+    if mail.attachments:
+        message.make_mixed()
+        for attachment in mail.attachments:
+            message.attach(attachment_part(attachment, message.policy))
+    return message
+
+
+def claim_outbox_batch(size: int = MAIL_BATCH_SIZE) -> list:
+    now = datetime.utcnow()
+    batch = []
+    for _ in range(size):
+        document = FindOneAndUpdate(
+            "MailOutbox",
+            {
+                "$or": [
+                    {"status": "queued", "nextAttemptAt": {"$lte": now}},
+                    {"status": "sending", "claimedAt": {"$lte": now - CLAIM_TIMEOUT}},
+                ],
+                "host": {"$in": [None, HOSTNAME]},
+            },
+            # Counted on claim, so a message whose worker dies while sending it still runs out of attempts
+            {
+                "$set": {"status": "sending", "claimedAt": now, "updatedAt": get_utc_timestamp()},
+                "$inc": {"attempts": 1},
+            },
+            sort=[("nextAttemptAt", 1)],
+        )
+        if not document:
+            break
+        mail = MailOutbox(**document)
+        if mail.attempts > MAIL_MAX_ATTEMPTS:
+            # Reclaimed after its last attempt never finished
+            mark_mail_failed(mail, TimeoutError("Delivery did not finish within the claim timeout"))
+            continue
+        batch.append(mail)
+    return batch
+
+
+def mark_mail_failed(mail: MailOutbox, error: Exception):
+    """Queue the message for a retry, or fail it for good once its claimed attempts reach MAIL_MAX_ATTEMPTS"""
+    attempts = mail.attempts
+    retry_in = timedelta(seconds=MAIL_RETRY_SECONDS * 2 ** (attempts - 1))
+    if attempts >= MAIL_MAX_ATTEMPTS:
+        discard_attachments(mail)
+    UpdateWriter("MailOutbox", {"id": mail.id}, {
+        "status": "failed" if attempts >= MAIL_MAX_ATTEMPTS else "queued",
+        "nextAttemptAt": datetime.utcnow() + retry_in,
+        "lastError": str(error),
+        "updatedAt": get_utc_timestamp(),
+    })
+
+
+async def dispatch_outbox(pool: SMTPPool = smtp_pool) -> int:
+    """Deliver every due outbox message in batches over pooled connections
+
+    Returns:
+        int: number of messages delivered
+    """
+    delivered = 0
+    while True:
+        # The outbox and attachment files are read off the event loop, only the SMTP traffic runs on it
+        batch = await run_in_threadpool(claim_outbox_batch)
+        if not batch:
+            return delivered
+        try:
+            async with pool.connection() as session:
+                for index, mail in enumerate(batch):
+                    try:
+                        await session.send_message(await run_in_threadpool(build_message, mail))
+                    except aiosmtplib.SMTPServerDisconnected as e:
+                        for pending in batch[index:]:
+                            await run_in_threadpool(mark_mail_failed, pending, e)
+                        raise
+                    except Exception as e:
+                        await run_in_threadpool(mark_mail_failed, mail, e)
+                        continue
+                    await run_in_threadpool(UpdateWriter, "MailOutbox", {"id": mail.id}, {
+                        "status": "sent",
+                        "sentAt": datetime.utcnow(),
+                        "updatedAt": get_utc_timestamp(),
+                    })
+                    await run_in_threadpool(discard_attachments, mail)
+                    delivered += 1
+        except aiosmtplib.SMTPServerDisconnected:
+            continue
+        except Exception as e:
+            # No connection could be opened, the whole batch is retried later
+            print("Outbox dispatch failed: ", e, flush=True)
+            for mail in batch:
+                await run_in_threadpool(mark_mail_failed, mail, e)
+            return delivered
+
+
+async def run_outbox_worker():
+    while True:
+        try:
+            await dispatch_outbox()
+        except Exception as e:
+            print("Outbox worker error: ", e, flush=True)
+        try:
+            await asyncio.wait_for(_outbox_wakeup.wait(), timeout=MAIL_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        _outbox_wakeup.clear()
+
+
+async def start_outbox_worker():
+    global _outbox_wakeup, _outbox_worker
+    _outbox_wakeup = asyncio.Event()
+    _outbox_worker = asyncio.create_task(run_outbox_worker())
+
+
+async def stop_outbox_worker():
+    if _outbox_worker is not None:
+        _outbox_worker.cancel()
+    await smtp_pool.close()
@@ -0,0 +1,254 @@
+from datetime import datetime
+
+from src.config.database import DataAggregation, DataWriter, DeleteData, MultiDataReader, UpsertWriter
+from src.models.models import MetricsCube
+from src.utils.auth import get_utc_timestamp
+from src.utils.date_time import naive_utc
+
+METRICS_MEASURES = ("hoursCharged", "hoursInvoiced", "invoices", "invoiced", "tax", "cancelled", "payments", "paid")
+
+
+def metrics_id(work_order_id: str, period: str, client_id: str, currency_id: str) -> str:
+    return f"{work_order_id}:{period}:{client_id}:{currency_id}"
+
+
+def metrics_period(value) -> str:
+    """YYYY-MM in UTC of a datetime or a timestamp, the month the rebuild groups it in"""
+    if not isinstance(value, datetime):
+        value = datetime.utcfromtimestamp(value)
+    return naive_utc(value).strftime("%Y-%m")
+
+
+def apply_metrics(org_id: str, work_order: dict, period: str, currency_id: str = None, session=None, **increments):
+    """Add to the measures of a work order month in the metrics cube
+
+    Client and currency are part of the cell, amounts summed under one currency
+    are never relabeled by a later write.
+
+    Args:
+        org_id (str): organization of the work order
+        work_order (dict): the work order, the cell is booked to its client
+        period (str): YYYY-MM
+        currency_id (str): currency of the amounts, the work order currency by default
+        session (ClientSession): transaction the write joins
+        **increments: measure=amount, negative to take back
+    """
+    currency_id = currency_id or work_order["currencyId"]
+    UpsertWriter(
+        "MetricsCube",
+        {
+            "orgId": org_id,
+            "workOrderId": work_order["id"],
+            "period": period,
+            "clientId": work_order["clientId"],
+            "currencyId": currency_id,
+        },
+        requiredFields={"updatedAt": get_utc_timestamp()},
+        increments=increments,
+        defaults={"id": metrics_id(work_order["id"], period, work_order["clientId"], currency_id)},
+        session=session,
+    )
+
+
+def apply_time_charge_metrics(org_id: str, work_order: dict, timesheets: list, sign: int = 1, charged: bool = True):
+    """Add (sign=1) or take back (sign=-1) the hours of time charges in the months they were worked
+
+    Args:
+        charged (bool): False to only count them as invoiced hours, as when an invoice takes them up
+    """
+    periods = {}
+    for timesheet in timesheets:
+        hours = (timesheet["endTime"] - timesheet["startTime"]).total_seconds() / 3600 * sign
+        increments = periods.setdefault(metrics_period(timesheet["startTime"]), {})
+        if charged:
+            increments["hoursCharged"] = increments.get("hoursCharged", 0) + hours
+        if not charged or timesheet.get("invoiced"):
+            increments["hoursInvoiced"] = increments.get("hoursInvoiced", 0) + hours
+    for period, increments in periods.items():
+        apply_metrics(org_id, work_order, period, **increments)
+
+
+def invoice_total(invoice: dict) -> float:
+    return invoice["amount"] + (invoice.get("tax") or 0)
+
+
+def apply_invoice_metrics(org_id: str, work_order: dict, invoice: dict, sign: int = 1):
+    """Add or take back an invoice in the month it was generated, in the invoice currency"""
+    apply_metrics(
+        org_id,
+        work_order,
+        metrics_period(invoice["generatedOn"]),
+        invoice["currencyId"],
+        invoices=sign,
+        invoiced=invoice["amount"] * sign,
+        tax=(invoice.get("tax") or 0) * sign,
+    )
+
+
+def remove_invoice_metrics(org_id: str, work_order: dict, invoice: dict):
+    """Take back a deleted invoice together with its cancellation and payments"""
+    apply_invoice_metrics(org_id, work_order, invoice, -1)
+    if not invoice.get("dueBy") and not invoice.get("paidOn"):
+        apply_metrics(
+            org_id,
+            work_order,
+            metrics_period(invoice["generatedOn"]),
+            invoice["currencyId"],
+            cancelled=-invoice_total(invoice),
+        )
+    payments = MultiDataReader(
+        "Payment", {"invoiceId": invoice["id"]}, {"_id": 0, "amount": 1, "currencyId": 1, "createdAt": 1}
+    )
+    for payment in payments:
+        apply_metrics(
+            org_id,
+            work_order,
+            metrics_period(payment["createdAt"]),
+            payment["currencyId"],
+            payments=-1,
+            paid=-payment["amount"],
+        )
+
+
+def metrics_cells(org_id: str, work_orders: dict) -> list:
+    """Cube cells of the work orders computed from the timesheets, invoices and invoice payments
+
+    Args:
+        work_orders (dict): {id: work order with clientId and currencyId}
+    """
+    cells = {}
+
+    def cell(work_order_id: str, period: str, currency_id: str = None) -> MetricsCube:
+        work_order = work_orders[work_order_id]
+        currency_id = currency_id or work_order["currencyId"]
+        key = metrics_id(work_order_id, period, work_order["clientId"], currency_id)
+        if key not in cells:
+            cells[key] = MetricsCube(
+                id=key,
+                orgId=org_id,
+                clientId=work_order["clientId"],
+                workOrderId=work_order_id,
+                currencyId=currency_id,
+                period=period,
+            )
+        return cells[key]
+
+    hours = DataAggregation("Timesheet", [
+        {"$match": {"workOrderId": {"$in": list(work_orders)}}},
+        {
+            "$group": {
+                "_id": {
+                    "workOrderId": "$workOrderId",
+                    "period": {"$dateToString": {"format": "%Y-%m", "date": "$startTime"}},
+                },
+                "hoursCharged": {"$sum": {"$divide": [{"$subtract": ["$endTime", "$startTime"]}, 3600000]}},
+                "hoursInvoiced": {
+                    "$sum": {
+                        "$cond": [
+                            "$invoiced",
+                            {"$divide": [{"$subtract": ["$endTime", "$startTime"]}, 3600000]},
+                            0,
+                        ]
+                    }
+                },
+            }
+        },
+    ])
+    for row in hours:
+        metrics = cell(row["_id"]["workOrderId"], row["_id"]["period"])
+        metrics.hoursCharged = row["hoursCharged"]
+        metrics.hoursInvoiced = row["hoursInvoiced"]
+
+    invoices = list(MultiDataReader(
+        "Invoice",
+        {"workOrderId": {"$in": list(work_orders)}},
+        {
+            "_id": 0, "id": 1, "workOrderId": 1, "currencyId": 1, "generatedOn": 1, "dueBy": 1, "paidOn": 1,
+            "amount": 1, "tax": 1,
+        },
+    ))
+    for invoice in invoices:
+        metrics = cell(invoice["workOrderId"], metrics_period(invoice["generatedOn"]), invoice["currencyId"])
+        metrics.invoices += 1
+        metrics.invoiced += invoice["amount"]
+        metrics.tax += invoice.get("tax") or 0
+        if not invoice.get("dueBy") and not invoice.get("paidOn"):
+            metrics.cancelled += invoice_total(invoice)
+
+    invoice_work_orders = {invoice["id"]: invoice["workOrderId"] for invoice in invoices}
+    payments = MultiDataReader(
+        "Payment",
+        {"invoiceId": {"$in": list(invoice_work_orders)}},
+        {"_id": 0, "invoiceId": 1, "amount": 1, "currencyId": 1, "createdAt": 1},
+    )
+    for payment in payments:
+        metrics = cell(
+            invoice_work_orders[payment["invoiceId"]], metrics_period(payment["createdAt"]), payment["currencyId"]
+        )
+        metrics.payments += 1
+        metrics.paid += payment["amount"]
+    return list(cells.values())
+
+
+def rebuild_work_order_metrics(org_id: str, work_order: dict):
+    """Recompute the cells of one work order, e.g. after its client or currency changed"""
+    DeleteData("MetricsCube", {"workOrderId": work_order["id"]}, True)
+    cells = metrics_cells(org_id, {work_order["id"]: work_order})
+    if cells:
+        DataWriter("MetricsCube", [metrics.dict() for metrics in cells], True)
+
+
+def rebuild_metrics(org_id: str = None):
+    """Recompute the metrics cube from the timesheets, invoices and invoice payments"""
+    organizations = MultiDataReader("Organization", {"id": org_id} if org_id else {}, {"_id": 0, "id": 1})
+    for organization in list(organizations):
+        DeleteData("MetricsCube", {"orgId": organization["id"]}, True)
+        client_ids = [
+            client["id"]
+            for client in MultiDataReader("Client", {"orgId": organization["id"]}, {"_id": 0, "id": 1})
+        ]
+        work_orders = {
+            work_order["id"]: work_order
+            for work_order in MultiDataReader(
+                "WorkOrder", {"clientId": {"$in": client_ids}}, {"_id": 0, "id": 1, "clientId": 1, "currencyId": 1}
+            )
+        }
+        cells = metrics_cells(organization["id"], work_orders)
+        if cells:
+            DataWriter("MetricsCube", [metrics.dict() for metrics in cells], True)
+
+
+def metrics_dashboard(org_id: str, start_period: str = None, end_period: str = None, group_by: str = "period") -> list:
+    """Totals of the metrics cube by period, client or work order, always split by currency
+
+    outstanding is what was invoiced in the range and not paid or cancelled in it, so over
+    the whole history it is the open receivables.
+    """
+    match = {"orgId": org_id}
+    if start_period or end_period:
+        match["period"] = {}
+        if start_period:
+            match["period"]["$gte"] = start_period
+        if end_period:
+            match["period"]["$lte"] = end_period
+    field = {"organization": None, "period": "period", "client": "clientId", "workOrder": "workOrderId"}[group_by]
+    pipeline = [
+        {"$match": match},
+        {
+            "$group": {
+                "_id": {"key": f"${field}" if field else None, "currencyId": "$currencyId"},
+                **{measure: {"$sum": f"${measure}"} for measure in METRICS_MEASURES},
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                **({field: "$_id.key"} if field else {}),
+                "currencyId": "$_id.currencyId",
+                **{measure: 1 for measure in METRICS_MEASURES},
+                "outstanding": {"$subtract": [{"$add": ["$invoiced", "$tax"]}, {"$add": ["$paid", "$cancelled"]}]},
+            }
+        },
+        {"$sort": {**({field: 1} if field else {}), "currencyId": 1}},
+    ]
+    return DataAggregation("MetricsCube", pipeline)
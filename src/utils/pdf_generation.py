@@ -1,4 +1,3 @@
-import pdfkit
 from src.config.settings import TEMPLATE_ENV
 from src.utils.convertors import get_base64_string
 
@@ -23,6 +22,8 @@ def generate_invoice_pdf(invoice_data: dict, pdf_options: dict, template: str):
     output_text = template.render(
         logo=logo, tax_amount=tax_amount, total_amount=total_amount, **invoice_data
     )
+    import pdfkit
+
     pdf = pdfkit.from_string(output_text, False, options=pdf_options)
     return pdf
 
@@ -38,5 +39,7 @@ def generate_timesheet_pdf(
         logo=logo,
         data=data,
     )
+    import pdfkit
+
     pdf = pdfkit.from_string(output_text, False, options=pdf_options)
     return pdf
@@ -10,6 +10,7 @@ from fastapi import HTTPException, Depends
 
 from src.config.database import SingleDataReader
 from src.utils.auth import decode_token
+from src.utils.batching import load
 from src.models.db_models import UserInDb
 
 
@@ -175,7 +176,7 @@ async def validate_jwt_token(token=Depends(JWTRequired)) -> UserInDb:
     if not user_id:
         raise HTTPException(status_code=403, detail="Malformed authorization code.")
     # user = await prisma.user.find_unique(where={"id": user_id})
-    user = SingleDataReader("User", {"id": user_id}, None)
+    user = await load("User", user_id)
     if not user:
         raise HTTPException(status_code=403, detail="Invalid authorization code.")
     return UserInDb(**user)
@@ -0,0 +1,81 @@
+import threading
+import time
+
+from src.config.database import FindOneAndUpdate, MultiDataReader, SingleDataReader
+from src.config.settings import REFERENCE_DATA_TTL_SECONDS
+
+
+class ReferenceData:
+    """In-process copy of every currency and organization
+
+    A version counter in the ReferenceVersion collection is bumped on each
+    write to either collection. Processes compare it at most once per ttl
+    seconds and reload everything when it moved, the writing process reloads
+    on its next read. A document created since the last reload is read on
+    its first miss and kept until the next one.
+    """
+
+    def __init__(self, ttl: float = REFERENCE_DATA_TTL_SECONDS):
+        self.ttl = ttl
+        self.version = None
+        self.checked_at = 0
+        self.currencies = {}
+        self.organizations = {}
+        self._lock = threading.Lock()
+
+    def _is_fresh(self) -> bool:
+        return self.version is not None and time.monotonic() - self.checked_at < self.ttl
+
+    def _refresh(self):
+        if self._is_fresh():
+            return
+        with self._lock:
+            if self._is_fresh():
+                return
+            stored = SingleDataReader("ReferenceVersion", {"id": "reference"}, {"_id": 0, "version": 1})
+            version = stored["version"] if stored else 0
+            if version != self.version:
+                currencies = MultiDataReader("Currency", {}, {"_id": 0})
+                organizations = MultiDataReader("Organization", {}, {"_id": 0})
+                if currencies is None or organizations is None:
+                    return
+                self.currencies = {currency["id"]: currency for currency in currencies}
+                self.organizations = {organization["id"]: organization for organization in organizations}
+                self.version = version
+            self.checked_at = time.monotonic()
+
+    def _lookup(self, cached: dict, collection: str, document_id: str) -> dict:
+        """Cached document, read and kept when it was written after the last reload"""
+        self._refresh()
+        document = cached.get(document_id)
+        if document is None and document_id is not None:
+            document = SingleDataReader(collection, {"id": document_id}, {"_id": 0})
+            if document:
+                cached[document_id] = document
+        return dict(document) if document else None
+
+    def currency(self, currency_id: str) -> dict:
+        return self._lookup(self.currencies, "Currency", currency_id)
+
+    def organization(self, org_id: str) -> dict:
+        return self._lookup(self.organizations, "Organization", org_id)
+
+    def invalidate(self):
+        FindOneAndUpdate("ReferenceVersion", {"id": "reference"}, {"$inc": {"version": 1}}, upsert=True)
+        with self._lock:
+            self.version = None
+
+
+reference_data = ReferenceData()
+
+
+def with_currency(document: dict, field: str = "currencyId", target: str = "currency") -> dict:
+    """Set document[target] to the cached currency referenced by document[field]"""
+    document[target] = reference_data.currency(document.get(field))
+    return document
+
+
+def with_organization(document: dict, field: str = "orgId", target: str = "organization") -> dict:
+    """Set document[target] to the cached organization referenced by document[field]"""
+    document[target] = reference_data.organization(document.get(field))
+    return document
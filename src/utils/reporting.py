@@ -0,0 +1,87 @@
+from src.utils.snapshots import read_table
+
+UTILIZATION_GROUPS = {"user": "chargedById", "client": "clientId", "workOrder": "workOrderId"}
+
+
+def snapshot_frame(org_id: str, table: str, start_period: str = None, end_period: str = None, manifest: dict = None):
+    """(manifest, DataFrame) of a snapshot table, (None, None) without a snapshot"""
+    import pandas as pd
+
+    manifest, columns = read_table(org_id, table, start_period, end_period, manifest)
+    if columns is None:
+        return None, None
+    return manifest, pd.DataFrame(columns, copy=False)
+
+
+def revenue_report(org_id: str, start_period: str = None, end_period: str = None, by_client: bool = False) -> dict:
+    """Invoiced, paid and outstanding amounts per month and currency from the analytics snapshot
+
+    Invoices count in the month they were generated and payments in the month
+    they were received, outstanding is invoiced + tax - paid - cancelled as on
+    the metrics dashboard. Amounts are in the invoice and payment currency.
+    received/spent come from the ledger and are in the organization default currency.
+
+    Returns:
+        dict: snapshot creation time, invoice rows and ledger rows, None without a snapshot
+    """
+    manifest, invoices = snapshot_frame(org_id, "invoices", start_period, end_period)
+    if invoices is None:
+        return None
+    manifest, payments = snapshot_frame(org_id, "payments", start_period, end_period, manifest)
+    manifest, transactions = snapshot_frame(org_id, "transactions", start_period, end_period, manifest)
+
+    keys = ["period", "currencyId"] + (["clientId"] if by_client else [])
+    # Invoices neither due nor paid were cancelled, their whole amount is written off
+    cancelled = invoices["dueBy"].isna() & invoices["paidOn"].isna()
+    invoices["cancelled"] = (invoices["amount"] + invoices["tax"].fillna(0)).where(cancelled, 0)
+    invoiced = invoices.groupby(keys, sort=True).agg(
+        invoices=("id", "size"),
+        invoiced=("amount", "sum"),
+        tax=("tax", "sum"),
+        cancelled=("cancelled", "sum"),
+    )
+    paid = payments.groupby(keys, sort=True).agg(
+        payments=("id", "size"),
+        paid=("amount", "sum"),
+    )
+    totals = invoiced.join(paid, how="outer").fillna(0).reset_index()
+    totals[["invoices", "payments"]] = totals[["invoices", "payments"]].astype(int)
+    totals["outstanding"] = totals["invoiced"] + totals["tax"] - totals["paid"] - totals["cancelled"]
+
+    ledger = transactions.groupby("period", sort=True).agg(
+        received=("credit", "sum"),
+        spent=("debit", "sum"),
+    ).reset_index()
+    ledger["net"] = ledger["received"] - ledger["spent"]
+    return {
+        "snapshotAt": manifest["createdAt"],
+        "invoices": totals.to_dict("records"),
+        "ledger": ledger.to_dict("records"),
+    }
+
+
+def utilization_report(org_id: str, start_period: str = None, end_period: str = None, group_by: str = "user") -> dict:
+    """Hours charged and invoiced per month from the analytics snapshot
+
+    Args:
+        group_by (str): "user", "client" or "workOrder"
+
+    Returns:
+        dict: snapshot creation time and rows with hours, invoicedHours and utilization, None without a snapshot
+    """
+    manifest, time_charges = snapshot_frame(org_id, "timesheets", start_period, end_period)
+    if time_charges is None:
+        return None
+
+    key = UTILIZATION_GROUPS[group_by]
+    time_charges["invoicedHours"] = time_charges["hours"].where(time_charges["invoiced"], 0)
+    rows = time_charges.groupby(["period", key], sort=True).agg(
+        timeCharges=("id", "size"),
+        hours=("hours", "sum"),
+        invoicedHours=("invoicedHours", "sum"),
+    ).reset_index()
+    rows["utilization"] = (rows["invoicedHours"] / rows["hours"]).where(rows["hours"] > 0, 0).round(4)
+    return {
+        "snapshotAt": manifest["createdAt"],
+        "rows": rows.rename(columns={key: f"{group_by}Id"}).to_dict("records"),
+    }
@@ -0,0 +1,236 @@
+import json
+import os
+import shutil
+from datetime import datetime
+from uuid import uuid4
+
+from src.config.database import MultiDataReader
+from src.config.settings import ANALYTICS_SNAPSHOT_DIR
+from src.utils.auth import get_utc_timestamp
+
+# Column types of each snapshot table, strings are fixed width so every column can be memory-mapped
+SNAPSHOT_TABLES = {
+    "timesheets": [
+        ("id", "str"),
+        ("workOrderId", "str"),
+        ("clientId", "str"),
+        ("currencyId", "str"),
+        ("chargedById", "str"),
+        ("startTime", "datetime64[s]"),
+        ("hours", "float64"),
+        ("rate", "float64"),
+        ("invoiced", "bool"),
+    ],
+    "invoices": [
+        ("id", "str"),
+        ("workOrderId", "str"),
+        ("clientId", "str"),
+        ("currencyId", "str"),
+        ("generatedOn", "datetime64[s]"),
+        ("dueBy", "datetime64[s]"),
+        ("paidOn", "datetime64[s]"),
+        ("amount", "float64"),
+        ("tax", "float64"),
+    ],
+    "payments": [
+        ("id", "str"),
+        ("invoiceId", "str"),
+        ("clientId", "str"),
+        ("currencyId", "str"),
+        ("createdAt", "int64"),
+        ("amount", "float64"),
+    ],
+    "transactions": [
+        ("id", "str"),
+        ("accountId", "str"),
+        ("clientId", "str"),
+        ("currencyId", "str"),
+        ("transaction_date", "int64"),
+        ("debit", "float64"),
+        ("credit", "float64"),
+        ("originalAmount", "float64"),
+    ],
+}
+
+
+def month(value) -> str:
+    return value.strftime("%Y-%m") if value else None
+
+
+def snapshot_rows(org_id: str) -> dict:
+    """Rows of every snapshot table of the organization by month
+
+    Returns:
+        dict: {table: {"YYYY-MM": [row, ...]}}
+    """
+    client_ids = [
+        client["id"] for client in MultiDataReader("Client", {"orgId": org_id}, {"_id": 0, "id": 1})
+    ]
+    work_orders = {
+        work_order["id"]: work_order
+        for work_order in MultiDataReader(
+            "WorkOrder",
+            {"clientId": {"$in": client_ids}},
+            {"_id": 0, "id": 1, "clientId": 1, "currencyId": 1, "rate": 1},
+        )
+    }
+    tables = {table: {} for table in SNAPSHOT_TABLES}
+
+    time_charges = MultiDataReader(
+        "Timesheet",
+        {"workOrderId": {"$in": list(work_orders)}},
+        {"_id": 0, "id": 1, "workOrderId": 1, "chargedById": 1, "startTime": 1, "endTime": 1, "invoiced": 1},
+    )
+    for time_charge in time_charges:
+        work_order = work_orders[time_charge["workOrderId"]]
+        tables["timesheets"].setdefault(month(time_charge["startTime"]), []).append({
+            **time_charge,
+            "clientId": work_order["clientId"],
+            "currencyId": work_order["currencyId"],
+            "hours": (time_charge["endTime"] - time_charge["startTime"]).total_seconds() / 3600,
+            "rate": work_order["rate"],
+        })
+
+    invoices = MultiDataReader("Invoice", {"workOrderId": {"$in": list(work_orders)}}, {"_id": 0})
+    invoice_clients = {}
+    for invoice in invoices:
+        work_order = work_orders[invoice["workOrderId"]]
+        invoice_clients[invoice["id"]] = work_order["clientId"]
+        tables["invoices"].setdefault(month(invoice["generatedOn"]), []).append(
+            {**invoice, "clientId": work_order["clientId"]}
+        )
+
+    payments = MultiDataReader(
+        "Payment",
+        {"invoiceId": {"$in": list(invoice_clients)}},
+        {"_id": 0, "id": 1, "invoiceId": 1, "currencyId": 1, "createdAt": 1, "amount": 1},
+    )
+    for payment in payments:
+        tables["payments"].setdefault(month(datetime.utcfromtimestamp(payment["createdAt"])), []).append(
+            {**payment, "clientId": invoice_clients[payment["invoiceId"]]}
+        )
+
+    for entry in MultiDataReader("LedgerEntry", {"orgId": org_id}, {"_id": 0}):
+        tables["transactions"].setdefault(entry["period"], []).append(entry)
+    return tables
+
+
+def column_array(rows: list, column: str, dtype: str):
+    import numpy as np
+
+    values = [row.get(column) for row in rows]
+    if dtype == "str":
+        return np.array(["" if value is None else str(value) for value in values], dtype=str)
+    if dtype == "bool":
+        return np.array([bool(value) for value in values], dtype=bool)
+    if dtype == "int64":
+        return np.array([value or 0 for value in values], dtype=np.int64)
+    # None becomes NaN for floats and NaT for datetimes
+    return np.array(values, dtype=dtype)
+
+
+def write_partition(path: str, table: str, rows: list):
+    import numpy as np
+
+    os.makedirs(path)
+    for column, dtype in SNAPSHOT_TABLES[table]:
+        np.save(os.path.join(path, f"{column}.npy"), column_array(rows, column, dtype))
+
+
+def snapshot_manifest(org_id: str) -> dict:
+    """Version and creation time of the organization's current snapshot, None when there is none"""
+    try:
+        with open(os.path.join(ANALYTICS_SNAPSHOT_DIR, org_id, "CURRENT")) as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def snapshot_organization(org_id: str) -> dict:
+    """Write a new snapshot version of the organization and make it current
+
+    Each version is a directory of table/YYYY-MM/column.npy files. CURRENT is
+    swapped in once the version is complete. The version it replaces stays on
+    disk for readers that read CURRENT just before the swap, older ones are
+    removed; readers that already mapped them keep their open files.
+    """
+    version = f"{get_utc_timestamp()}-{uuid4().hex[:8]}"
+    previous = snapshot_manifest(org_id)
+    kept = {version, previous["version"] if previous else None}
+    org_dir = os.path.join(ANALYTICS_SNAPSHOT_DIR, org_id)
+    version_dir = os.path.join(org_dir, version)
+    os.makedirs(version_dir)
+
+    tables = snapshot_rows(org_id)
+    partitions = {}
+    for table, months in tables.items():
+        for period, rows in months.items():
+            write_partition(os.path.join(version_dir, table, period), table, rows)
+        partitions[table] = sorted(months)
+
+    manifest = {"version": version, "createdAt": get_utc_timestamp(), "partitions": partitions}
+    partial_path = os.path.join(org_dir, f"CURRENT.{uuid4().hex}.part")
+    with open(partial_path, "w") as file:
+        json.dump(manifest, file)
+    os.replace(partial_path, os.path.join(org_dir, "CURRENT"))
+
+    for entry in os.scandir(org_dir):
+        if entry.is_dir() and entry.name not in kept:
+            shutil.rmtree(entry.path, ignore_errors=True)
+    return manifest
+
+
+def snapshot_analytics(org_id: str = None):
+    """Snapshot timesheets, invoices, invoice payments and ledger entries of one or every organization"""
+    organizations = MultiDataReader("Organization", {"id": org_id} if org_id else {}, {"_id": 0, "id": 1})
+    for organization in list(organizations):
+        snapshot_organization(organization["id"])
+
+
+def load_columns(org_id: str, manifest: dict, table: str, periods: list) -> dict:
+    import numpy as np
+
+    table_dir = os.path.join(ANALYTICS_SNAPSHOT_DIR, org_id, manifest["version"], table)
+    columns = {}
+    for column, dtype in SNAPSHOT_TABLES[table]:
+        arrays = [
+            np.load(os.path.join(table_dir, period, f"{column}.npy"), mmap_mode="r") for period in periods
+        ]
+        if len(arrays) == 1:
+            columns[column] = arrays[0]
+        elif arrays:
+            columns[column] = np.concatenate(arrays)
+        else:
+            columns[column] = np.array([], dtype=str if dtype == "str" else dtype)
+        if column == "id":
+            columns["period"] = np.repeat(np.array(periods, dtype=str), [len(array) for array in arrays])
+    return columns
+
+
+def read_table(
+        org_id: str, table: str, start_period: str = None, end_period: str = None, manifest: dict = None
+) -> tuple:
+    """Columns of a snapshot table over the months, memory-mapped when a single month is read
+
+    Args:
+        manifest (dict): snapshot version to read, the current one by default; pass the manifest
+            returned for a first table to read the others from the same version
+
+    Returns:
+        tuple: (manifest of the version read, {column: numpy array} with a "period" column added),
+            (None, None) when the organization has no snapshot
+    """
+    for attempt in range(2):
+        manifest = manifest if attempt == 0 and manifest else snapshot_manifest(org_id)
+        if manifest is None:
+            return None, None
+        periods = [
+            period for period in manifest["partitions"].get(table, [])
+            if (not start_period or period >= start_period) and (not end_period or period <= end_period)
+        ]
+        try:
+            return manifest, load_columns(org_id, manifest, table, periods)
+        except FileNotFoundError:
+            # The version was pruned by two snapshots since CURRENT was read, once more with the new CURRENT
+            if attempt:
+                raise
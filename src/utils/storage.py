@@ -1,19 +1,31 @@
-from azure.identity import ClientSecretCredential, DefaultAzureCredential
-from azure.storage.blob import BlobServiceClient
+import os
+import time
+from uuid import uuid4
 
-from src.config.settings import STORAGE_ACCOUNT_NAME
+from src.config.settings import DOCUMENT_CACHE_DIR, DOCUMENT_CACHE_SECONDS, STORAGE_ACCOUNT_NAME
+
+# Directories of DOCUMENT_CACHE_DIR that are not blob copies and have their own lifetime
+UNCACHED_DIRS = ("exports", "spool")
+# Least seconds between two scans of the blob copies
+PRUNE_INTERVAL_SECONDS = 600
+_pruned_at = 0
 
 
 def getCredentials() -> any:
+    # The Azure SDK is slow to import, load it on the first blob operation
+    from azure.identity import DefaultAzureCredential
+
     return DefaultAzureCredential()
 
 
+def getBlobServiceClient(account_url: str) -> any:
+    from azure.storage.blob import BlobServiceClient
+
+    return BlobServiceClient(account_url=account_url, credential=getCredentials())
+
+
 def list_blobs(storage_account: str = STORAGE_ACCOUNT_NAME, path: str = None) -> list:
-    token_credential = getCredentials()
-    blob_service_client = BlobServiceClient(
-        account_url=f"https://{storage_account}.blob.core.windows.net",
-        credential=token_credential,
-    )
+    blob_service_client = getBlobServiceClient(f"https://{storage_account}.blob.core.windows.net")
     container_name = path.split("/")[0]
     target_directory = "/".join(path.split("/")[1:])
     try:
@@ -37,11 +49,7 @@ def read_blob(
     path: str = None,
     bytes_to_read: int = None,
 ) -> any:
-    token_credential = getCredentials()
-    blob_service_client = BlobServiceClient(
-        account_url=f"https://{storage_account}.blob.core.windows.net",
-        credential=token_credential,
-    )
+    blob_service_client = getBlobServiceClient(f"https://{storage_account}.blob.core.windows.net")
     container_name = path.split("/")[0]
     target_filepath = "/".join(path.split("/")[1:])
     try:
@@ -59,15 +67,108 @@ def read_blob(
         return None
 
 
+def read_blob_to_file(
+    storage_account: str = STORAGE_ACCOUNT_NAME, path: str = None, file: any = None
+) -> bool:
+    """Stream a blob into an open binary file without holding it in memory"""
+    blob_service_client = getBlobServiceClient(f"https://{storage_account}.blob.core.windows.net")
+    container_name = path.split("/")[0]
+    target_filepath = "/".join(path.split("/")[1:])
+    try:
+        container_client = blob_service_client.get_container_client(container_name)
+        blob_client = container_client.get_blob_client(target_filepath)
+        blob_client.download_blob().readinto(file)
+        return True
+    except Exception as e:
+        print(e)
+        return False
+
+
+def prune_blob_cache():
+    """Drop local blob copies unused for DOCUMENT_CACHE_SECONDS, at most once per PRUNE_INTERVAL_SECONDS"""
+    global _pruned_at
+    if time.monotonic() - _pruned_at < PRUNE_INTERVAL_SECONDS:
+        return
+    _pruned_at = time.monotonic()
+    cutoff = time.time() - DOCUMENT_CACHE_SECONDS
+    for entry in os.scandir(DOCUMENT_CACHE_DIR):
+        if not entry.is_dir() or entry.name in UNCACHED_DIRS:
+            continue
+        for root, _, files in os.walk(entry.path, topdown=False):
+            for name in files:
+                try:
+                    file_path = os.path.join(root, name)
+                    if os.stat(file_path).st_mtime < cutoff:
+                        os.remove(file_path)
+                except OSError:
+                    pass
+            try:
+                if os.stat(root).st_mtime < cutoff:
+                    os.rmdir(root)
+            except OSError:
+                # Not empty
+                pass
+
+
+def cache_blob(storage_account: str = STORAGE_ACCOUNT_NAME, path: str = None) -> str:
+    """Local file holding the current version of a blob, downloaded on first use
+
+    The cached copy is keyed on the blob etag so rewritten documents (e.g. an
+    invoice regenerated on payment) are fetched again. Each use refreshes the
+    copy's mtime, copies unused for DOCUMENT_CACHE_SECONDS are pruned.
+
+    Returns:
+        str: path of the local copy, None when the blob could not be read
+    """
+    blob_service_client = getBlobServiceClient(f"https://{storage_account}.blob.core.windows.net")
+    container_name = path.split("/")[0]
+    target_filepath = "/".join(path.split("/")[1:])
+    try:
+        blob_client = blob_service_client.get_container_client(
+            container_name
+        ).get_blob_client(target_filepath)
+        etag = blob_client.get_blob_properties().etag.strip('"')
+    except Exception as e:
+        print(e)
+        return None
+
+    local_path = os.path.join(DOCUMENT_CACHE_DIR, container_name, etag, target_filepath)
+    try:
+        os.utime(local_path)
+        return local_path
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    prune_blob_cache()
+    partial_path = f"{local_path}.{uuid4().hex}.part"
+    with open(partial_path, "wb") as file:
+        downloaded = read_blob_to_file(storage_account, path, file)
+    if not downloaded:
+        os.remove(partial_path)
+        return None
+    os.replace(partial_path, local_path)
+    return local_path
+
+
+def spool_document(data: any, suffix: str = ".pdf") -> str:
+    """Write generated document bytes (or a memoryview of them) to the local cache
+
+    Returns:
+        str: path of the spooled file, the caller owns and removes it
+    """
+    spool_dir = os.path.join(DOCUMENT_CACHE_DIR, "spool")
+    os.makedirs(spool_dir, exist_ok=True)
+    local_path = os.path.join(spool_dir, f"{uuid4().hex}{suffix}")
+    with open(local_path, "wb") as file:
+        file.write(data)
+    return local_path
+
+
 def write_to_blob(
     storage_account: str = STORAGE_ACCOUNT_NAME, path: str = None, data: any = None
 ) -> any:
-    token_credential = getCredentials()
     account_url = f"https://{storage_account}.blob.core.windows.net"
-    blob_service_client = BlobServiceClient(
-        account_url=account_url,
-        credential=token_credential,
-    )
+    blob_service_client = getBlobServiceClient(account_url)
     container_name = path.split("/")[0]
     target_filepath = "/".join(path.split("/")[1:])
     try:
@@ -80,11 +181,7 @@ def write_to_blob(
 
 
 def delete_blob(storage_account: str = STORAGE_ACCOUNT_NAME, path: str = None) -> any:
-    token_credential = getCredentials()
-    blob_service_client = BlobServiceClient(
-        account_url=f"https://{storage_account}.blob.core.windows.net",
-        credential=token_credential,
-    )
+    blob_service_client = getBlobServiceClient(f"https://{storage_account}.blob.core.windows.net")
     container_name = path.split("/")[0]
     target_filepath = "/".join(path.split("/")[1:])
     try:
@@ -1,56 +1,430 @@
-import pandas as pd
-
+import io
 from datetime import datetime, timedelta
 
-from src.utils.date_time import generate_calendar_table, format_seconds_to_hr_mm
+from src.config.database import DataAggregation, DeleteData, FindOneAndUpdate, MultiDataReader, SingleDataReader
+from src.config.settings import CUT_OFF_DATE, MAX_TIME_CHARGE_HOURS
+from src.models.models import TimesheetDB
+from src.utils.date_time import generate_calendar_table, format_seconds_to_hr_mm, naive_utc
 from src.utils.pdf_generation import generate_timesheet_pdf
 
 
-def generate_timesheet_calendar(time_charges, details, work_order):
-    df = pd.DataFrame(list(map(lambda x: x, time_charges)))
-    df = df[["id", "description", "startTime", "endTime", "invoiced", "chargedById"]]
-    duration = df["endTime"] - df["startTime"]
-    df["duration"] = duration
-    df.sort_values(by=["startTime", "duration"], ascending=[True, False], inplace=True)
-    daily_grouper = df.groupby(pd.Grouper(key="startTime", freq="D"))
-    duration_df = daily_grouper["duration"].sum().reset_index()
-    description_df = (
-        daily_grouper.apply(lambda x: x.nlargest(4, "duration"))
-        .groupby(pd.Grouper(key="startTime", freq="D"))
-        .agg(
-            {
-                "description": lambda x: sorted(
-                    list(set(x)),
-                    key=lambda d: df.loc[df["description"] == d, "duration"].values[0],
-                    reverse=True,
-                )
+# Number of descriptions kept per day in the TimesheetDaily rollup
+TOP_DESCRIPTIONS = 4
+
+MAX_TIME_CHARGE = timedelta(hours=MAX_TIME_CHARGE_HOURS)
+TIME_CHARGE_TOO_LONG = f"A time charge cannot be longer than {MAX_TIME_CHARGE_HOURS} hours"
+
+
+def timesheet_daily_id(work_order_id, charged_by_id, date):
+    return f"{work_order_id}:{charged_by_id or ''}:{date.strftime('%Y-%m-%d')}"
+
+
+def timesheet_daily_stages():
+    """Aggregation stages rolling matched timesheets into one TimesheetDaily row per work order, user and day"""
+    duration = {"$divide": [{"$subtract": ["$endTime", "$startTime"]}, 1000]}
+    return [
+        {
+            "$group": {
+                "_id": {
+                    "workOrderId": "$workOrderId",
+                    "chargedById": "$chargedById",
+                    "date": {"$dateTrunc": {"date": "$startTime", "unit": "day"}},
+                    "description": "$description",
+                },
+                "seconds": {"$sum": duration},
+                "longest": {"$max": duration},
+                "entries": {"$sum": 1},
+                "invoicedSeconds": {"$sum": {"$cond": ["$invoiced", duration, 0]}},
+                "invoicedEntries": {"$sum": {"$cond": ["$invoiced", 1, 0]}},
             }
-        )
-        .reset_index()
-    )
-    charge_summary = pd.merge(duration_df, description_df, on="startTime")
-    date_range = pd.date_range(start=details.start, end=details.end, freq="D")
-    date_df = pd.DataFrame({"startTime": date_range})
+        },
+        {
+            "$sort": {"longest": -1}
+        },
+        {
+            "$group": {
+                "_id": {
+                    "workOrderId": "$_id.workOrderId",
+                    "chargedById": "$_id.chargedById",
+                    "date": "$_id.date",
+                },
+                "seconds": {"$sum": "$seconds"},
+                "entries": {"$sum": "$entries"},
+                "invoicedSeconds": {"$sum": "$invoicedSeconds"},
+                "invoicedEntries": {"$sum": "$invoicedEntries"},
+                "descriptions": {
+                    "$push": {"description": "$_id.description", "seconds": "$seconds", "longest": "$longest"}
+                },
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "id": {
+                    "$concat": [
+                        "$_id.workOrderId",
+                        ":",
+                        {"$ifNull": ["$_id.chargedById", ""]},
+                        ":",
+                        {"$dateToString": {"format": "%Y-%m-%d", "date": "$_id.date"}},
+                    ]
+                },
+                "workOrderId": "$_id.workOrderId",
+                "chargedById": "$_id.chargedById",
+                "date": "$_id.date",
+                "seconds": 1,
+                "entries": 1,
+                "invoicedSeconds": 1,
+                "invoicedEntries": 1,
+                "invoiced": {"$eq": ["$invoicedEntries", "$entries"]},
+                "descriptions": {"$slice": ["$descriptions", TOP_DESCRIPTIONS]},
+                "updatedAt": {"$toLong": {"$divide": [{"$toLong": "$$NOW"}, 1000]}},
+            }
+        },
+        {
+            "$merge": {
+                "into": "TimesheetDaily",
+                "on": "id",
+                "whenMatched": "replace",
+                "whenNotMatched": "insert",
+            }
+        }
+    ]
 
-    period_charge_summary = pd.merge(
-        date_df, charge_summary, on="startTime", how="left"
-    )
-    period_charge_summary["week_number"] = (
-        period_charge_summary["startTime"].dt.isocalendar().week
+
+def refresh_timesheet_daily(timesheets):
+    """Recompute the TimesheetDaily rollups of the days touched by the given timesheets
+
+    Args:
+        timesheets (list): timesheet documents that were created, updated or deleted
+    """
+    days = {}
+    for timesheet in timesheets:
+        date = datetime.combine(naive_utc(timesheet["startTime"]).date(), datetime.min.time())
+        day_id = timesheet_daily_id(timesheet["workOrderId"], timesheet.get("chargedById"), date)
+        days[day_id] = {
+            "workOrderId": timesheet["workOrderId"],
+            "chargedById": timesheet.get("chargedById"),
+            "startTime": {"$gte": date, "$lt": date + timedelta(days=1)},
+        }
+    if not days:
+        return
+
+    # Days left without charges have no rollup row, so clear them before merging the fresh ones
+    DeleteData("TimesheetDaily", {"id": {"$in": list(days.keys())}}, True)
+    pipeline = [{"$match": {"$or": list(days.values())}}, *timesheet_daily_stages()]
+    DataAggregation("Timesheet", pipeline)
+
+
+def rebuild_timesheet_daily(work_order_id=None):
+    """Rebuild the TimesheetDaily rollups from the raw timesheets, optionally for one work order"""
+    match = {"workOrderId": work_order_id} if work_order_id else {}
+    DeleteData("TimesheetDaily", match, True)
+    pipeline = [{"$match": match}, *timesheet_daily_stages()]
+    DataAggregation("Timesheet", pipeline)
+
+
+# Columns a bulk time charge upload has to carry
+TIME_CHARGE_COLUMNS = ["description", "startTime", "endTime"]
+
+
+def parse_time_charges_csv(content: bytes) -> list:
+    """Rows of an uploaded time charge CSV, values left as text for prepare_time_charges
+
+    Raises:
+        ValueError: the file cannot be read or misses a column
+    """
+    import pandas as pd
+
+    try:
+        df = pd.read_csv(io.BytesIO(content), dtype=str, keep_default_na=False, skipinitialspace=True)
+    except (pd.errors.ParserError, pd.errors.EmptyDataError, UnicodeDecodeError) as e:
+        raise ValueError(f"Unreadable CSV: {e}")
+    missing = [column for column in TIME_CHARGE_COLUMNS if column not in df.columns]
+    if missing:
+        raise ValueError(f"Missing column(s): {', '.join(missing)}")
+    return df[TIME_CHARGE_COLUMNS].to_dict("records")
+
+
+def overlapping(df):
+    """Flag the intervals of df overlapping any other one, df sorted by startTime
+
+    An interval overlaps an earlier one when it starts before the latest end
+    seen so far, and a later one when the next interval starts before it ends.
+    Touching intervals do not overlap.
+    """
+    previous_end = df["endTime"].cummax().shift()
+    next_start = df["startTime"].shift(-1)
+    return (df["startTime"] < previous_end) | (df["endTime"] > next_start)
+
+
+def overlapping_time_charge(charged_by_id: str, start: datetime, end: datetime, session=None) -> dict:
+    """Recorded charge of the user overlapping [start, end), None when the interval is free
+
+    No charge is longer than MAX_TIME_CHARGE, so only charges starting in
+    [start - MAX_TIME_CHARGE, end) can overlap. That bounded range of the
+    (chargedById, startTime) index is walked from its end, latest start first.
+    """
+    return SingleDataReader(
+        "Timesheet",
+        {
+            "chargedById": charged_by_id,
+            "startTime": {"$gte": start - MAX_TIME_CHARGE, "$lt": end},
+            "endTime": {"$gt": start},
+        },
+        {"_id": 0, "id": 1, "workOrderId": 1, "startTime": 1, "endTime": 1},
+        session=session,
+        sort=[("startTime", -1)],
     )
-    period_charge_summary["day_number"] = (
-        period_charge_summary["startTime"].dt.isocalendar().day
+
+
+def lock_time_charges(charged_by_id: str, session):
+    """Write the user's TimeChargeLock document inside the transaction recording their charges
+
+    Two transactions charging time for the same user both write it, the second
+    one hits a write conflict and is retried once the first committed, so its
+    overlap check sees the other charges. Without transactions (a standalone
+    server) the check stays best-effort.
+    """
+    FindOneAndUpdate(
+        "TimeChargeLock", {"id": charged_by_id}, {"$inc": {"version": 1}}, upsert=True, session=session
     )
-    period_charge_summary["duration"].fillna(timedelta(seconds=0), inplace=True)
-    period_charge_summary["description"].fillna("", inplace=True)
 
-    duration_in_seconds = period_charge_summary["duration"].apply(
-        lambda x: x.total_seconds()
+
+def find_overlaps(time_charges) -> list:
+    """Pairs of overlapping charges, time_charges sorted by chargedById then startTime
+
+    A single sweep keeps, per user, the charge reaching furthest so far. Any
+    charge starting before that one ends overlaps it.
+    """
+    overlaps = []
+    furthest = None
+    for time_charge in time_charges:
+        if furthest is not None and furthest["chargedById"] != time_charge["chargedById"]:
+            furthest = None
+        if furthest is not None and time_charge["startTime"] < furthest["endTime"]:
+            overlap = min(furthest["endTime"], time_charge["endTime"]) - time_charge["startTime"]
+            overlaps.append({
+                "chargedById": time_charge["chargedById"],
+                "first": furthest,
+                "second": time_charge,
+                "overlapSeconds": overlap.total_seconds(),
+            })
+        if furthest is None or time_charge["endTime"] > furthest["endTime"]:
+            furthest = time_charge
+    return overlaps
+
+
+def time_charge_text(value):
+    """ISO text of a datetime, text as given, None for anything else"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value if isinstance(value, str) else None
+
+
+def prepare_time_charges(rows: list, work_order_id: str, charged_by_id: str, session=None):
+    """Validate time charges of one user against each other and the charges already recorded
+
+    Args:
+        rows (list): dicts with description, startTime and endTime, as text or datetimes; any
+            other value, or a missing one, is reported as that row's error
+        work_order_id (str): work order the time is charged to, already validated
+        charged_by_id (str): user charging the time
+        session (ClientSession): transaction the recorded charges are read in
+
+    Returns:
+        tuple: TimesheetDB documents to insert and the errors as {"row", "detail"}, rows counted from 1
+    """
+    import pandas as pd
+
+    df = pd.DataFrame(rows, columns=TIME_CHARGE_COLUMNS)
+    df["row"] = range(1, len(df) + 1)
+    df["description"] = df["description"].map(lambda value: value.strip() if isinstance(value, str) else "")
+    for column in ("startTime", "endTime"):
+        values = df[column].map(time_charge_text)
+        df[column] = pd.to_datetime(values, errors="coerce", utc=True, format="ISO8601").dt.tz_convert(None)
+
+    df["error"] = None
+    checks = [
+        (df["description"] == "", "Description is required"),
+        (df["startTime"].isna(), "Invalid startTime"),
+        (df["endTime"].isna(), "Invalid endTime"),
+        (df["startTime"] > df["endTime"], "Start Time Cannot be greater than the endTime"),
+        (df["endTime"] - df["startTime"] > MAX_TIME_CHARGE, TIME_CHARGE_TOO_LONG),
+    ]
+    for failed, detail in checks:
+        df.loc[failed & df["error"].isna(), "error"] = detail
+
+    valid = df[df["error"].isna()]
+    if not valid.empty:
+        existing = MultiDataReader(
+            "Timesheet",
+            {
+                "chargedById": charged_by_id,
+                "startTime": {
+                    "$gte": valid["startTime"].min().to_pydatetime() - MAX_TIME_CHARGE,
+                    "$lt": valid["endTime"].max().to_pydatetime(),
+                },
+                "endTime": {"$gt": valid["startTime"].min().to_pydatetime()},
+            },
+            {"_id": 0, "startTime": 1, "endTime": 1},
+            session,
+        )
+        existing = pd.DataFrame(list(existing or []), columns=["startTime", "endTime"])
+        for column in ("startTime", "endTime"):
+            existing[column] = pd.to_datetime(existing[column])
+        intervals = pd.concat(
+            [valid[["row", "startTime", "endTime"]], existing.assign(row=0)], ignore_index=True
+        ).sort_values("startTime", kind="mergesort")
+        clashing = intervals.loc[overlapping(intervals) & (intervals["row"] > 0), "row"]
+        df.loc[df["row"].isin(clashing), "error"] = "Overlaps another time charge"
+
+    timesheets = [
+        TimesheetDB(
+            description=row.description,
+            startTime=row.startTime.to_pydatetime(),
+            endTime=row.endTime.to_pydatetime(),
+            workOrderId=work_order_id,
+            chargedById=charged_by_id,
+        )
+        for row in df[df["error"].isna()].itertuples()
+    ]
+    errors = [
+        {"row": row.row, "detail": row.error}
+        for row in df[df["error"].notna()].itertuples()
+    ]
+    return timesheets, errors
+
+
+def summarize_charged_days(charged_days, start_date, end_date, work_order):
+    """Build the week summary from timesheets already grouped per day.
+
+    Args:
+        charged_days (list): rows of ``date``, ``duration`` (ms), ``invoiced`` and ``timesheets``
+        start_date (datetime): first day of the period, optional
+        end_date (datetime): last day of the period, optional
+        work_order (WorkOrder): work order the charges belong to
+
+    Returns:
+        dict: total duration and the per day details sorted by date
+    """
+    days = {}
+    total_seconds = 0
+    max_seconds = 0
+    for row in charged_days:
+        seconds = row["duration"] / 1000
+        total_seconds += seconds
+        max_seconds = max(max_seconds, seconds)
+        date = row["date"].date()
+        for timesheet in row["timesheets"]:
+            timesheet["duration"] = format_seconds_to_hr_mm(
+                (timesheet["endTime"] - timesheet["startTime"]).total_seconds()
+            )
+            timesheet["date"] = date
+        days[date] = {
+            "date": date,
+            "duration": seconds,
+            "invoiced": row["invoiced"] is True,
+            "timesheets": row["timesheets"],
+        }
+
+    for day in days.values():
+        day["pct"] = round((day["duration"] / max_seconds) * 100, 0) if max_seconds else 0
+        day["duration"] = format_seconds_to_hr_mm(day["duration"])
+
+    if start_date and end_date:
+        current_date = start_date
+        while current_date <= end_date:
+            date_to_search = current_date.date()
+            if date_to_search not in days:
+                days[date_to_search] = {
+                    "date": date_to_search,
+                    "duration": "0:00 hrs",
+                    "pct": 0,
+                    "invoiced": date_to_search < work_order.startDate.date()
+                                or date_to_search < CUT_OFF_DATE.date(),
+                    "timesheets": [],
+                }
+            current_date += timedelta(days=1)
+
+    return {
+        "total_duration": format_seconds_to_hr_mm(total_seconds),
+        "total_duration_numeric": round(total_seconds / 3600, 2),
+        "details": [days[date] for date in sorted(days)],
+    }
+
+
+def fold_calendar_days(rollups) -> dict:
+    """Charged seconds and longest distinct descriptions per work order and day, over every user
+
+    Args:
+        rollups (iterable): TimesheetDaily rows
+
+    Returns:
+        dict: {workOrderId: {date: {"seconds": float, "descriptions": [description, ...]}}}
+    """
+    days = {}
+    for rollup in rollups:
+        day = days.setdefault(rollup["workOrderId"], {}).setdefault(rollup["date"], {"seconds": 0, "longest": {}})
+        day["seconds"] += rollup["seconds"]
+        for description in rollup.get("descriptions") or []:
+            longest = day["longest"].get(description["description"], 0)
+            day["longest"][description["description"]] = max(longest, description["longest"])
+    for work_order_days in days.values():
+        for day in work_order_days.values():
+            longest = day.pop("longest")
+            day["descriptions"] = sorted(longest, key=longest.get, reverse=True)[:TOP_DESCRIPTIONS]
+    return days
+
+
+def timesheet_calendar_days(work_order_ids: list, start: datetime, end: datetime) -> dict:
+    """fold_calendar_days of the TimesheetDaily rollups of the work orders in [start, end]"""
+    first_day = datetime.combine(naive_utc(start).date(), datetime.min.time())
+    rollups = MultiDataReader(
+        "TimesheetDaily",
+        {"workOrderId": {"$in": work_order_ids}, "date": {"$gte": first_day, "$lte": naive_utc(end)}},
+        {"_id": 0, "workOrderId": 1, "date": 1, "seconds": 1, "descriptions": 1},
     )
-    period_charge_summary["duration"] = duration_in_seconds
-    data = period_charge_summary.to_dict("records")
+    return fold_calendar_days(rollups or [])
+
+
+def timesheet_calendar_data(days: dict, start: datetime, end: datetime):
+    """Calendar weeks of [start, end] with each day's duration and longest distinct descriptions
+
+    Args:
+        days (dict): {date: {"seconds", "descriptions"}} of one work order, from fold_calendar_days
+
+    Returns:
+        tuple: (calendar_data, weekly_duration, seconds charged over the period)
+    """
+    data = []
+    date = datetime.combine(naive_utc(start).date(), datetime.min.time())
+    while date.date() <= naive_utc(end).date():
+        day = days.get(date, {})
+        _, week_number, day_number = date.isocalendar()
+        data.append({
+            "startTime": date,
+            "duration": day.get("seconds", 0),
+            "description": day.get("descriptions") or "",
+            "week_number": week_number,
+            "day_number": day_number,
+        })
+        date += timedelta(days=1)
 
     calendar_data, weekly_duration = generate_calendar_table(data)
+    return calendar_data, weekly_duration, sum(entry["duration"] for entry in data)
+
+
+def generate_timesheet_calendar(days, details, work_order):
+    """Timesheet PDF of a work order over details.start to details.end
+
+    Args:
+        days (dict): {date: {"seconds", "descriptions"}} of the work order, from timesheet_calendar_days
+
+    Returns:
+        tuple: total time charged as text and the PDF
+    """
+    calendar_data, weekly_duration, seconds = timesheet_calendar_data(days, details.start, details.end)
     timesheet_period = f"{details.start.strftime('%d/%m/%Y')} - {details.end.strftime('%d/%m/%Y')} | {(details.end - details.start).days + 1} day(s)"
     pdf_data = {
         "calendar_data": calendar_data,
@@ -78,8 +452,6 @@ def generate_timesheet_calendar(time_charges, details, work_order):
         template="templates/timesheet.html",
     )
 
-    total_time_charged = format_seconds_to_hr_mm(
-        period_charge_summary["duration"].sum()
-    )
+    total_time_charged = format_seconds_to_hr_mm(seconds)
 
     return total_time_charged, pdf